@@ -0,0 +1,15 @@
+"""OSBuild Manifest Benchmarks"""
+
+
+from .bench import (
+    Bench,
+    FakeDepsolver,
+    generate_corpus,
+)
+
+
+__all__ = [
+    "Bench",
+    "FakeDepsolver",
+    "generate_corpus",
+]
@@ -0,0 +1,10 @@
+"""OSBuild Manifest Benchmarks"""
+
+
+import sys
+from .bench import Bench as Main
+
+
+if __name__ == "__main__":
+    with Main(sys.argv) as global_main:
+        sys.exit(global_main.run())
@@ -0,0 +1,553 @@
+"""Manifest Benchmarks
+
+The benchmarks measure the hot paths of the pre-processor and the database
+on a synthetic corpus of manifest stubs. The corpus is generated from a
+seed, so the same parameters always produce the same corpus. Dependencies
+are resolved by a fake depsolve backend, which needs neither network access
+nor repository metadata, so the benchmarks run on any plain Linux machine.
+
+Results are written as JSON, together with the parameters of the run and the
+commit it was run on, so they can be compared across commits.
+"""
+
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import mdb
+import mpp
+import mpp.compact
+import mpp.mpp
+from mpp import codec, depsolve
+
+
+VERSION = 1
+
+
+class FakeDepsolver(depsolve.DepsolveBackend):
+    """Fake Dependency Solver
+
+    Resolves every requested package to exactly itself, with a checksum
+    derived from the platform and the package name. No repository metadata
+    is involved and the depsolve cache is not used, so results are
+    deterministic and cost next to nothing.
+    """
+
+    def session_key(self, options):
+        return (str(options["fedora"]), str(options["architecture"]))
+
+    def resolve(self, options):
+        fedora = str(options["fedora"])
+        architecture = str(options["architecture"])
+
+        deps = []
+        for name in options.get("packages", []):
+            digest = hashlib.sha256(f"{fedora}/{architecture}/{name}".encode()).hexdigest()
+            deps.append({
+                "checksum": "sha256:" + digest,
+                "name": name,
+                "path": f"Packages/{name[0]}/{name}-1.0-1.fc{fedora}.{architecture}.rpm",
+            })
+        return deps
+
+
+def register_backend():
+    """Register the fake depsolve backend as `fake`"""
+
+    depsolve.BACKENDS.setdefault("fake", FakeDepsolver)
+
+
+def _rpm_stage(fedora, architecture, packages):
+    return {
+        "name": "org.osbuild.rpm",
+        "options": {
+            "mpp-depsolve": {
+                "architecture": architecture,
+                "baseurl": f"https://example.com/fedora/{fedora}/{architecture}/os",
+                "fedora": fedora,
+                "packages": packages,
+            },
+        },
+    }
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(data, stream, indent=2)
+        stream.write("\n")
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def generate_corpus(path, *, manifests, depth, packages, platforms=2, seed=0):
+    """Generate a synthetic corpus of manifest stubs
+
+    Write a corpus of stubs into the directory `path`. For every platform,
+    there is a chain of `depth` build pipelines, each importing the one
+    below it via `mpp-pipeline-import`, and an OS pipeline. Every stub is
+    based on the OS pipeline of its platform via `mpp-pipeline-base`, uses
+    the top of the build chain, and adds its own packages. Every pipeline
+    resolves `packages` packages, drawn from a common pool.
+
+    Return the list of stubs, relative to `path`, in the order they were
+    generated.
+    """
+
+    rng = random.Random(seed)
+    pool = [f"pkg-{i:05d}" for i in range(max(packages, 1) * 4)]
+    count = min(packages, len(pool))
+
+    def sample():
+        return sorted(rng.sample(pool, count))
+
+    stubs = []
+    bases = []
+    for i in range(platforms):
+        fedora = str(32 + i // 2)
+        architecture = ("x86_64", "aarch64")[i % 2]
+        runner = f"org.osbuild.fedora{fedora}"
+        base = f"base/f{fedora}-{architecture}"
+
+        for level in range(depth):
+            pipeline = {"stages": [_rpm_stage(fedora, architecture, sample())]}
+            if level > 0:
+                pipeline["build"] = {
+                    "mpp-pipeline-import": f"{base}/build-{level - 1}.json",
+                    "runner": runner,
+                }
+            _write_json(os.path.join(path, base, f"build-{level}.json"), {"pipeline": pipeline})
+
+        _write_json(
+            os.path.join(path, base, "os.json"),
+            {"pipeline": {"stages": [_rpm_stage(fedora, architecture, sample())]}},
+        )
+        bases.append((base, fedora, architecture, runner))
+
+    for i in range(manifests):
+        base, fedora, architecture, runner = bases[i % len(bases)]
+        pipeline = {
+            "mpp-pipeline-base": f"{base}/os.json",
+            "stages": [
+                _rpm_stage(fedora, architecture, sample()),
+                {"name": "org.osbuild.locale", "options": {"language": "en_US"}},
+            ],
+        }
+        if depth > 0:
+            pipeline["build"] = {
+                "mpp-pipeline-import": f"{base}/build-{depth - 1}.json",
+                "runner": runner,
+            }
+        stub = os.path.join("stubs", f"f{fedora}-{architecture}", f"image-{i:05d}.json")
+        _write_json(os.path.join(path, stub), {"pipeline": pipeline})
+        stubs.append(stub)
+
+    return stubs
+
+
+def _measure(func, repeat):
+    # Run `func` once to warm up, then `repeat` times, and return the
+    # durations of all measured runs in seconds.
+    func()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _summary(durations, items):
+    return {
+        "items": items,
+        "repeat": len(durations),
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+        "per_item": min(durations) / max(items, 1),
+    }
+
+
+def _commit():
+    with contextlib.suppress(OSError, subprocess.CalledProcessError):
+        proc = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return proc.stdout.decode().strip()
+    return None
+
+
+class BenchSuite:
+    """Benchmark Suite
+
+    Runs all selected benchmarks on a generated corpus. The corpus is
+    pre-processed once up front, so the parsing and serialization
+    benchmarks operate on realistic pre-processed manifests.
+
+    Parameters
+    ----------
+    srcdir
+        Path to the generated corpus.
+    stubs
+        List of stubs of the corpus, relative to `srcdir`.
+    workdir
+        Path to a scratch directory for caches and databases.
+    repeat
+        Number of measured runs of every benchmark.
+    jobs
+        Number of jobs for `mdb preprocess`.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, srcdir, stubs, workdir, repeat, jobs):
+        self._srcdir = srcdir
+        self._stubs = stubs
+        self._workdir = workdir
+        self._repeat = repeat
+        self._jobs = jobs
+        self._engine = self._new_engine()
+        self._sources = []
+        for stub in stubs:
+            with open(os.path.join(srcdir, stub), "r", encoding="utf-8") as stream:
+                self._sources.append(json.load(stream))
+
+        self._outputs = []
+        for data in self._sources:
+            stream = io.StringIO()
+            self._engine.process(mpp.Manifest(mpp.mpp.json_copy(data))).to_stream(stream)
+            self._outputs.append(stream.getvalue())
+
+    def _new_engine(self):
+        path_cache = tempfile.mkdtemp(dir=self._workdir, prefix="cache-")
+        return mpp.MppEngine(
+            path_cache=path_cache,
+            path_cwd=self._srcdir,
+            depsolve_backend="fake",
+        )
+
+    @property
+    def corpus_size(self):
+        """Total size of the pre-processed corpus, in bytes"""
+        return sum(len(output.encode()) for output in self._outputs)
+
+    def bench_from_stream(self):
+        """Parse all pre-processed manifests"""
+
+        def run():
+            for output in self._outputs:
+                mpp.Manifest.from_stream(io.StringIO(output))
+
+        return _measure(run, self._repeat), len(self._outputs)
+
+    def bench_refresh(self):
+        """Refresh the links of all pre-processed manifests"""
+
+        manifests = [mpp.Manifest.from_stream(io.StringIO(o)) for o in self._outputs]
+
+        def run():
+            for manifest in manifests:
+                manifest.refresh()
+
+        return _measure(run, self._repeat), len(manifests)
+
+    def bench_to_stream(self):
+        """Serialize all pre-processed manifests"""
+
+        manifests = [mpp.Manifest.from_stream(io.StringIO(o)) for o in self._outputs]
+
+        def run():
+            for manifest in manifests:
+                manifest.to_stream(io.StringIO())
+
+        return _measure(run, self._repeat), len(manifests)
+
+    def bench_compact(self):
+        """Compact all pre-processed manifests with a new compactor"""
+
+        documents = [codec.default().loads(o) for o in self._outputs]
+
+        def run():
+            compactor = mpp.compact.Compactor()
+            for data in documents:
+                compactor.compact(data)
+
+        return _measure(run, self._repeat), len(documents)
+
+    def footprint(self):
+        """Memory footprint of the pre-processed corpus, in bytes
+
+        Return the footprint of all pre-processed manifests of the corpus,
+        decoded as plain documents and in their compact representation, with
+        and without packed checksums.
+        """
+
+        documents = [codec.default().loads(o) for o in self._outputs]
+        result = {"plain": mpp.compact.footprint(*documents)}
+        for name, pack_digests in (("compact", False), ("compact_packed", True)):
+            compactor = mpp.compact.Compactor(pack_digests=pack_digests)
+            compacted = [compactor.compact(data) for data in documents]
+            result[name] = mpp.compact.footprint(*compacted)
+        return result
+
+    def bench_mpp_run(self):
+        """Pre-process all stubs with a shared, warm engine"""
+
+        def run():
+            for data in self._sources:
+                self._engine.process(mpp.Manifest(mpp.mpp.json_copy(data)))
+
+        return _measure(run, self._repeat), len(self._sources)
+
+    def bench_mpp_run_cold(self):
+        """Pre-process all stubs with a new engine for every run"""
+
+        def run():
+            engine = self._new_engine()
+            for data in self._sources:
+                engine.process(mpp.Manifest(mpp.mpp.json_copy(data)))
+
+        return _measure(run, self._repeat), len(self._sources)
+
+    def _mdb(self, *args):
+        argv = ["osbuild-mdb", "--depsolve-backend", "fake", *args]
+        with mdb.Mdb(argv) as main:
+            ret = main.run()
+        if ret != 0:
+            raise RuntimeError(f"mdb {args[0]} failed with exit code {ret}")
+
+    def _new_database(self):
+        dstdir = tempfile.mkdtemp(dir=self._workdir, prefix="db-")
+        os.mkdir(os.path.join(dstdir, "by-checksum"))
+        return dstdir
+
+    def _mdb_preprocess(self, dstdir):
+        self._mdb(
+            "preprocess",
+            "--jobs", str(self._jobs),
+            "--srcdir", self._srcdir,
+            "--dstdir", dstdir,
+            "stubs",
+        )
+
+    def bench_mdb_preprocess(self):
+        """Pre-process the corpus into an empty database"""
+
+        def run():
+            self._mdb_preprocess(self._new_database())
+
+        return _measure(run, self._repeat), len(self._stubs)
+
+    def bench_mdb_preprocess_noop(self):
+        """Pre-process the corpus into an up-to-date database"""
+
+        dstdir = self._new_database()
+        self._mdb_preprocess(dstdir)
+
+        def run():
+            self._mdb_preprocess(dstdir)
+
+        return _measure(run, self._repeat), len(self._stubs)
+
+
+# Registry of all benchmarks, by name, in the order they are run.
+BENCHMARKS = {
+    "manifest.from_stream": BenchSuite.bench_from_stream,
+    "manifest.refresh": BenchSuite.bench_refresh,
+    "manifest.to_stream": BenchSuite.bench_to_stream,
+    "manifest.compact": BenchSuite.bench_compact,
+    "mpp.run": BenchSuite.bench_mpp_run,
+    "mpp.run.cold": BenchSuite.bench_mpp_run_cold,
+    "mdb.preprocess": BenchSuite.bench_mdb_preprocess,
+    "mdb.preprocess.noop": BenchSuite.bench_mdb_preprocess_noop,
+}
+
+
+class Bench(contextlib.AbstractContextManager):
+    """Benchmark Runner"""
+
+    def __init__(self, argv):
+        self.args = None
+        self._argv = argv
+        self._ctx = contextlib.ExitStack()
+        self._parser = None
+
+    def _parse_args(self):
+        self._parser = argparse.ArgumentParser(
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="OSBuild Manifest Benchmarks",
+            prog="osbuild-mdb-bench",
+        )
+
+        self._parser.add_argument(
+            "--benchmark",
+            action="append",
+            choices=list(BENCHMARKS),
+            help="Benchmark to run (can be given multiple times, default: all)",
+            metavar="NAME",
+        )
+        self._parser.add_argument(
+            "--codec",
+            choices=list(codec.CODECS),
+            help="JSON codec to use (default: fastest available)",
+            metavar="NAME",
+        )
+        self._parser.add_argument(
+            "--corpus",
+            help="Path to write the generated corpus to (default: temporary)",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        self._parser.add_argument(
+            "--depth",
+            default=3,
+            help="Number of build pipelines in every import chain",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--jobs",
+            default=1,
+            help="Number of jobs for database benchmarks",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--manifests",
+            default=64,
+            help="Number of stubs in the corpus",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--output",
+            help="Path to write the results to (default: standard output)",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        self._parser.add_argument(
+            "--packages",
+            default=200,
+            help="Number of packages of every depsolve request",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--platforms",
+            default=2,
+            help="Number of distinct platforms in the corpus",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--repeat",
+            default=5,
+            help="Number of measured runs of every benchmark",
+            metavar="N",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--seed",
+            default=0,
+            help="Seed of the corpus generator",
+            metavar="N",
+            type=int,
+        )
+
+        args = self._parser.parse_args(self._argv[1:])
+        if args.manifests < 1 or args.platforms < 1 or args.repeat < 1:
+            self._parser.error("--manifests, --platforms and --repeat must be positive")
+        if args.depth < 0 or args.packages < 0:
+            self._parser.error("--depth and --packages must not be negative")
+        return args
+
+    def __enter__(self):
+        with self._ctx as ctx:
+            self.args = self._parse_args()
+            register_backend()
+            if self.args.codec is not None:
+                try:
+                    codec.set_default(self.args.codec)
+                except ValueError as e:
+                    self._parser.error(str(e))
+
+            # Initialization succeeded. Save the exit-stack for later.
+            self._ctx = ctx.pop_all()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        with self._ctx:
+            pass
+
+    def run(self):
+        """Run all selected benchmarks and report the results"""
+
+        parameters = {
+            "codec": codec.default().name,
+            "depth": self.args.depth,
+            "jobs": self.args.jobs,
+            "manifests": self.args.manifests,
+            "packages": self.args.packages,
+            "platforms": self.args.platforms,
+            "repeat": self.args.repeat,
+            "seed": self.args.seed,
+        }
+
+        with contextlib.ExitStack() as ctx:
+            workdir = ctx.enter_context(tempfile.TemporaryDirectory(prefix="mdb-bench-"))
+            srcdir = self.args.corpus or os.path.join(workdir, "corpus")
+            stubs = generate_corpus(
+                srcdir,
+                manifests=self.args.manifests,
+                depth=self.args.depth,
+                packages=self.args.packages,
+                platforms=self.args.platforms,
+                seed=self.args.seed,
+            )
+
+            suite = BenchSuite(srcdir, stubs, workdir, self.args.repeat, self.args.jobs)
+            results = {}
+            for name in self.args.benchmark or BENCHMARKS:
+                print(f"Running {name}...", file=sys.stderr)
+                durations, items = BENCHMARKS[name](suite)
+                results[name] = _summary(durations, items)
+
+            report = {
+                "version": VERSION,
+                "time": time.time(),
+                "commit": _commit(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "parameters": parameters,
+                "corpus": {"stubs": len(stubs), "size": suite.corpus_size},
+                "footprint": suite.footprint(),
+                "unit": "s",
+                "results": results,
+            }
+
+        if self.args.output is None:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(self.args.output, "w", encoding="utf-8") as stream:
+                json.dump(report, stream, indent=2)
+                stream.write("\n")
+
+        return 0
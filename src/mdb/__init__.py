@@ -1,7 +1,8 @@
 """OSBuild Manifest Database"""
 
 
+from .db import ManifestDB
 from .mdb import Mdb
 
 
-__all__ = ["Mdb"]
+__all__ = ["ManifestDB", "Mdb"]
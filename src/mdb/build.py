@@ -0,0 +1,334 @@
+"""Manifest Database Build Scheduler
+
+Manifests of the database often share pipelines. In particular, build
+pipelines are mostly identical across all manifests of a distribution
+release. The scheduler identifies every pipeline of a manifest by the hash
+of its level in the Merkle tree of the manifest, see `merkle`, which covers
+its stages, its runner and the hash of its build pipeline. Hence, two
+pipelines have the same hash exactly if they would produce the same tree,
+and `mdb build` and `mdb diff` agree on which pipelines are the same.
+All pipelines of all selected manifests form a DAG, in which every unique
+pipeline appears once and depends on its build pipeline. Each unique
+pipeline is executed once, as soon as its build pipeline is done.
+
+Results are recorded by pipeline hash in the `builds` directory of the
+database, so pipelines that were built successfully before are not executed
+again. How a pipeline is executed is defined by an executor. Executors are
+registered in `EXECUTORS` and selected by name.
+"""
+
+# pylint: disable=too-few-public-methods
+
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from . import merkle
+
+
+def pipeline_hashes(manifest):
+    """Compute the hashes of all pipelines of a manifest
+
+    Return a list with the hash of every level of `manifest.levels`, in the
+    same order, as computed by `merkle.level_hashes()`.
+    """
+
+    return [level["hash"] for level in merkle.level_hashes(manifest)]
+
+
+def _merge(target, data):
+    # Merge the dictionary `data` into `target`. Nested dictionaries are
+    # merged recursively. Other values are only set if not present yet.
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.setdefault(key, {}), dict):
+            _merge(target[key], value)
+        else:
+            target.setdefault(key, value)
+
+
+class BuildPlan:
+    """Build Plan
+
+    The DAG of all unique pipelines of a set of manifests. Every node is a
+    dictionary with the `hash` of the pipeline, the hash of its `build`
+    pipeline (or `None`), the `runner` of its level, a standalone `manifest`
+    to execute the pipeline with, and the `tags` of all manifests using the
+    pipeline. The sources of the standalone manifest are merged from all
+    manifests using the pipeline.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.manifests = 0
+        self.pipelines = 0
+
+    def add(self, tag, manifest):
+        """Add all pipelines of a manifest to the plan"""
+
+        hashes = pipeline_hashes(manifest)
+        sources = manifest.data.get("sources", {})
+
+        self.manifests += 1
+        for i, level in enumerate(manifest.levels):
+            self.pipelines += 1
+            node = self.nodes.get(hashes[i])
+            if node is None:
+                node = {
+                    "hash": hashes[i],
+                    "build": hashes[i + 1] if i + 1 < len(hashes) else None,
+                    "runner": level.get("runner"),
+                    "manifest": {"pipeline": level.get("pipeline", {}), "sources": {}},
+                    "tags": [],
+                }
+                self.nodes[hashes[i]] = node
+            _merge(node["manifest"]["sources"], sources)
+            node["tags"].append(tag)
+
+
+class BuildExecutor:
+    """Pipeline Executor
+
+    An executor runs a single pipeline. This class defines the interface
+    every executor must implement. Executors are registered in `EXECUTORS`
+    and selected by name. Executors are called from multiple threads.
+
+    Parameters
+    ----------
+    path_output
+        Path to the directory to store the outputs of pipelines in.
+    path_store
+        Path to the object store of the executor, if it uses one.
+    """
+
+    def __init__(self, *, path_output, path_store=None):
+        self._path_output = path_output
+        self._path_store = path_store
+
+    def run(self, node):
+        """Run a pipeline
+
+        Execute the pipeline of the given plan node. Its build pipeline was
+        executed before. Returns a JSON-serializable dictionary with details
+        of the result. Raises an exception if the pipeline failed.
+        """
+
+        raise NotImplementedError()
+
+
+class OsbuildExecutor(BuildExecutor):
+    """Executor Using osbuild
+
+    Runs each pipeline with `osbuild(1)`. The output of a pipeline is stored
+    in a sub-directory of the output directory named after the pipeline
+    hash, and the log of osbuild next to it. All runs share the osbuild
+    store, so osbuild can reuse the build pipelines of previous runs.
+    """
+
+    def run(self, node):
+        path_output = os.path.join(self._path_output, node["hash"])
+        path_log = path_output + ".log"
+        os.makedirs(self._path_output, exist_ok=True)
+
+        cmd = ["osbuild", "--output-directory", path_output]
+        if self._path_store is not None:
+            cmd += ["--store", self._path_store]
+        cmd += ["-"]
+
+        with open(path_log, "wb") as log:
+            proc = subprocess.run(
+                cmd,
+                input=json.dumps(node["manifest"]).encode(),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                check=False,
+            )
+        if proc.returncode != 0:
+            raise RuntimeError(f"osbuild failed with exit code {proc.returncode}, see {path_log}")
+
+        return {"output": path_output, "log": path_log}
+
+
+class LocalExecutor(BuildExecutor):
+    """Local Stand-In Executor
+
+    Does not build anything, but writes the standalone manifest of each
+    pipeline into its output directory, optionally after a fixed delay to
+    simulate work. This allows testing and benchmarking the scheduler
+    without osbuild.
+
+    Parameters
+    ----------
+    delay
+        Time to spend on every pipeline, in seconds.
+    """
+
+    def __init__(self, *, delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self._delay = delay
+
+    def run(self, node):
+        path_output = os.path.join(self._path_output, node["hash"])
+        os.makedirs(path_output, exist_ok=True)
+
+        if self._delay > 0:
+            time.sleep(self._delay)
+
+        with open(os.path.join(path_output, "manifest.json"), "w", encoding="utf-8") as stream:
+            json.dump(node["manifest"], stream)
+
+        return {"output": path_output}
+
+
+# Registry of all available executors, by name.
+EXECUTORS = {
+    "local": LocalExecutor,
+    "osbuild": OsbuildExecutor,
+}
+
+
+class BuildScheduler:
+    """Build Scheduler
+
+    Executes the pipelines of a build plan with bounded parallelism. Every
+    pipeline is started as soon as its build pipeline succeeded. If a
+    pipeline fails, all pipelines depending on it are skipped. The result of
+    every executed pipeline is recorded as `<hash>.json` in the results
+    directory. Pipelines whose result cannot be recorded fail as well.
+    Pipelines with a recorded success are not executed again, unless
+    forced.
+
+    Parameters
+    ----------
+    executor
+        The executor to run pipelines with.
+    path_results
+        Path to the directory to record results in.
+    jobs
+        Maximum number of pipelines to execute in parallel.
+    force
+        Execute all pipelines, even if they were built before.
+    callback
+        Called with every node and its result once it is done.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, executor, path_results, jobs=1, force=False, callback=None):
+        self._executor = executor
+        self._path_results = path_results
+        self._jobs = jobs
+        self._force = force
+        self._callback = callback
+
+    def _load(self, node):
+        # Unreadable results are treated like missing ones, so the pipeline
+        # is executed again.
+        path = os.path.join(self._path_results, node["hash"] + ".json")
+        try:
+            with open(path, "r", encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _store(self, result):
+        os.makedirs(self._path_results, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=self._path_results,
+                prefix=".tmp-",
+                delete=False,
+        ) as stream:
+            try:
+                json.dump(result, stream, indent=2)
+                stream.flush()
+                os.replace(stream.name, os.path.join(self._path_results, result["hash"] + ".json"))
+            except OSError:
+                os.unlink(stream.name)
+                raise
+
+    def _execute(self, node):
+        start = time.monotonic()
+        result = {
+            "hash": node["hash"],
+            "build": node["build"],
+            "tags": node["tags"],
+            "executor": type(self._executor).__name__,
+        }
+        try:
+            result["details"] = self._executor.run(node)
+            result["status"] = "success"
+        except Exception as e:  # pylint: disable=broad-except
+            result["error"] = str(e)
+            result["status"] = "failure"
+        result["duration"] = time.monotonic() - start
+        result["time"] = time.time()
+        try:
+            self._store(result)
+        except OSError as e:
+            # Without a recorded result, the pipeline would be built again
+            # on the next run, so treat it as failed and skip its dependents,
+            # but keep executing the rest of the plan.
+            result["error"] = f"Cannot record result: {e}"
+            result["status"] = "failure"
+        return result
+
+    def _done(self, results, node, result):
+        results[node["hash"]] = result
+        if self._callback is not None:
+            self._callback(node, result)
+
+    def run(self, plan):
+        """Execute a build plan
+
+        Return a dictionary mapping the hash of every pipeline of the plan
+        to its result. The status of a result is one of `success`,
+        `failure`, `cached` or `skipped`.
+        """
+
+        results = {}
+        dependents = {}
+        for node in plan.nodes.values():
+            if node["build"] is not None:
+                dependents.setdefault(node["build"], []).append(node)
+
+        def ready(node):
+            build = node["build"]
+            return build is None or results.get(build, {}).get("status") in ("success", "cached")
+
+        # Nodes are executed as soon as their build pipeline is done. All
+        # nodes depending on a node that did not succeed are skipped.
+        queue = [node for node in plan.nodes.values() if node["build"] is None]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            running = {}
+            while queue or running:
+                while queue:
+                    node = queue.pop(0)
+                    if not ready(node):
+                        self._done(results, node, {"hash": node["hash"], "status": "skipped"})
+                        queue += dependents.get(node["hash"], [])
+                        continue
+                    record = None if self._force else self._load(node)
+                    if record is not None and record.get("status") == "success":
+                        record["status"] = "cached"
+                        self._done(results, node, record)
+                        queue += dependents.get(node["hash"], [])
+                        continue
+                    running[pool.submit(self._execute, node)] = node
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    node = running.pop(future)
+                    self._done(results, node, future.result())
+                    queue += dependents.get(node["hash"], [])
+
+        return results
@@ -0,0 +1,292 @@
+"""Manifest Database Reader
+
+This module provides read access to a manifest database for other programs.
+Manifests are addressed either by tag, which is their path in `by-tag`, or
+by their checksum. Objects are read through the object store, so packed and
+compressed objects are supported transparently.
+"""
+
+
+import collections
+import contextlib
+import errno
+import os
+import threading
+
+import mpp
+import mpp.compact
+
+from . import store
+
+
+class ManifestEntry:
+    """Manifest Database Entry
+
+    An entry of a manifest database, as returned when iterating it. The
+    manifest of the entry is only read and parsed when it is accessed.
+    """
+
+    def __init__(self, db, tag, checksum):
+        self._db = db
+        self.tag = tag
+        self.checksum = checksum
+
+    def __repr__(self):
+        return f"ManifestEntry({self.tag!r}, {self.checksum!r})"
+
+    @property
+    def manifest(self):
+        """The parsed manifest of the entry"""
+        return self._db.get(self.checksum)
+
+    def raw(self):
+        """The serialized manifest of the entry, see `ManifestDB.raw()`"""
+        return self._db.raw(self.checksum)
+
+
+# pylint: disable=too-many-instance-attributes
+class ManifestDB:
+    """Manifest Database
+
+    Open a manifest database for reading. Manifests are parsed on first
+    access and kept in a cache of parsed manifests, bounded by the total
+    size of their serialized form. The least recently used manifests are
+    dropped first. Objects are content-addressed and never change, so cached
+    manifests never need to be invalidated. Every access returns a new
+    `mpp.Manifest` with its own copy of all containers, so callers can modify
+    it freely.
+
+    In compact mode, cached manifests are kept in the compact representation
+    of `mpp.compact`, in which all equal strings and lists of strings are
+    shared among all cached manifests. This reduces the memory needed to keep
+    many manifests cached by a multiple, but makes every access somewhat more
+    expensive. Shared values are kept for the lifetime of the database.
+
+    The database can be used from multiple threads.
+
+    Parameters
+    ----------
+    path
+        Path to the database directory.
+    cache_size
+        Maximum total size of all cached manifests, in bytes of their
+        serialized form.
+    compact
+        Keep cached manifests in their compact representation.
+    """
+
+    DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE, compact=False):
+        self._path = path
+        self._path_tags = os.path.join(path, "by-tag")
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_used = 0
+        self._lock = threading.Lock()
+        self._objects = store.ObjectStore(path)
+        self._compactor = mpp.compact.Compactor() if compact else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __contains__(self, ref):
+        try:
+            checksum = self.resolve(ref)
+        except KeyError:
+            return False
+        with self._lock:
+            return checksum in self._cache or self._objects.contains(checksum)
+
+    def __iter__(self):
+        return iter(self.entries())
+
+    def close(self):
+        """Drop all cached manifests and release the database"""
+
+        with self._lock:
+            self._cache.clear()
+            self._cache_used = 0
+            self._objects.close()
+
+    def resolve(self, ref):
+        """Resolve a tag or checksum to a checksum
+
+        Checksums are returned as they are, without checking whether the
+        object exists. Tags are resolved via their link in `by-tag`. Raises
+        `KeyError` if a tag does not exist.
+        """
+
+        if store.checksum_digest(ref) is not None:
+            return ref
+
+        path = os.path.normpath(os.path.join(self._path_tags, ref))
+        if not path.startswith(self._path_tags + os.sep):
+            raise KeyError(ref)
+        try:
+            return os.path.basename(os.readlink(path))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.EINVAL, errno.ENOTDIR):
+                raise KeyError(ref) from None
+            raise
+
+    def tags(self):
+        """Return a sorted list of all tags"""
+
+        tags = []
+        for level, subdirs, files in os.walk(self._path_tags):
+            subdirs.sort()
+            rel = os.path.relpath(level, self._path_tags)
+            for entry in files:
+                if not entry.startswith("."):
+                    tags.append(os.path.normpath(os.path.join(rel, entry)))
+        return sorted(tags)
+
+    def entries(self):
+        """Return a list of all tagged entries, sorted by tag"""
+
+        entries = []
+        for tag in self.tags():
+            try:
+                entries.append(ManifestEntry(self, tag, self.resolve(tag)))
+            except KeyError:
+                continue
+        return entries
+
+    def checksums(self):
+        """Iterate the checksums of all objects, tagged or not"""
+
+        with self._lock:
+            packed = [
+                store.CHECKSUM_PREFIX + digest.hex()
+                for pack in self._objects.packs
+                for digest, _offset, _length in pack.entries()
+            ]
+        seen = set(packed)
+        yield from packed
+        for checksum in self._objects.loose():
+            if checksum not in seen:
+                yield checksum
+
+    def raw(self, ref):
+        """Return the serialized manifest of a tag or checksum
+
+        The result is a read-only buffer. If the object is stored
+        uncompressed, it is a view of the memory-mapped file, so callers
+        that just forward the JSON do not copy it. Raises `KeyError` if the
+        manifest does not exist.
+        """
+
+        checksum = self.resolve(ref)
+        try:
+            with self._lock:
+                return self._objects.view(checksum)
+        except FileNotFoundError:
+            raise KeyError(ref) from None
+
+    def read_keys(self, ref, keys):
+        """Return selected top-level members of a manifest
+
+        Return a dictionary with all of the given top-level keys present in
+        the manifest of a tag or checksum. Only these members are decoded, so
+        this is much cheaper than `get()` if only small parts of a manifest
+        are needed. Raises `KeyError` if the manifest does not exist.
+        """
+
+        return mpp.codec.JsonScanner(self.raw(ref)).read_keys(keys)
+
+    def stage_names(self, ref):
+        """Return the stage names of every pipeline level of a manifest
+
+        See `mpp.codec.JsonScanner.stage_names()`. Raises `KeyError` if the
+        manifest does not exist.
+        """
+
+        return mpp.codec.JsonScanner(self.raw(ref)).stage_names()
+
+    def _cache_insert(self, checksum, data, size):
+        # Insert a parsed manifest and evict the least recently used ones,
+        # until the cache fits its size limit again. A manifest larger than
+        # the whole cache is not cached at all.
+        if size > self._cache_size:
+            return
+        self._cache[checksum] = (data, size)
+        self._cache_used += size
+        while self._cache_used > self._cache_size:
+            _checksum, (_data, evicted) = self._cache.popitem(last=False)
+            self._cache_used -= evicted
+
+    def _copy(self, data):
+        if self._compactor is not None:
+            return mpp.compact.expand(data)
+        return mpp.mpp.json_copy(data)
+
+    def _load(self, checksum):
+        with self._lock:
+            entry = self._cache.get(checksum)
+            if entry is not None:
+                self._cache.move_to_end(checksum)
+                return entry[0]
+
+            content = self._objects.read(checksum)
+
+        data = mpp.codec.default().loads(content)
+
+        with self._lock:
+            if self._compactor is not None:
+                data = self._compactor.compact(data)
+            if checksum not in self._cache:
+                self._cache_insert(checksum, data, len(content))
+        return data
+
+    def get(self, ref):
+        """Return the manifest of a tag or checksum
+
+        Raises `KeyError` if the manifest does not exist.
+        """
+
+        checksum = self.resolve(ref)
+        try:
+            data = self._load(checksum)
+        except FileNotFoundError:
+            raise KeyError(ref) from None
+        return mpp.Manifest(self._copy(data))
+
+    def get_many(self, refs):
+        """Return the manifests of multiple tags or checksums
+
+        Return a dictionary mapping each of the given tags and checksums to
+        its manifest. Tags and checksums that do not exist are omitted.
+        Objects that are not cached are read in the order they are stored,
+        so reading many objects from packs is mostly sequential I/O.
+        """
+
+        checksums = {}
+        for ref in refs:
+            with contextlib.suppress(KeyError):
+                checksums[ref] = self.resolve(ref)
+
+        def order(checksum):
+            location = self._objects.locate(checksum)
+            return location[:2] if location is not None else ("", 0)
+
+        with self._lock:
+            pending = sorted(
+                {c for c in checksums.values() if c not in self._cache},
+                key=order,
+            )
+        for checksum in pending:
+            with contextlib.suppress(FileNotFoundError):
+                self._load(checksum)
+
+        manifests = {}
+        for ref, checksum in checksums.items():
+            try:
+                data = self._load(checksum)
+            except FileNotFoundError:
+                continue
+            manifests[ref] = mpp.Manifest(self._copy(data))
+        return manifests
@@ -0,0 +1,387 @@
+"""Database Consistency Checks
+
+`Fsck` verifies a database. It never modifies objects or tags, the only
+file it writes is its cache, `state/fsck.json`. It performs these checks:
+
+ * Every object, loose or packed, is hashed and compared with its checksum.
+   Loose objects are memory-mapped and hashed in place, packed objects are
+   hashed in batches of their pack. Objects are hashed by a pool of threads,
+   since hashing and decompressing release the GIL.
+
+ * Every tag in `by-tag` must be a symlink to an object in `by-checksum`, in
+   the form `mdb` links them. Tags that point elsewhere are misdirected,
+   tags whose object does not exist are dangling.
+
+ * Temporary files are only left behind by interrupted commands. Temporary
+   files older than a grace period are reported as orphaned, since younger
+   ones might belong to commands still running.
+
+The cache records objects that passed by the inode, size and modification
+time of their files. Hence, repeated checks only hash new and modified
+files.
+"""
+
+# pylint: disable=too-few-public-methods
+
+
+import concurrent.futures
+import json
+import mmap
+import os
+import stat
+import tempfile
+import time
+
+from . import store
+
+
+VERSION = 1
+
+# Classes of problems. Each has its own bit in the exit code of `mdb fsck`,
+# so the exit code tells which classes were found.
+CORRUPT = 1
+DANGLING = 2
+MISDIRECTED = 4
+ORPHANED = 8
+
+# Exit code of `mdb fsck` if the check could not be run at all.
+FAILED = 16
+
+KINDS = {
+    CORRUPT: "corrupt",
+    DANGLING: "dangling",
+    MISDIRECTED: "misdirected",
+    ORPHANED: "orphaned",
+}
+
+# Prefixes of temporary files, as created by `mdb` and the object store.
+TMPFILE_PREFIXES = (".mdb-tmp-", ".tmp-")
+
+# Amount of packed content hashed by a single job, in bytes.
+BATCH_SIZE = 64 * 1024 * 1024
+
+
+def _stat_key(info):
+    return [info.st_ino, info.st_size, info.st_mtime_ns]
+
+
+def _scandir(dirpath):
+    # Iterate the entries of a directory, or nothing if it does not exist.
+    try:
+        it = os.scandir(dirpath)
+    except FileNotFoundError:
+        return
+    with it:
+        yield from it
+
+
+def _lstat(dirent):
+    # Return the status of a directory entry, or `None` if it was deleted
+    # since it was listed.
+    try:
+        return dirent.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+
+
+class FsckCache:
+    """Cache of Verified Files
+
+    Maps paths relative to the database to the `[inode, size, mtime]` of
+    all files they consist of, as of their last successful check. Only
+    entries added or confirmed since the cache was loaded are saved, so
+    entries of deleted files are dropped.
+
+    Parameters
+    ----------
+    path
+        Path to the cache file.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._valid = {}
+
+    def load(self):
+        """Load the cache, or start empty if there is none"""
+
+        try:
+            with open(self._path, "r", encoding="utf-8") as stream:
+                data = json.load(stream)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if data.get("version") == VERSION:
+            self._entries = data.get("entries", {})
+
+    def lookup(self, name, *infos):
+        """Check whether a file is unchanged since its last check"""
+
+        key = [_stat_key(info) for info in infos]
+        if self._entries.get(name) != key:
+            return False
+        self._valid[name] = key
+        return True
+
+    def add(self, name, *infos):
+        """Record a successful check of a file"""
+
+        self._valid[name] = [_stat_key(info) for info in infos]
+
+    def save(self):
+        """Write the cache"""
+
+        dirpath = os.path.dirname(self._path)
+        os.makedirs(dirpath, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=dirpath,
+                prefix=".tmp-",
+                delete=False,
+        ) as stream:
+            json.dump({"version": VERSION, "entries": self._valid}, stream)
+        os.replace(stream.name, self._path)
+
+
+# pylint: disable=too-many-instance-attributes
+class Fsck:
+    """Database Checker
+
+    Parameters
+    ----------
+    dstdir
+        Path to the database directory.
+    jobs
+        Number of objects hashed in parallel.
+    cache
+        Use and update the cache of verified files.
+    temp_age
+        Minimum age of orphaned temporary files, in seconds.
+    """
+
+    def __init__(self, dstdir, jobs=1, cache=True, temp_age=3600):
+        self._dstdir = dstdir
+        self._path_loose = os.path.join(dstdir, "by-checksum")
+        self._path_tags = os.path.join(dstdir, "by-tag")
+        self._path_packs = os.path.join(dstdir, "packs")
+        self._jobs = jobs
+        self._cache = FsckCache(os.path.join(dstdir, "state", "fsck.json")) if cache else None
+        self._deadline = time.time() - temp_age
+        self._problems = []
+        self._known = set()
+        self.stats = {"objects": 0, "cached": 0, "packs": 0, "tags": 0}
+
+    def _report(self, kind, path, message):
+        self._problems.append((kind, os.path.relpath(path, self._dstdir), message))
+
+    def _cached(self, name, *infos):
+        return self._cache is not None and self._cache.lookup(name, *infos)
+
+    def _temporary(self, path, info):
+        # Report orphaned temporary files. Returns whether `path` is a
+        # temporary file at all.
+        if not os.path.basename(path).startswith(TMPFILE_PREFIXES):
+            return False
+        if info.st_mtime < self._deadline:
+            self._report(ORPHANED, path, "temporary file left behind")
+        return True
+
+    def _scan_temporary(self, dirpath, recursive=False):
+        for dirent in _scandir(dirpath):
+            info = _lstat(dirent)
+            if info is None or self._temporary(dirent.path, info):
+                continue
+            if recursive and stat.S_ISDIR(info.st_mode):
+                self._scan_temporary(dirent.path, recursive=True)
+
+    @staticmethod
+    def _hash_loose(objects, path):
+        # Hash a loose object in place. Returns whether it matches its
+        # checksum, and the status of the file that was hashed.
+        digest = store.checksum_digest(os.path.basename(path))
+        with open(path, "rb") as stream:
+            info = os.fstat(stream.fileno())
+            if info.st_size == 0:
+                return objects.verify(digest, b""), info
+            with mmap.mmap(stream.fileno(), 0, prot=mmap.PROT_READ) as mapping:
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+                return objects.verify(digest, mapping), info
+
+    @staticmethod
+    def _hash_packed(objects, pack, entries):
+        # Hash a batch of objects of a pack. Returns the digests of all
+        # objects that do not match.
+        return [
+            digest for digest, offset, length in entries
+            if not objects.verify(digest, pack.view(offset, length))
+        ]
+
+    def _submit_loose(self, pool, objects):
+        jobs = {}
+        for dirent in _scandir(self._path_loose):
+            info = _lstat(dirent)
+            if info is None or self._temporary(dirent.path, info):
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                self._report(MISDIRECTED, dirent.path, "not a regular file")
+                continue
+            if store.checksum_digest(dirent.name) is None:
+                self._report(MISDIRECTED, dirent.path, "not named by a checksum")
+                continue
+
+            self._known.add(dirent.name)
+            self.stats["objects"] += 1
+            if self._cached("by-checksum/" + dirent.name, info):
+                self.stats["cached"] += 1
+                continue
+            jobs[pool.submit(self._hash_loose, objects, dirent.path)] = dirent.path
+        return jobs
+
+    def _open_packs(self):
+        # Open all packs, like `ObjectStore.packs`, but report packs with
+        # an invalid index instead of failing.
+        packs = []
+        for dirent in sorted(_scandir(self._path_packs), key=lambda d: d.name):
+            info = _lstat(dirent)
+            if info is None or self._temporary(dirent.path, info):
+                continue
+            if not dirent.name.startswith("pack-") or not dirent.name.endswith(".idx"):
+                continue
+            try:
+                packs.append(store.Pack(dirent.path[:-4]))
+            except ValueError:
+                self._report(CORRUPT, dirent.path, "invalid pack index")
+            except FileNotFoundError:
+                self._report(CORRUPT, dirent.path, "pack index without pack")
+        return packs
+
+    def _submit_packs(self, pool, objects, packs):
+        jobs = {}
+        for pack in packs:
+            name = os.path.relpath(pack.path, self._dstdir)
+            try:
+                pack_info = os.stat(pack.path + ".pack")
+                idx_info = os.stat(pack.path + ".idx")
+            except FileNotFoundError:
+                # Deleted since it was opened, which is fine.
+                continue
+            entries = pack.entries()
+            self._known.update(store.CHECKSUM_PREFIX + e[0].hex() for e in entries)
+            self.stats["objects"] += len(entries)
+            self.stats["packs"] += 1
+            if self._cached(name, pack_info, idx_info):
+                self.stats["cached"] += len(entries)
+                continue
+
+            # Split the pack into batches of similar size, so large packs
+            # are hashed in parallel, too.
+            batches = [[]]
+            size = 0
+            for entry in entries:
+                if size >= BATCH_SIZE:
+                    batches.append([])
+                    size = 0
+                batches[-1].append(entry)
+                size += entry[2]
+            for batch in batches:
+                job = pool.submit(self._hash_packed, objects, pack, batch)
+                jobs[job] = (name, pack_info, idx_info)
+        return jobs
+
+    def _check_objects(self, objects, packs):
+        # Check all loose objects and all packs.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            loose = self._submit_loose(pool, objects)
+            packed = self._submit_packs(pool, objects, packs)
+
+            failed = set()
+            for job in concurrent.futures.as_completed(loose):
+                try:
+                    valid, info = job.result()
+                except FileNotFoundError:
+                    # Deleted concurrently, which is fine.
+                    continue
+                if valid:
+                    if self._cache is not None:
+                        self._cache.add("by-checksum/" + os.path.basename(loose[job]), info)
+                else:
+                    self._report(CORRUPT, loose[job], "content does not match checksum")
+
+            for job in concurrent.futures.as_completed(packed):
+                name = packed[job][0]
+                for digest in job.result():
+                    failed.add(name)
+                    self._report(
+                        CORRUPT,
+                        os.path.join(self._dstdir, name + ".pack"),
+                        f"content of {store.CHECKSUM_PREFIX}{digest.hex()} does not match checksum",
+                    )
+
+            if self._cache is not None:
+                for name, pack_info, idx_info in set(packed.values()):
+                    if name not in failed:
+                        self._cache.add(name, pack_info, idx_info)
+
+    def _check_tag(self, path, info):
+        if not stat.S_ISLNK(info.st_mode):
+            self._report(MISDIRECTED, path, "not a symlink")
+            return
+
+        # Tags must point to `by-checksum` via a relative path, so the
+        # database can be moved. The object must exist, but need not be
+        # loose, since it might be packed. Objects added since they were
+        # listed are loose.
+        try:
+            target = os.readlink(path)
+        except FileNotFoundError:
+            return
+        checksum = os.path.basename(target)
+        expected = os.path.relpath(
+            os.path.join(self._path_loose, checksum),
+            os.path.dirname(path),
+        )
+        if target != expected or store.checksum_digest(checksum) is None:
+            self._report(MISDIRECTED, path, f"points to {target}")
+        elif checksum not in self._known and not os.path.exists(
+                os.path.join(self._path_loose, checksum)):
+            self._report(DANGLING, path, f"points to missing object {checksum}")
+
+    def _check_tags(self, dirpath):
+        for dirent in _scandir(dirpath):
+            info = _lstat(dirent)
+            if info is None or self._temporary(dirent.path, info):
+                continue
+            if stat.S_ISDIR(info.st_mode):
+                self._check_tags(dirent.path)
+            elif not dirent.name.startswith("."):
+                self.stats["tags"] += 1
+                self._check_tag(dirent.path, info)
+
+    def run(self):
+        """Check the database
+
+        Return a sorted list of `(kind, path, message)` tuples, one for
+        every problem found, where `kind` is one of the problem classes and
+        `path` is relative to the database.
+        """
+
+        if self._cache is not None:
+            self._cache.load()
+
+        packs = self._open_packs()
+        try:
+            with store.ObjectStore(self._dstdir) as objects:
+                self._check_objects(objects, packs)
+        finally:
+            for pack in packs:
+                pack.close()
+        self._check_tags(self._path_tags)
+
+        self._scan_temporary(os.path.join(self._dstdir, "state"), recursive=True)
+        self._scan_temporary(os.path.join(self._dstdir, "builds"))
+
+        if self._cache is not None:
+            self._cache.save()
+
+        return sorted(self._problems)
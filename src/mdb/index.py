@@ -0,0 +1,425 @@
+"""Manifest Database Index
+
+The index is a single SQLite database stored alongside the manifest database.
+It maps tags to objects, and records facts about every indexed object, like
+the stages and runners it uses, the platforms it was resolved for and the
+packages it installs. This allows answering queries without reading any
+manifest.
+
+The index also serves as reverse index from package checksums, source URLs
+and gpg key fingerprints to the objects referencing them.
+"""
+
+
+import base64
+import hashlib
+import os
+import sqlite3
+import urllib.parse
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    checksum TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY,
+    checksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_checksum ON tags (checksum);
+CREATE TABLE IF NOT EXISTS stages (
+    checksum TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (name, checksum)
+);
+CREATE TABLE IF NOT EXISTS runners (
+    checksum TEXT NOT NULL,
+    runner TEXT NOT NULL,
+    UNIQUE (runner, checksum)
+);
+CREATE TABLE IF NOT EXISTS platforms (
+    checksum TEXT NOT NULL,
+    fedora TEXT NOT NULL,
+    architecture TEXT NOT NULL,
+    UNIQUE (fedora, architecture, checksum)
+);
+CREATE TABLE IF NOT EXISTS packages (
+    checksum TEXT NOT NULL,
+    package TEXT NOT NULL,
+    UNIQUE (package, checksum)
+);
+CREATE TABLE IF NOT EXISTS urls (
+    checksum TEXT NOT NULL,
+    package TEXT NOT NULL,
+    url TEXT NOT NULL,
+    host TEXT NOT NULL,
+    UNIQUE (url, checksum)
+);
+CREATE INDEX IF NOT EXISTS urls_host ON urls (host);
+CREATE TABLE IF NOT EXISTS gpgkeys (
+    checksum TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    keyid TEXT NOT NULL,
+    UNIQUE (fingerprint, checksum)
+);
+CREATE INDEX IF NOT EXISTS gpgkeys_keyid ON gpgkeys (keyid);
+"""
+
+# All tables of the index, used to drop an index of an older version.
+TABLES = ["objects", "tags", "stages", "runners", "platforms", "packages", "urls", "gpgkeys"]
+
+# Upper bound of all strings starting with a given prefix, as compared by
+# SQLite. Used to turn prefix matches into range scans on an index.
+PREFIX_END = chr(0x10ffff)
+
+
+def _pgp_packets(data):
+    """Iterate the `(tag, body)` tuples of all OpenPGP packets in `data`"""
+
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if not header & 0x80:
+            raise ValueError("Invalid OpenPGP packet header")
+
+        if header & 0x40:
+            # New packet format. Partial body lengths are only allowed for
+            # data packets, which never occur in keys, so they are rejected.
+            tag = header & 0x3f
+            length = data[pos]
+            if length < 192:
+                pos += 1
+            elif length < 224:
+                length = ((length - 192) << 8) + data[pos + 1] + 192
+                pos += 2
+            elif length == 255:
+                length = int.from_bytes(data[pos + 1:pos + 5], "big")
+                pos += 5
+            else:
+                raise ValueError("Unsupported OpenPGP packet length")
+        else:
+            # Old packet format.
+            tag = (header >> 2) & 0x0f
+            size = {0: 1, 1: 2, 2: 4}.get(header & 0x03)
+            if size is None:
+                raise ValueError("Unsupported OpenPGP packet length")
+            length = int.from_bytes(data[pos:pos + size], "big")
+            pos += size
+
+        yield tag, data[pos:pos + length]
+        pos += length
+
+
+def gpgkey_fingerprints(armored):
+    """Compute the fingerprints of an ASCII-armored gpg key
+
+    Return the upper-case hex fingerprints of all primary keys in all
+    armored key blocks of the given string. Only version 4 keys, as used by
+    all current distributions, are supported. Blocks that cannot be parsed
+    are skipped.
+    """
+
+    fingerprints = []
+
+    for block in armored.split("-----BEGIN PGP PUBLIC KEY BLOCK-----")[1:]:
+        block = block.split("-----END PGP PUBLIC KEY BLOCK-----")[0]
+
+        # The armor headers are separated from the data by an empty line.
+        # The data is followed by a CRC24 checksum line starting with `=`.
+        lines = block.strip().splitlines()
+        if "" in lines:
+            lines = lines[lines.index("") + 1:]
+        lines = [line.strip() for line in lines if not line.startswith("=")]
+
+        try:
+            data = base64.b64decode("".join(lines), validate=True)
+            for tag, body in _pgp_packets(data):
+                if tag == 6 and body[:1] == b"\x04":
+                    digest = hashlib.sha1(
+                        b"\x99" + len(body).to_bytes(2, "big") + body
+                    ).hexdigest()
+                    fingerprints.append(digest.upper())
+        except (ValueError, IndexError):
+            continue
+
+    return fingerprints
+
+
+def _gpgkey_condition(gpgkey):
+    # Build the condition on the `gpgkeys` table to look up a key by its
+    # fingerprint or a suffix of it. Fingerprints and long key IDs are looked
+    # up exactly. Shorter IDs are matched against the end of the long key
+    # IDs, and longer ones against the end of the fingerprints. Keys are
+    # hexadecimal, so they never contain `LIKE` wildcards.
+    gpgkey = "".join(gpgkey.split()).upper()
+    if gpgkey.startswith("0X"):
+        gpgkey = gpgkey[2:]
+    if not gpgkey or len(gpgkey) > 40 or gpgkey.strip("0123456789ABCDEF"):
+        raise ValueError(f"Invalid gpg key fingerprint or ID: {gpgkey}")
+
+    if len(gpgkey) == 40:
+        return "fingerprint = ?", gpgkey
+    if len(gpgkey) == 16:
+        return "keyid = ?", gpgkey
+    if len(gpgkey) < 16:
+        return "keyid LIKE ?", "%" + gpgkey
+    return "fingerprint LIKE ?", "%" + gpgkey
+
+
+def manifest_facts(manifest, platforms=()):
+    """Extract the indexed facts of a manifest
+
+    Collect the stage names, runners and packages of all pipelines of a
+    manifest. The platforms a manifest was resolved for are not part of the
+    manifest itself, so they must be passed in by the caller as a list of
+    `(fedora, architecture)` tuples.
+    """
+
+    stages = {}
+    runners = {}
+    packages = {}
+    urls = {}
+    gpgkeys = {}
+
+    for level in manifest.levels:
+        if "runner" in level:
+            runners[level["runner"]] = None
+        for stage in level.get("pipeline", {}).get("stages", []):
+            stages[stage.get("name")] = None
+            options = stage.get("options", {})
+            for package in options.get("packages", []):
+                if isinstance(package, dict):
+                    package = package.get("id")
+                packages[package] = None
+            for key in options.get("gpgkeys", []):
+                gpgkeys.update(dict.fromkeys(gpgkey_fingerprints(key)))
+
+    for package, url in manifest.links.get("urls", {}).items():
+        if isinstance(url, dict):
+            url = url.get("url")
+        if isinstance(url, str):
+            urls[(package, url)] = None
+
+    return {
+        "stages": list(stages),
+        "runners": list(runners),
+        "platforms": [list(p) for p in dict.fromkeys(tuple(p) for p in platforms)],
+        "packages": list(packages),
+        "urls": [list(u) for u in urls],
+        "gpgkeys": list(gpgkeys),
+    }
+
+
+class MdbIndex:
+    """Manifest Database Index
+
+    Parameters
+    ----------
+    path
+        Path to the index file. It is created if it does not exist.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, timeout=60)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            # Objects indexed by older versions lack facts, so the index is
+            # rebuilt from scratch. Preprocess re-indexes all objects it
+            # links.
+            for table in TABLES:
+                self._db.execute(f"DROP TABLE IF EXISTS {table}")
+            self._db.executescript(SCHEMA)
+            self._db.execute(f"PRAGMA user_version = {self.VERSION}")
+            self._db.commit()
+
+    def close(self):
+        """Commit all pending changes and close the index"""
+
+        self._db.commit()
+        self._db.close()
+
+    def commit(self):
+        """Commit all pending changes"""
+
+        self._db.commit()
+
+    def has_object(self, checksum):
+        """Check whether an object is indexed"""
+
+        cur = self._db.execute("SELECT 1 FROM objects WHERE checksum = ?", (checksum,))
+        return cur.fetchone() is not None
+
+    def add_object(self, checksum, facts):
+        """Index an object with the given facts
+
+        The facts are the ones returned by `manifest_facts()`. Objects are
+        immutable, so an object that is indexed already is left untouched.
+        """
+
+        if self.has_object(checksum):
+            return
+
+        db = self._db
+        db.execute("INSERT INTO objects (checksum) VALUES (?)", (checksum,))
+        db.executemany(
+            "INSERT OR IGNORE INTO stages (checksum, name) VALUES (?, ?)",
+            ((checksum, name) for name in facts["stages"]),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO runners (checksum, runner) VALUES (?, ?)",
+            ((checksum, runner) for runner in facts["runners"]),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO platforms (checksum, fedora, architecture) VALUES (?, ?, ?)",
+            ((checksum, str(f), str(a)) for f, a in facts["platforms"]),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO packages (checksum, package) VALUES (?, ?)",
+            ((checksum, package) for package in facts["packages"]),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO urls (checksum, package, url, host) VALUES (?, ?, ?, ?)",
+            (
+                (checksum, package, url, urllib.parse.urlsplit(url).hostname or "")
+                for package, url in facts["urls"]
+            ),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO gpgkeys (checksum, fingerprint, keyid) VALUES (?, ?, ?)",
+            ((checksum, fingerprint, fingerprint[-16:]) for fingerprint in facts["gpgkeys"]),
+        )
+
+    def remove_object(self, checksum):
+        """Drop an object and all tags pointing at it from the index"""
+
+        for table in TABLES:
+            self._db.execute(f"DELETE FROM {table} WHERE checksum = ?", (checksum,))
+
+    def set_tag(self, tag, checksum):
+        """Point a tag at an object"""
+
+        cur = self._db.execute("SELECT checksum FROM tags WHERE tag = ?", (tag,))
+        row = cur.fetchone()
+        if row is None or row[0] != checksum:
+            self._db.execute(
+                "INSERT OR REPLACE INTO tags (tag, checksum) VALUES (?, ?)",
+                (tag, checksum),
+            )
+
+    def prune_tags(self, tags):
+        """Drop all tags that no longer exist
+
+        `tags` maps every existing tag to the checksum of its object. All
+        indexed tags that are missing from it, or point at another object,
+        are dropped. Returns the number of dropped tags.
+        """
+
+        stale = [
+            (tag, checksum)
+            for tag, checksum in self._db.execute("SELECT tag, checksum FROM tags")
+            if tags.get(tag) != checksum
+        ]
+        self._db.executemany("DELETE FROM tags WHERE tag = ? AND checksum = ?", stale)
+        return len(stale)
+
+    # pylint: disable=too-many-arguments
+    def query(
+            self,
+            *,
+            tag=None,
+            stage=None,
+            runner=None,
+            fedora=None,
+            architecture=None,
+            package=None,
+    ):
+        """Query tagged objects
+
+        Return a sorted list of `(tag, checksum)` tuples of all tags whose
+        object matches all given criteria. `tag` is a glob pattern matched
+        against the tag. All other criteria must match exactly. `package` is
+        the checksum of a package, as listed by `org.osbuild.rpm` stages.
+        """
+
+        conditions = []
+        params = []
+
+        if tag is not None:
+            conditions.append("tags.tag GLOB ?")
+            params.append(tag)
+        if stage is not None:
+            conditions.append("tags.checksum IN (SELECT checksum FROM stages WHERE name = ?)")
+            params.append(stage)
+        if runner is not None:
+            conditions.append("tags.checksum IN (SELECT checksum FROM runners WHERE runner = ?)")
+            params.append(runner)
+        if fedora is not None or architecture is not None:
+            conditions.append(
+                "tags.checksum IN (SELECT checksum FROM platforms"
+                " WHERE (? IS NULL OR fedora = ?) AND (? IS NULL OR architecture = ?))"
+            )
+            params += [fedora, fedora, architecture, architecture]
+        if package is not None:
+            conditions.append("tags.checksum IN (SELECT checksum FROM packages WHERE package = ?)")
+            params.append(package)
+
+        sql = "SELECT tag, checksum FROM tags"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY tag"
+
+        return self._db.execute(sql, params).fetchall()
+
+    def lookup(self, *, package=None, url=None, host=None, gpgkey=None):
+        """Look up objects referencing packages, URLs or gpg keys
+
+        Return a sorted list of `(checksum, tags)` tuples of all objects that
+        match all given criteria, where `tags` is the sorted list of tags
+        pointing at the object. `package` is a package checksum, `url` is a
+        prefix of a source URL, `host` is the host of a source URL and
+        `gpgkey` is a key fingerprint, or a suffix of it like a key ID.
+        Raises `ValueError` if `gpgkey` is not hexadecimal.
+        """
+
+        conditions = []
+        params = []
+
+        if package is not None:
+            conditions.append(
+                "objects.checksum IN (SELECT checksum FROM packages WHERE package = ?)"
+            )
+            params.append(package)
+        if url is not None:
+            conditions.append(
+                "objects.checksum IN (SELECT checksum FROM urls WHERE url >= ? AND url < ?)"
+            )
+            params += [url, url + PREFIX_END]
+        if host is not None:
+            conditions.append("objects.checksum IN (SELECT checksum FROM urls WHERE host = ?)")
+            params.append(host.lower())
+        if gpgkey is not None:
+            condition, param = _gpgkey_condition(gpgkey)
+            conditions.append(
+                f"objects.checksum IN (SELECT checksum FROM gpgkeys WHERE {condition})"
+            )
+            params.append(param)
+
+        sql = (
+            "SELECT objects.checksum, tags.tag FROM objects"
+            " LEFT JOIN tags ON tags.checksum = objects.checksum"
+        )
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY objects.checksum, tags.tag"
+
+        results = {}
+        for checksum, tag in self._db.execute(sql, params):
+            tags = results.setdefault(checksum, [])
+            if tag is not None:
+                tags.append(tag)
+
+        return list(results.items())
@@ -6,17 +6,39 @@ This tool provides access to the OSBuild Manifest DB, performs maintenance
 tasks on the database, and provides external access to the manifests.
 """
 
-# pylint: disable=invalid-name,too-few-public-methods
+# pylint: disable=invalid-name,too-few-public-methods,too-many-lines
 
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
 import errno
+import fcntl
 import hashlib
+import json
 import os
 import stat
 import subprocess
 import sys
+import tempfile
+import time
+
+import mpp
+
+from . import build
+from . import fsck
+from . import index
+from . import merkle
+from . import serve
+from . import store
+from .db import ManifestDB
+
+
+# Prefix of temporary directory entries created by the database. Entries with
+# this prefix are never valid database entries.
+TMPFILE_PREFIX = ".mdb-tmp-"
 
 
 @contextlib.contextmanager
@@ -45,7 +67,13 @@ def suppress_oserror(*errnos):
 def open_tmpfile(dirpath, mode=0o777):
     """Open O_TMPFILE and optionally link it"""
 
-    ctx = {"name": None, "stream": None, "link": True, "unlink": True}
+    ctx = {
+        "name": None,
+        "stream": None,
+        "link": True,
+        "unlink": True,
+        "exist_ok": False,
+    }
     dirfd = None
     fd = None
 
@@ -60,7 +88,14 @@ def open_tmpfile(dirpath, mode=0o777):
                 with suppress_oserror(errno.ENOENT):
                     os.unlink(ctx["name"], dir_fd=dirfd)
             if ctx["link"]:
-                os.link(f"/proc/self/fd/{fd}", ctx["name"], dst_dir_fd=dirfd)
+                try:
+                    os.link(f"/proc/self/fd/{fd}", ctx["name"], dst_dir_fd=dirfd)
+                except FileExistsError:
+                    if not ctx["exist_ok"]:
+                        raise
+                    # Refresh the existing entry, so it is considered as
+                    # recent as a newly linked one.
+                    os.utime(ctx["name"], dir_fd=dirfd)
     finally:
         if fd is not None:
             os.close(fd)
@@ -68,24 +103,788 @@ def open_tmpfile(dirpath, mode=0o777):
             os.close(dirfd)
 
 
+class HashWriter:
+    """Hashing Stream Writer
+
+    A minimal writable stream that computes the SHA-256 checksum of all data
+    written to it and forwards the data to a binary stream. Text is encoded
+    as UTF-8 before it is hashed and forwarded.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        """Hash and forward data"""
+
+        if isinstance(data, str):
+            data = data.encode()
+        self._hash.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self):
+        """Return the checksum of all data written so far"""
+
+        return self._hash.hexdigest()
+
+
+def replace_symlink(target, path):
+    """Atomically create or replace a symlink
+
+    Create a symlink at `path` pointing to `target`. If `path` exists, it is
+    replaced atomically, so concurrent readers either see the old or the new
+    link, but never a missing entry. Concurrent writers to the same path are
+    safe, the last one wins.
+    """
+
+    dirpath = os.path.dirname(path)
+    tmppath = os.path.join(dirpath, TMPFILE_PREFIX + os.urandom(8).hex())
+
+    os.symlink(target, tmppath)
+    try:
+        os.replace(tmppath, path)
+    except BaseException:
+        with suppress_oserror(errno.ENOENT):
+            os.unlink(tmppath)
+        raise
+
+
+@contextlib.contextmanager
+def lock_database(dstdir, exclusive=False):
+    """Lock a database
+
+    Acquire a lock on the database in `dstdir` for the duration of the
+    context. Commands that add objects and tags take a shared lock, so they
+    can run in parallel. Garbage collection takes an exclusive lock, so it
+    never observes objects that were linked but are not tagged, yet. The
+    call blocks until the lock is acquired.
+    """
+
+    path = os.path.join(dstdir, "state", "lock")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+class MdbCache:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        if self._mdb.args.cache is None:
+            print("No cache directory specified", file=sys.stderr)
+            return 1
+
+        engine = mpp.MppEngine(
+            path_cache=self._mdb.args.cache,
+            path_cwd=os.getcwd(),
+            depsolve_cache_size=self._mdb.args.depsolve_cache_size,
+        )
+        cache = engine.depsolve_cache
+
+        if self._mdb.args.purge:
+            reclaimed = cache.purge()
+            print(f"Purged depsolve cache, reclaimed {reclaimed} bytes")
+            return 0
+
+        entries = cache.entries()
+        for entry in entries:
+            mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["mtime"]))
+            print(f"{entry['key']}  {entry['size']:>10}  {mtime}")
+        total = sum(e["size"] for e in entries)
+        print(f"{len(entries)} depsolve cache entries, {total} bytes total")
+        return 0
+
+
 class MdbBuild:
     """Database Command"""
 
     def __init__(self, mdb):
         self._mdb = mdb
 
-    # pylint: disable=no-self-use
+    def _select(self, manifests):
+        # Select all tags matching a given tag or directory. If none is
+        # given, all tags are selected.
+        selectors = [os.path.normpath(t) for t in self._mdb.args.TAG]
+        tags = []
+        for tag in manifests.tags():
+            if not selectors or any(tag == s or tag.startswith(s + "/") for s in selectors):
+                tags.append(tag)
+        return tags
+
+    @staticmethod
+    def _report(node, result):
+        duration = result.get("duration")
+        duration = "" if duration is None else f"  {duration:.2f}s"
+        print(f"{node['hash']}  {result['status']:<8}  {node['tags'][0]}{duration}")
+        if result.get("error"):
+            print(f"    {result['error']}", file=sys.stderr)
+
+    def run(self):
+        """Run database command"""
+
+        args = self._mdb.args
+        jobs = args.jobs
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        path_output = args.output or os.path.join(args.dstdir, "builds", "output")
+
+        plan = build.BuildPlan()
+        with ManifestDB(args.dstdir) as manifests:
+            for tag in self._select(manifests):
+                plan.add(tag, manifests.get(tag))
+
+        options = {"path_output": path_output, "path_store": args.store}
+        if args.executor == "local":
+            options["delay"] = args.local_delay
+        executor = build.EXECUTORS[args.executor](**options)
+
+        scheduler = build.BuildScheduler(
+            executor,
+            os.path.join(args.dstdir, "builds"),
+            jobs=jobs,
+            force=args.force,
+            callback=self._report,
+        )
+        results = scheduler.run(plan)
+
+        counts = collections.Counter(r["status"] for r in results.values())
+        print(
+            f"{plan.manifests} manifests, {plan.pipelines} pipelines, "
+            f"{len(plan.nodes)} unique: "
+            + ", ".join(f"{counts[s]} {s}" for s in ("success", "cached", "failure", "skipped"))
+        )
+        return 1 if counts["failure"] or counts["skipped"] else 0
+
+
+class MdbQuery:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        path = os.path.join(self._mdb.args.dstdir, "state", "index.sqlite")
+        if not os.path.exists(path):
+            print(f"No index at {path}", file=sys.stderr)
+            return 1
+
+        db_index = index.MdbIndex(path)
+        try:
+            rows = db_index.query(
+                tag=self._mdb.args.tag,
+                stage=self._mdb.args.stage,
+                runner=self._mdb.args.runner,
+                fedora=self._mdb.args.fedora,
+                architecture=self._mdb.args.arch,
+                package=self._mdb.args.package,
+            )
+        finally:
+            db_index.close()
+
+        for tag, checksum in rows:
+            print(f"{tag}  {checksum}")
+        return 0
+
+
+class MdbDiff:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        args = self._mdb.args
+        trees = merkle.MerkleStore(args.dstdir)
+
+        with ManifestDB(args.dstdir) as manifests:
+            try:
+                checksums = [manifests.resolve(args.A), manifests.resolve(args.B)]
+                loaded = {}
+
+                def load(checksum):
+                    if checksum not in loaded:
+                        loaded[checksum] = manifests.get(checksum)
+                    return loaded[checksum]
+
+                old, new = (trees.get(c, load) for c in checksums)
+            except KeyError as e:
+                print(f"No such manifest: {e.args[0]}", file=sys.stderr)
+                return 2
+
+            changes = merkle.diff(
+                old,
+                new,
+                lambda: load(checksums[0]),
+                lambda: load(checksums[1]),
+            )
+
+        for change in changes:
+            print(change)
+        return 1 if changes else 0
+
+
+class MdbFsck:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        args = self._mdb.args
+        if not os.path.isdir(os.path.join(args.dstdir, "by-checksum")):
+            print(f"No database at {args.dstdir}", file=sys.stderr)
+            return fsck.FAILED
+
+        jobs = args.jobs
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+
+        checker = fsck.Fsck(
+            args.dstdir,
+            jobs=jobs,
+            cache=not args.full,
+            temp_age=args.temp_age,
+        )
+        try:
+            with lock_database(args.dstdir):
+                problems = checker.run()
+        except (OSError, ValueError) as e:
+            print(f"Cannot check {args.dstdir}: {e}", file=sys.stderr)
+            return fsck.FAILED
+
+        ret = 0
+        counts = dict.fromkeys(fsck.KINDS, 0)
+        for kind, path, message in problems:
+            print(f"{fsck.KINDS[kind]}: {path}: {message}")
+            counts[kind] += 1
+            ret |= kind
+
+        stats = checker.stats
+        summary = ", ".join(f"{counts[kind]} {name}" for kind, name in fsck.KINDS.items())
+        print(
+            f"Checked {stats['objects']} objects ({stats['cached']} unchanged) "
+            f"and {stats['tags']} tags: {summary}"
+        )
+        return ret
+
+
+class MdbGc:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def _mark(self):
+        # Collect all objects reachable from `by-tag`, as well as all
+        # pinned objects. Pins are either checksums or tags. Also return
+        # all tags with the checksums of their objects.
+        tag_dir = os.path.join(self._mdb.args.dstdir, "by-tag")
+        marked = set()
+        tags = {}
+
+        for level, _subdirs, files in os.walk(tag_dir):
+            for entry in files:
+                path = os.path.join(level, entry)
+                with suppress_oserror(errno.ENOENT, errno.EINVAL):
+                    tags[os.path.relpath(path, tag_dir)] = os.path.basename(os.readlink(path))
+        marked.update(tags.values())
+
+        for pin in self._mdb.args.pin:
+            path = os.path.join(tag_dir, pin)
+            if os.path.islink(path):
+                marked.add(os.path.basename(os.readlink(path)))
+            else:
+                marked.add(pin)
+
+        return marked, tags
+
     def run(self):
         """Run database command"""
 
+        dstdir = self._mdb.args.dstdir
+        if not os.path.isdir(os.path.join(dstdir, "by-checksum")):
+            print(f"No database at {dstdir}", file=sys.stderr)
+            return 1
+
+        with lock_database(dstdir, exclusive=True):
+            deadline = time.time() - self._mdb.args.keep_recent
+            marked, tags = self._mark()
+            with store.ObjectStore(dstdir) as objects:
+                swept = objects.sweep(marked, deadline, dry_run=self._mdb.args.dry_run)
+
+            # Drop the Merkle trees of deleted objects, as well as the objects
+            # and all removed tags in the index, if there is one.
+            if not self._mdb.args.dry_run:
+                trees = merkle.MerkleStore(dstdir)
+                for checksum, _size in swept:
+                    trees.remove(checksum)
+            path = os.path.join(dstdir, "state", "index.sqlite")
+            if not self._mdb.args.dry_run and os.path.exists(path):
+                db_index = index.MdbIndex(path)
+                try:
+                    for checksum, _size in swept:
+                        db_index.remove_object(checksum)
+                    db_index.prune_tags(tags)
+                finally:
+                    db_index.close()
+
+        for checksum, size in swept:
+            print(f"{checksum}  {size:>10}")
+        reclaimed = sum(size for _checksum, size in swept)
+        verb = "Would reclaim" if self._mdb.args.dry_run else "Reclaimed"
+        print(f"{verb} {reclaimed} bytes in {len(swept)} objects")
         return 0
 
 
+class MdbLookup:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        args = self._mdb.args
+        if args.package is None and args.url is None and args.host is None and args.gpgkey is None:
+            print("No lookup criteria specified", file=sys.stderr)
+            return 1
+
+        path = os.path.join(args.dstdir, "state", "index.sqlite")
+        if not os.path.exists(path):
+            print(f"No index at {path}", file=sys.stderr)
+            return 1
+
+        db_index = index.MdbIndex(path)
+        try:
+            rows = db_index.lookup(
+                package=args.package,
+                url=args.url,
+                host=args.host,
+                gpgkey=args.gpgkey,
+            )
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        finally:
+            db_index.close()
+
+        for checksum, tags in rows:
+            print("  ".join([checksum] + tags))
+        return 0
+
+
+class MdbRepack:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        dstdir = self._mdb.args.dstdir
+        if not os.path.isdir(os.path.join(dstdir, "by-checksum")):
+            print(f"No database at {dstdir}", file=sys.stderr)
+            return 1
+
+        with lock_database(dstdir, exclusive=True):
+            with store.ObjectStore(dstdir) as objects:
+                packed, skipped = objects.repack(
+                    merge=self._mdb.args.merge,
+                    compression=self._mdb.args.compress,
+                )
+
+        for checksum in skipped:
+            print(f"Skipped corrupted object {checksum}", file=sys.stderr)
+        print(f"Packed {packed} objects")
+        return 0
+
+
+class MdbServe:
+    """Database Command"""
+
+    def __init__(self, mdb):
+        self._mdb = mdb
+
+    def run(self):
+        """Run database command"""
+
+        args = self._mdb.args
+        if not os.path.isdir(os.path.join(args.dstdir, "by-checksum")):
+            print(f"No database at {args.dstdir}", file=sys.stderr)
+            return 1
+
+        def ready(addresses):
+            for address in addresses:
+                print(f"Serving {args.dstdir} on {address[0]}:{address[1]}", file=sys.stderr)
+
+        server = serve.MdbServer(
+            args.dstdir,
+            max_connections=args.max_connections,
+            max_concurrency=args.max_concurrency,
+        )
+        try:
+            asyncio.run(server.serve(args.bind, args.port, ready=ready))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+        return 0
+
+
+class MdbPreprocessState:
+    """Persistent Preprocess State
+
+    The preprocess state records, for every pre-processed stub, the checksum
+    of the resulting object together with the content hashes of all files
+    the object was generated from, the options it was generated with, and
+    the revisions of the repository metadata its dependencies were resolved
+    against. A stub needs to be pre-processed again only if one of these
+    changed.
+
+    To avoid re-reading unchanged files, content hashes are cached together
+    with the size and modification time of the file they were computed from.
+
+    Parameters
+    ----------
+    path
+        Path to the file the state is stored in.
+    srcdir
+        Path to the source directory. All recorded paths are relative to it.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path, srcdir):
+        self._path = path
+        self._srcdir = srcdir
+        self._files = {}
+        self._outputs = {}
+        self._hashes = {}
+
+    def load(self):
+        """Load the state from disk, if it exists"""
+
+        try:
+            with open(self._path, "r", encoding="utf-8") as stream:
+                data = json.load(stream)
+        except FileNotFoundError:
+            return
+
+        if data.get("version") != self.VERSION:
+            return
+
+        self._files = data["files"]
+        self._outputs = data["outputs"]
+
+    def save(self):
+        """Write the state to disk"""
+
+        # Drop cached hashes of files no output depends on anymore.
+        used = set()
+        for output in self._outputs.values():
+            used.update(output["inputs"])
+        files = {k: v for k, v in self._files.items() if k in used}
+
+        data = {
+            "version": self.VERSION,
+            "files": files,
+            "outputs": self._outputs,
+        }
+
+        dirpath = os.path.dirname(self._path)
+        os.makedirs(dirpath, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=dirpath,
+                prefix=TMPFILE_PREFIX,
+                delete=False,
+        ) as stream:
+            json.dump(data, stream, indent=2, sort_keys=True)
+        os.replace(stream.name, self._path)
+
+    def hash_file(self, path):
+        """Compute the content hash of a file, or `None` if it is missing"""
+
+        if path in self._hashes:
+            return self._hashes[path]
+
+        try:
+            info = os.stat(os.path.join(self._srcdir, path))
+        except FileNotFoundError:
+            self._hashes[path] = None
+            return None
+
+        entry = self._files.get(path)
+        if not entry or entry["size"] != info.st_size or entry["mtime_ns"] != info.st_mtime_ns:
+            hashproc = hashlib.sha256()
+            with open(os.path.join(self._srcdir, path), "rb") as stream:
+                for block in iter(lambda: stream.read(65536), b''):
+                    hashproc.update(block)
+            entry = {
+                "sha256": hashproc.hexdigest(),
+                "size": info.st_size,
+                "mtime_ns": info.st_mtime_ns,
+            }
+            self._files[path] = entry
+
+        self._hashes[path] = entry["sha256"]
+        return entry["sha256"]
+
+    def lookup(self, path, options, revision):
+        """Return the checksum of an up-to-date output, or `None`
+
+        `options` are the options the output must have been generated with.
+        `revision` is called with the fedora release and architecture of
+        every platform of the output, and must return the current revision
+        of its repository metadata.
+        """
+
+        output = self._outputs.get(path)
+        if output is None or output["options"] != options:
+            return None
+
+        for dep, dep_hash in output["inputs"].items():
+            if self.hash_file(dep) != dep_hash:
+                return None
+
+        for fedora, architecture, dep_revision in output["revisions"]:
+            if revision(fedora, architecture) != dep_revision:
+                return None
+
+        return output["checksum"]
+
+    def update(self, path, checksum, dependencies, options, revisions):
+        """Record the output of a stub and everything it depends on
+
+        `revisions` is a list of `[fedora, architecture, revision]` of all
+        platforms dependencies were resolved for.
+        """
+
+        self._outputs[path] = {
+            "checksum": checksum,
+            "inputs": {dep: self.hash_file(dep) for dep in dependencies},
+            "options": options,
+            "platforms": [[fedora, architecture] for fedora, architecture, _ in revisions],
+            "revisions": revisions,
+        }
+
+    def platforms(self, path):
+        """Return the recorded platforms of the output of a stub"""
+
+        return self._outputs.get(path, {}).get("platforms", [])
+
+
+class MdbPreprocessWorker:
+    """Preprocess Worker
+
+    A worker pre-processes manifest stubs and stores the result in the
+    `by-checksum` directory of the database. It does not touch the `by-tag`
+    directory, so multiple workers can run in parallel. If several workers
+    produce the same object, the first one to link it wins. Since objects are
+    content-addressed, this does not affect the result.
+
+    Parameters
+    ----------
+    args
+        The parsed command-line arguments of the preprocess command.
+    path_cache
+        Path to the cache directory shared by all workers, or `None` if the
+        pre-processor runs isolated.
+    depsolve_jobs
+        Maximum number of processes resolving depsolve requests of a
+        manifest concurrently.
+    """
+
+    def __init__(self, args, path_cache, depsolve_jobs=mpp.MppEngine.DEPSOLVE_JOBS):
+        self._args = args
+        self._engine = None
+        self._objects = store.ObjectStore(args.dstdir)
+
+        if not args.isolate:
+            self._engine = mpp.MppEngine(
+                path_cache=path_cache,
+                path_cwd=args.srcdir,
+                depsolve_cache_size=args.depsolve_cache_size,
+                depsolve_backend=args.depsolve_backend,
+                depsolve_snapshot=args.depsolve_snapshot,
+                depsolve_jobs=depsolve_jobs,
+            )
+
+    def close(self):
+        """Stop the depsolve worker processes of the pre-processor, if any"""
+
+        if self._engine is not None:
+            self._engine.close()
+
+    def _preprocess_inprocess(self, src_stream, dst_stream):
+        context = mpp.MppContext(self._engine, mpp.Manifest.from_stream(src_stream))
+        with mpp.trace.span("MppContext.run"):
+            manifest = context.run()
+        manifest.to_stream(dst_stream)
+
+        return manifest, context.report()
+
+    def _preprocess_isolated(self, src_stream, dst_stream):
+        with contextlib.ExitStack() as ctx:
+            report = ctx.enter_context(
+                tempfile.NamedTemporaryFile(mode="r", encoding="utf-8", suffix=".json"),
+            )
+            cmd = [
+                "python3",
+                "-m", "mpp",
+                "--cwd", self._args.srcdir,
+                "--report", report.name,
+                "--depsolve-cache-size", str(self._args.depsolve_cache_size),
+            ]
+            if self._args.cache is not None:
+                cmd += ["--cache", self._args.cache]
+            if self._args.depsolve_backend is not None:
+                cmd += ["--depsolve-backend", self._args.depsolve_backend]
+            if self._args.depsolve_snapshot is not None:
+                cmd += ["--depsolve-snapshot", self._args.depsolve_snapshot]
+
+            # If we are traced, the pre-processor records its own trace,
+            # which is merged into ours.
+            path_trace = None
+            if mpp.trace.enabled():
+                path_trace = ctx.enter_context(tempfile.NamedTemporaryFile(suffix=".json")).name
+                cmd += ["--trace", path_trace]
+
+            with mpp.trace.span("mpp subprocess", "mdb"):
+                with subprocess.Popen(
+                        cmd,
+                        stdin=src_stream,
+                        stdout=subprocess.PIPE
+                ) as proc:
+                    for block in iter(lambda: proc.stdout.read(65536), b''):
+                        dst_stream.write(block)
+
+            if path_trace is not None:
+                mpp.trace.add_events(mpp.trace.load(path_trace))
+
+            if proc.returncode != 0:
+                raise RuntimeError(f"Pre-processor failed with exit code {proc.returncode}")
+
+            return None, json.load(report)
+
+    def process(self, path):
+        """Pre-process a stub
+
+        Pre-process the stub at the given path and link the result into the
+        database. Returns a dictionary with the checksum of the result, the
+        list of files it was generated from (including the stub itself), the
+        platforms it was resolved for, and its index facts.
+        """
+
+        with mpp.trace.span("preprocess", "mdb", path=path):
+            return self._process(path)
+
+    def _process(self, path):
+        src_path = os.path.join(self._args.srcdir, path)
+        hash_dir = os.path.join(self._args.dstdir, "by-checksum")
+        hash_file = None
+
+        # Open the source file and stream it through the pre-processor into a
+        # temporary file in the `by-checksum` directory, compressing it if
+        # requested. We compute the checksum on the fly and eventually link
+        # the file under its own checksum as name. If the object exists
+        # already, we keep it.
+        with open(src_path, "r", encoding="utf-8") as src_stream:
+            with open_tmpfile(hash_dir, mode=0o644) as ctx:
+                # The checksum is computed over the uncompressed data.
+                with self._objects.writer(ctx["stream"], self._args.compress) as writer:
+                    dst_stream = HashWriter(writer)
+                    if self._engine is None:
+                        manifest, report = self._preprocess_isolated(src_stream, dst_stream)
+                    else:
+                        manifest, report = self._preprocess_inprocess(src_stream, dst_stream)
+
+                # If the pre-processor ran isolated, we have to read the
+                # result back to extract its facts.
+                if manifest is None:
+                    ctx["stream"].seek(0)
+                    data = self._objects.decode(ctx["stream"].read())
+                    manifest = mpp.Manifest(mpp.codec.default().loads(data))
+
+                hash_file = "sha256:" + dst_stream.hexdigest()
+                ctx["name"] = hash_file
+                ctx["unlink"] = False
+                ctx["exist_ok"] = True
+                mpp.trace.counter("mdb.bytes_written", ctx["stream"].tell())
+
+        with mpp.trace.span("facts", "mdb"):
+            facts = index.manifest_facts(manifest, report["platforms"])
+            tree = merkle.manifest_tree(manifest)
+
+        return {
+            "checksum": hash_file,
+            "dependencies": list(dict.fromkeys([path] + report["dependencies"])),
+            "platforms": report["platforms"],
+            "revisions": report["revisions"],
+            "facts": facts,
+            "merkle": tree,
+        }
+
+
+# The worker of the current process, if it is part of a worker pool.
+_POOL_WORKER = None
+
+
+def _pool_init(args, path_cache, backends):
+    # pylint: disable=global-statement
+    global _POOL_WORKER
+
+    # Depsolve backends registered at runtime, like the fake backend of the
+    # benchmarks, are only inherited by forked workers. Register them again,
+    # so workers can use them with any start method.
+    mpp.depsolve.BACKENDS.update(backends)
+
+    # Manifests are already processed in parallel by the pool, so their
+    # depsolve requests are not spread across further processes.
+    _POOL_WORKER = MdbPreprocessWorker(args, path_cache, depsolve_jobs=1)
+
+    # Workers record their own trace, without anything inherited from the
+    # parent, and hand their events back with every result.
+    if args.trace is not None:
+        mpp.trace.enable("mdb worker")
+    else:
+        mpp.trace.disable()
+
+
+def _pool_process(path):
+    result = _POOL_WORKER.process(path)
+    result["trace"] = mpp.trace.take_events()
+    return result
+
+
 class MdbPreprocess:
     """Database Command"""
 
     def __init__(self, mdb):
         self._mdb = mdb
+        self._engine = None
+        self._path_cache = None
 
     def _collect(self):
         paths = []
@@ -95,66 +894,176 @@ class MdbPreprocess:
             itr_path = os.path.join(itr_base, itr)
             info = os.stat(itr_path)
             if stat.S_ISDIR(info.st_mode):
-                for level, _subdirs, files in os.walk(itr_path):
+                for level, subdirs, files in os.walk(itr_path):
+                    subdirs.sort()
                     rel = os.path.relpath(level, itr_base)
-                    for entry in files:
+                    for entry in sorted(files):
                         paths.append(os.path.join(rel, entry))
             else:
                 paths.append(itr)
 
-        return paths
-
-    def _process(self, path):
-        src_path = os.path.join(self._mdb.args.srcdir, path)
+        # Drop duplicates, in case the same stub was specified multiple times,
+        # but retain the order.
+        return list(dict.fromkeys(os.path.normpath(p) for p in paths))
 
+    def _link(self, path, hash_file):
         dst_path = os.path.join(self._mdb.args.dstdir, "by-tag", path)
         dst_dir, _dst_file = os.path.split(dst_path)
+        hash_path = os.path.join(self._mdb.args.dstdir, "by-checksum", hash_file)
+        target = os.path.relpath(hash_path, dst_dir)
 
-        hash_path = None
-        hash_file = None
-        hash_dir = os.path.join(self._mdb.args.dstdir, "by-checksum")
+        # Mirror the source path and create a symlink to the checksum-file of
+        # the pre-processed manifest, unless it is already in place.
+        with suppress_oserror(errno.ENOENT, errno.EINVAL):
+            if os.readlink(dst_path) == target:
+                return
+        os.makedirs(dst_dir, exist_ok=True)
+        replace_symlink(target, dst_path)
+        mpp.trace.counter("mdb.links_replaced")
 
-        # As first step we open the source file and stream it into a temporary
-        # file in the `by-checksum` directory. We compute the checksum on the
-        # fly and eventually link the file under its own checksum as name.
-        with open(src_path, "r") as src_stream:
-            with open_tmpfile(hash_dir, mode=0o644) as ctx:
-                cmd = [
-                    "python3",
-                    "-m", "mpp",
-                    "--cwd", self._mdb.args.srcdir,
-                ]
-                if self._mdb.args.cache is not None:
-                    cmd += ["--cache", self._mdb.args.cache]
-
-                proc = subprocess.Popen(
-                    cmd,
-                    stdin=src_stream,
-                    stdout=subprocess.PIPE
-                )
+    @staticmethod
+    def _index(db_index, objects, state, path, hash_file):
+        # Objects of up-to-date stubs are usually indexed already. If not,
+        # for instance because the index was deleted, we read the object
+        # back to index it.
+        if not db_index.has_object(hash_file):
+            manifest = mpp.Manifest(mpp.codec.default().loads(objects.read(hash_file)))
+            facts = index.manifest_facts(manifest, state.platforms(path))
+            db_index.add_object(hash_file, facts)
+        db_index.set_tag(path, hash_file)
 
-                hashproc = hashlib.sha256()
-                for block in iter(lambda: proc.stdout.read(4096), b''):
-                    hashproc.update(block)
-                    ctx["stream"].write(block)
+    def _options(self):
+        # Options the output of a stub depends on, besides its files.
+        args = self._mdb.args
+        return {
+            "compress": args.compress,
+            "depsolve_backend": args.depsolve_backend,
+            "depsolve_snapshot": args.depsolve_snapshot,
+        }
 
-                hash_file = "sha256:" + hashproc.hexdigest()
-                hash_path = os.path.join(hash_dir, hash_file)
-                ctx["name"] = hash_file
+    def _revision(self, fedora, architecture):
+        # Identify the current revision of the repository metadata of a
+        # platform, like the depsolve cache does. The depsolver is created
+        # on first use, so stubs without depsolve requests never need one.
+        if self._engine is None:
+            args = self._mdb.args
+            self._engine = mpp.MppEngine(
+                path_cache=self._path_cache,
+                path_cwd=args.srcdir,
+                depsolve_cache_size=args.depsolve_cache_size,
+                depsolve_backend=args.depsolve_backend,
+                depsolve_snapshot=args.depsolve_snapshot,
+                depsolve_jobs=1,
+            )
+        return self._engine.depsolver.revision({"fedora": fedora, "architecture": architecture})
 
-        # As a second step we mirror the source path and create a symlink to
-        # the checksum-file we just created.
-        os.makedirs(dst_dir, exist_ok=True)
-        with suppress_oserror(errno.ENOENT):
-            os.unlink(dst_path)
-        os.symlink(os.path.relpath(hash_path, dst_dir), dst_path)
+    def _lookup(self, objects, state, path):
+        if self._mdb.args.force:
+            return None
+
+        # Check whether the stub, all its dependencies, its options and the
+        # repository metadata it was resolved against are unchanged, and
+        # the object is still present, either loose or packed.
+        hash_file = state.lookup(path, self._options(), self._revision)
+        if hash_file is not None and not objects.contains(hash_file):
+            hash_file = None
+
+        return hash_file
 
     def run(self):
         """Run database command"""
 
-        paths = self._collect()
-        for path in paths:
-            self._process(path)
+        jobs = self._mdb.args.jobs
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+
+        state = MdbPreprocessState(
+            os.path.join(self._mdb.args.dstdir, "state", "preprocess.json"),
+            self._mdb.args.srcdir,
+        )
+        state.load()
+
+        with contextlib.ExitStack() as ctx:
+            # Keep garbage collection from running while we link objects.
+            ctx.enter_context(lock_database(self._mdb.args.dstdir))
+
+            # Whatever we processed is recorded, even if we fail midway.
+            ctx.callback(state.save)
+            db_index = index.MdbIndex(
+                os.path.join(self._mdb.args.dstdir, "state", "index.sqlite"),
+            )
+            ctx.callback(db_index.close)
+            objects = ctx.enter_context(store.ObjectStore(self._mdb.args.dstdir))
+
+            # All pre-processors share the cache, and so does the depsolver
+            # checking whether stubs are up-to-date. A temporary
+            # cache-directory is created here, if none was specified.
+            self._path_cache = self._mdb.args.cache
+            if self._path_cache is None:
+                self._path_cache = ctx.enter_context(tempfile.TemporaryDirectory())
+            else:
+                os.makedirs(self._path_cache, exist_ok=True)
+
+            # Skip all stubs that are up-to-date, but make sure they are
+            # linked and indexed.
+            paths = []
+            with mpp.trace.span("check", "mdb"):
+                for path in self._collect():
+                    hash_file = self._lookup(objects, state, path)
+                    if hash_file is None:
+                        paths.append(path)
+                    else:
+                        mpp.trace.counter("mdb.up_to_date")
+                        self._index(db_index, objects, state, path, hash_file)
+                        self._link(path, hash_file)
+                        db_index.commit()
+
+            if not paths:
+                return 0
+
+            # Unless isolation is requested, we run the pre-processor in our
+            # own process (or our worker processes, respectively). Isolated
+            # pre-processors only use the cache, if one was specified.
+            path_cache = None if self._mdb.args.isolate else self._path_cache
+
+            # Pre-process all stubs, possibly in parallel. Results are
+            # returned in order, and all `by-tag` links are committed
+            # serially by us. Hence, the resulting tree does not depend on
+            # the number of jobs.
+            if jobs > 1 and len(paths) > 1:
+                pool = ctx.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(
+                        max_workers=jobs,
+                        initializer=_pool_init,
+                        initargs=(self._mdb.args, path_cache, dict(mpp.depsolve.BACKENDS)),
+                    )
+                )
+                results = pool.map(_pool_process, paths)
+            else:
+                worker = MdbPreprocessWorker(self._mdb.args, path_cache)
+                ctx.callback(worker.close)
+                results = map(worker.process, paths)
+
+            trees = merkle.MerkleStore(self._mdb.args.dstdir)
+            for path, result in zip(paths, results):
+                mpp.trace.add_events(result.pop("trace", None))
+                with mpp.trace.span("commit", "mdb", path=path):
+                    state.update(
+                        path,
+                        result["checksum"],
+                        result["dependencies"],
+                        self._options(),
+                        result["revisions"],
+                    )
+                    db_index.add_object(result["checksum"], result["facts"])
+                    trees.store(result["checksum"], result["merkle"])
+                    db_index.set_tag(path, result["checksum"])
+                    self._link(path, result["checksum"])
+
+                    # Commit every stub on its own, so the index is never
+                    # locked while stubs are pre-processed, and concurrent
+                    # queries see every stub as soon as it is linked.
+                    db_index.commit()
 
         return 0
 
@@ -168,6 +1077,7 @@ class Mdb(contextlib.AbstractContextManager):
         self._ctx = contextlib.ExitStack()
         self._parser = None
 
+    # pylint: disable=too-many-statements
     def _parse_args(self):
         self._parser = argparse.ArgumentParser(
             add_help=True,
@@ -183,13 +1093,38 @@ class Mdb(contextlib.AbstractContextManager):
             metavar="PATH",
             type=os.path.abspath,
         )
+        self._parser.add_argument(
+            "--depsolve-cache-size",
+            default=mpp.MppEngine.DEPSOLVE_CACHE_SIZE,
+            help="Maximum size of the depsolve cache in bytes",
+            metavar="BYTES",
+            type=int,
+        )
+        self._parser.add_argument(
+            "--depsolve-backend",
+            choices=sorted(mpp.depsolve.BACKENDS),
+            help="Depsolve backend to use",
+            metavar="NAME",
+        )
+        self._parser.add_argument(
+            "--depsolve-snapshot",
+            help="Path to local repository snapshots to depsolve against",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        self._parser.add_argument(
+            "--trace",
+            help="Path to write a trace of the command to, in Chrome trace-event format",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
 
         db = self._parser.add_subparsers(
             dest="cmd",
             title="Database Maintenance",
         )
 
-        _db_build = db.add_parser(
+        db_build = db.add_parser(
             "build",
             add_help=True,
             allow_abbrev=False,
@@ -198,6 +1133,220 @@ class Mdb(contextlib.AbstractContextManager):
             help="Run manifest pipelines",
             prog=f"{self._parser.prog} build",
         )
+        db_build.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_build.add_argument(
+            "--executor",
+            choices=sorted(build.EXECUTORS),
+            default="osbuild",
+            help="Executor to run pipelines with",
+            metavar="NAME",
+        )
+        db_build.add_argument(
+            "--force",
+            action="store_true",
+            default=False,
+            help="Run all pipelines, even if they were built before",
+        )
+        db_build.add_argument(
+            "--jobs",
+            default=1,
+            help="Number of pipelines to run in parallel (0 for one per CPU)",
+            metavar="N",
+            type=int,
+        )
+        db_build.add_argument(
+            "--local-delay",
+            default=0.0,
+            help="Time the local executor spends on every pipeline",
+            metavar="SECONDS",
+            type=float,
+        )
+        db_build.add_argument(
+            "--output",
+            help="Path to the output directory of pipelines",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_build.add_argument(
+            "--store",
+            help="Path to the object store of the executor",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_build.add_argument(
+            "TAG",
+            help="Tag or directory of tags to build (default: all)",
+            nargs="*",
+            type=str,
+        )
+
+        db_cache = db.add_parser(
+            "cache",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Inspect or purge the depsolve cache",
+            help="Manage the depsolve cache",
+            prog=f"{self._parser.prog} cache",
+        )
+        db_cache.add_argument(
+            "--purge",
+            action="store_true",
+            default=False,
+            help="Drop all entries of the depsolve cache",
+        )
+
+        db_diff = db.add_parser(
+            "diff",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Show the structural differences between two manifests",
+            help="Compare manifests",
+            prog=f"{self._parser.prog} diff",
+        )
+        db_diff.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_diff.add_argument(
+            "A",
+            help="Tag or checksum of the old manifest",
+            type=str,
+        )
+        db_diff.add_argument(
+            "B",
+            help="Tag or checksum of the new manifest",
+            type=str,
+        )
+
+        db_fsck = db.add_parser(
+            "fsck",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description=(
+                "Verify the checksums of all objects, and check for misdirected "
+                "or dangling tags and orphaned temporary files. The exit code "
+                "is the bitwise OR of the classes of problems found: "
+                f"{fsck.CORRUPT} for corrupt objects or packs, {fsck.DANGLING} for "
+                f"dangling tags, {fsck.MISDIRECTED} for misdirected tags or invalid "
+                f"entries, {fsck.ORPHANED} for orphaned temporary files, and "
+                f"{fsck.FAILED} if the check could not be run."
+            ),
+            help="Check database consistency",
+            prog=f"{self._parser.prog} fsck",
+        )
+        db_fsck.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_fsck.add_argument(
+            "--full",
+            action="store_true",
+            default=False,
+            help="Hash all objects, even if unchanged since they were last checked",
+        )
+        db_fsck.add_argument(
+            "--jobs",
+            default=0,
+            help="Number of objects to hash in parallel (0 for one per CPU)",
+            metavar="N",
+            type=int,
+        )
+        db_fsck.add_argument(
+            "--temp-age",
+            default=3600,
+            help="Report temporary files older than this many seconds",
+            metavar="SECONDS",
+            type=float,
+        )
+
+        db_gc = db.add_parser(
+            "gc",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Delete objects that are not referenced by any tag",
+            help="Collect garbage",
+            prog=f"{self._parser.prog} gc",
+        )
+        db_gc.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Only list the objects that would be deleted",
+        )
+        db_gc.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_gc.add_argument(
+            "--keep-recent",
+            default=0,
+            help="Keep objects created or reused within this many seconds",
+            metavar="SECONDS",
+            type=float,
+        )
+        db_gc.add_argument(
+            "--pin",
+            action="append",
+            default=[],
+            help="Keep the object with this checksum or tag (can be given multiple times)",
+            metavar="CHECKSUM|TAG",
+        )
+
+        db_lookup = db.add_parser(
+            "lookup",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="List pre-processed manifests referencing packages, URLs or gpg keys",
+            help="Look up manifests by package, URL or gpg key",
+            prog=f"{self._parser.prog} lookup",
+        )
+        db_lookup.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_lookup.add_argument(
+            "--gpgkey",
+            help="Only list manifests trusting the gpg key with this fingerprint or key ID",
+            metavar="FINGERPRINT",
+        )
+        db_lookup.add_argument(
+            "--host",
+            help="Only list manifests fetching sources from this host",
+            metavar="HOST",
+        )
+        db_lookup.add_argument(
+            "--package",
+            help="Only list manifests installing the package with this checksum",
+            metavar="CHECKSUM",
+        )
+        db_lookup.add_argument(
+            "--url",
+            help="Only list manifests fetching sources from URLs with this prefix",
+            metavar="PREFIX",
+        )
 
         db_preprocess = db.add_parser(
             "preprocess",
@@ -208,6 +1357,12 @@ class Mdb(contextlib.AbstractContextManager):
             help="Preprocess manifests",
             prog=f"{self._parser.prog} preprocess",
         )
+        db_preprocess.add_argument(
+            "--compress",
+            choices=sorted(store.COMPRESSIONS),
+            help="Store new objects compressed with this format",
+            metavar="FORMAT",
+        )
         db_preprocess.add_argument(
             "--dstdir",
             default=os.getcwd(),
@@ -215,6 +1370,25 @@ class Mdb(contextlib.AbstractContextManager):
             metavar="PATH",
             type=os.path.abspath,
         )
+        db_preprocess.add_argument(
+            "--force",
+            action="store_true",
+            default=False,
+            help="Pre-process all manifests, even if they are up-to-date",
+        )
+        db_preprocess.add_argument(
+            "--isolate",
+            action="store_true",
+            default=False,
+            help="Run the pre-processor in a separate process for each manifest",
+        )
+        db_preprocess.add_argument(
+            "--jobs",
+            default=1,
+            help="Number of manifests to pre-process in parallel (0 for one per CPU)",
+            metavar="N",
+            type=int,
+        )
         db_preprocess.add_argument(
             "--srcdir",
             default=os.getcwd(),
@@ -229,12 +1403,138 @@ class Mdb(contextlib.AbstractContextManager):
             type=str,
         )
 
+        db_query = db.add_parser(
+            "query",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Query the index of pre-processed manifests",
+            help="Query manifests",
+            prog=f"{self._parser.prog} query",
+        )
+        db_query.add_argument(
+            "--arch",
+            help="Only list manifests resolved for this architecture",
+            metavar="ARCH",
+        )
+        db_query.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_query.add_argument(
+            "--fedora",
+            help="Only list manifests resolved for this fedora release",
+            metavar="RELEASE",
+        )
+        db_query.add_argument(
+            "--package",
+            help="Only list manifests installing the package with this checksum",
+            metavar="CHECKSUM",
+        )
+        db_query.add_argument(
+            "--runner",
+            help="Only list manifests using this runner",
+            metavar="RUNNER",
+        )
+        db_query.add_argument(
+            "--stage",
+            help="Only list manifests using this stage",
+            metavar="NAME",
+        )
+        db_query.add_argument(
+            "--tag",
+            help="Only list tags matching this glob pattern",
+            metavar="GLOB",
+        )
+
+        db_repack = db.add_parser(
+            "repack",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Migrate loose objects into packs",
+            help="Pack objects",
+            prog=f"{self._parser.prog} repack",
+        )
+        db_repack.add_argument(
+            "--compress",
+            choices=sorted(store.COMPRESSIONS),
+            help="Compress packed objects with this format (with --merge, all objects)",
+            metavar="FORMAT",
+        )
+        db_repack.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_repack.add_argument(
+            "--merge",
+            action="store_true",
+            default=False,
+            help="Merge all existing packs into the new pack",
+        )
+
+        db_serve = db.add_parser(
+            "serve",
+            add_help=True,
+            allow_abbrev=False,
+            argument_default=None,
+            description="Serve the manifest database over HTTP",
+            help="Serve manifests",
+            prog=f"{self._parser.prog} serve",
+        )
+        db_serve.add_argument(
+            "--bind",
+            default="127.0.0.1",
+            help="Address to listen on",
+            metavar="ADDRESS",
+        )
+        db_serve.add_argument(
+            "--dstdir",
+            default=os.getcwd(),
+            help="Path to database directory",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+        db_serve.add_argument(
+            "--max-concurrency",
+            default=64,
+            help="Maximum number of requests processed at the same time",
+            metavar="N",
+            type=int,
+        )
+        db_serve.add_argument(
+            "--max-connections",
+            default=256,
+            help="Maximum number of open client connections",
+            metavar="N",
+            type=int,
+        )
+        db_serve.add_argument(
+            "--port",
+            default=8080,
+            help="Port to listen on",
+            metavar="PORT",
+            type=int,
+        )
+
         return self._parser.parse_args(self._argv[1:])
 
     def __enter__(self):
         with self._ctx as ctx:
             self.args = self._parse_args()
 
+            # If `--trace=FILE` was specified, record a trace of the command
+            # and write it when we are done, even on failure.
+            if self.args.trace is not None:
+                mpp.trace.enable("mdb")
+                ctx.callback(mpp.trace.dump, self.args.trace)
+
             # Initialization succeeded. Save the exit-stack for later.
             self._ctx = ctx.pop_all()
 
@@ -251,10 +1551,26 @@ class Mdb(contextlib.AbstractContextManager):
             print("No subcommand specified", file=sys.stderr)
             self._parser.print_help(file=sys.stderr)
             ret = 1
+        elif self.args.cmd == "cache":
+            ret = MdbCache(self).run()
         elif self.args.cmd == "build":
             ret = MdbBuild(self).run()
+        elif self.args.cmd == "diff":
+            ret = MdbDiff(self).run()
+        elif self.args.cmd == "fsck":
+            ret = MdbFsck(self).run()
+        elif self.args.cmd == "gc":
+            ret = MdbGc(self).run()
+        elif self.args.cmd == "lookup":
+            ret = MdbLookup(self).run()
         elif self.args.cmd == "preprocess":
             ret = MdbPreprocess(self).run()
+        elif self.args.cmd == "repack":
+            ret = MdbRepack(self).run()
+        elif self.args.cmd == "serve":
+            ret = MdbServe(self).run()
+        elif self.args.cmd == "query":
+            ret = MdbQuery(self).run()
         else:
             raise RuntimeError("Subcommand mismatch")
 
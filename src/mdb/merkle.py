@@ -0,0 +1,278 @@
+"""Manifest Merkle Trees
+
+A Merkle tree of a manifest assigns a hash to every stage, every pipeline
+level and every source type of the manifest, following the same structure
+`mpp.Manifest` links. The hash of a level covers the hashes of its stages,
+its runner and the hash of its build level, and the root hash covers the
+top-level pipeline and all sources. Hence, if two subtrees have the same
+hash, they are identical and need not be compared any further.
+
+Trees are stored as sidecar files `state/merkle/<checksum>.json` of their
+objects. Comparing two manifests only needs their trees, plus the parts of
+the manifests where hashes differ.
+"""
+
+
+import difflib
+import hashlib
+import json
+import os
+import tempfile
+
+
+VERSION = 1
+
+
+def _hash(value):
+    data = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def level_hashes(manifest):
+    """Compute the hashes of all pipeline levels of a manifest
+
+    Return a list with an entry for every level of `manifest.levels`, in
+    the same order. Every entry has the `hash` of the level, its `runner`
+    and a list of `stages`, each a `[hash, name]` pair. The hash of a level
+    covers its stages, its runner and the hash of its build level, so two
+    levels have the same hash exactly if they run the same stages the same
+    way.
+    """
+
+    levels = [None] * len(manifest.levels)
+    build = None
+
+    for i in reversed(range(len(manifest.levels))):
+        level = manifest.levels[i]
+        stages = [
+            [_hash(stage), stage.get("name")]
+            for stage in level.get("pipeline", {}).get("stages", [])
+        ]
+        runner = level.get("runner")
+        levels[i] = {
+            "hash": _hash({"build": build, "runner": runner, "stages": [s[0] for s in stages]}),
+            "runner": runner,
+            "stages": stages,
+        }
+        build = levels[i]["hash"]
+
+    return levels
+
+
+def manifest_tree(manifest):
+    """Compute the Merkle tree of a manifest
+
+    Return a JSON-serializable dictionary with the `root` hash, the hash of
+    every source type in `sources`, and the `levels` of `level_hashes()`.
+    """
+
+    levels = level_hashes(manifest)
+    sources = {key: _hash(value) for key, value in manifest.links["sources"].items()}
+
+    return {
+        "version": VERSION,
+        "root": _hash({"pipeline": levels[0]["hash"] if levels else None, "sources": sources}),
+        "sources": sources,
+        "levels": levels,
+    }
+
+
+class MerkleStore:
+    """Merkle Tree Sidecar Store
+
+    Parameters
+    ----------
+    dstdir
+        Path to the database directory.
+    """
+
+    def __init__(self, dstdir):
+        self._path = os.path.join(dstdir, "state", "merkle")
+
+    def _entry_path(self, checksum):
+        return os.path.join(self._path, checksum + ".json")
+
+    def load(self, checksum):
+        """Load the tree of an object, or `None` if there is none"""
+
+        try:
+            with open(self._entry_path(checksum), "r", encoding="utf-8") as stream:
+                tree = json.load(stream)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if tree.get("version") != VERSION:
+            return None
+        return tree
+
+    def store(self, checksum, tree):
+        """Store the tree of an object"""
+
+        os.makedirs(self._path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=self._path,
+                prefix=".tmp-",
+                delete=False,
+        ) as stream:
+            json.dump(tree, stream)
+        os.replace(stream.name, self._entry_path(checksum))
+
+    def remove(self, checksum):
+        """Drop the tree of an object"""
+
+        try:
+            os.unlink(self._entry_path(checksum))
+        except FileNotFoundError:
+            pass
+
+    def get(self, checksum, load):
+        """Return the tree of an object, computing it if necessary
+
+        If no tree is stored for the object, `load` is called with the
+        checksum to get the manifest, and its tree is computed and stored.
+        """
+
+        tree = self.load(checksum)
+        if tree is None:
+            tree = manifest_tree(load(checksum))
+            self.store(checksum, tree)
+        return tree
+
+
+def _diff_options(old, new):
+    # Return the sorted list of option keys that differ between two stages.
+    old = old.get("options", {})
+    new = new.get("options", {})
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+def _align_stages(old, new):
+    # Align two lists of `[hash, name]` stages by their hashes and yield a
+    # `(kind, a, b)` tuple for every stage that was `removed`, `changed` or
+    # `added`, with its index in the old list, the new list, or both.
+    # Stages replaced by a stage of the same name are reported as changes.
+    matcher = difflib.SequenceMatcher(
+        a=[s[0] for s in old],
+        b=[s[0] for s in new],
+        autojunk=False,
+    )
+    for op, a_lo, a_hi, b_lo, b_hi in matcher.get_opcodes():
+        if op == "equal":
+            continue
+
+        pairs = []
+        if op == "replace" and a_hi - a_lo == b_hi - b_lo:
+            pairs = [
+                (a, b) for a, b in zip(range(a_lo, a_hi), range(b_lo, b_hi))
+                if old[a][1] == new[b][1]
+            ]
+        paired_a = {a for a, _ in pairs}
+        paired_b = {b for _, b in pairs}
+
+        for a in range(a_lo, a_hi):
+            if a not in paired_a:
+                yield "removed", a, None
+        for a, b in pairs:
+            yield "changed", a, b
+        for b in range(b_lo, b_hi):
+            if b not in paired_b:
+                yield "added", None, b
+
+
+def _diff_stages(i, old, new, loaders):
+    # Report all stages of level `i` that were added, removed or changed.
+    # Only changed stages are loaded, to show which options changed.
+    prefix = "pipeline" + ".build" * i
+    changes = []
+
+    for kind, a, b in _align_stages(old["stages"], new["stages"]):
+        if kind == "removed":
+            changes.append(f"{prefix} stage {a} {old['stages'][a][1]}: removed")
+        elif kind == "added":
+            changes.append(f"{prefix} stage {b} {new['stages'][b][1]}: added")
+        else:
+            stage_old = loaders[0]().levels[i]["pipeline"]["stages"][a]
+            stage_new = loaders[1]().levels[i]["pipeline"]["stages"][b]
+            keys = ", ".join(_diff_options(stage_old, stage_new)) or "name"
+            changes.append(f"{prefix} stage {b} {new['stages'][b][1]}: changed ({keys})")
+
+    return changes
+
+
+def _diff_sources(old, new, load_old, load_new):
+    changes = []
+
+    for key in sorted(set(old["sources"]) | set(new["sources"])):
+        if old["sources"].get(key) == new["sources"].get(key):
+            continue
+        if key not in old["sources"]:
+            changes.append(f"sources {key}: added")
+            continue
+        if key not in new["sources"]:
+            changes.append(f"sources {key}: removed")
+            continue
+
+        # Source types map identifiers to their definitions, so they are
+        # compared entry by entry.
+        source_old = load_old().links["sources"][key]
+        source_new = load_new().links["sources"][key]
+        for sub in sorted(set(source_old) | set(source_new)):
+            entries_old = source_old.get(sub, {})
+            entries_new = source_new.get(sub, {})
+            if entries_old == entries_new:
+                continue
+            if not isinstance(entries_old, dict) or not isinstance(entries_new, dict):
+                changes.append(f"sources {key} {sub}: changed")
+                continue
+            added = len(set(entries_new) - set(entries_old))
+            removed = len(set(entries_old) - set(entries_new))
+            changed = sum(
+                1 for k in set(entries_old) & set(entries_new)
+                if entries_old[k] != entries_new[k]
+            )
+            changes.append(
+                f"sources {key} {sub}: {added} added, {removed} removed, {changed} changed"
+            )
+
+    return changes
+
+
+def diff(old, new, load_old, load_new):
+    """Compare two manifests by their Merkle trees
+
+    Return a list of human-readable changes from the manifest with tree
+    `old` to the manifest with tree `new`. Subtrees with equal hashes are
+    skipped. Manifests are only loaded, via `load_old()` and `load_new()`,
+    if changed stages or sources have to be compared in detail. Both
+    functions must return the same manifest on every call.
+    """
+
+    if old["root"] == new["root"]:
+        return []
+
+    changes = []
+
+    # Compare levels from the top-level pipeline down. Level hashes cover
+    # all build levels below them, so the first equal pair ends the descent.
+    depth = max(len(old["levels"]), len(new["levels"]))
+    for i in range(depth):
+        prefix = "pipeline" + ".build" * i
+        if i >= len(old["levels"]):
+            changes.append(f"{prefix}: added")
+            break
+        if i >= len(new["levels"]):
+            changes.append(f"{prefix}: removed")
+            break
+
+        level_old = old["levels"][i]
+        level_new = new["levels"][i]
+        if level_old["hash"] == level_new["hash"]:
+            break
+        if level_old["runner"] != level_new["runner"]:
+            changes.append(f"{prefix} runner: {level_old['runner']} -> {level_new['runner']}")
+        changes += _diff_stages(i, level_old, level_new, (load_old, load_new))
+
+    changes += _diff_sources(old, new, load_old, load_new)
+
+    return changes
@@ -0,0 +1,444 @@
+"""Manifest Database HTTP Server
+
+This module serves a manifest database over HTTP. It implements just enough
+of HTTP/1.1 for clients to fetch manifests, including persistent
+connections, and runs on a single asyncio event loop without any external
+dependencies.
+
+The following resources are provided:
+
+`GET /by-checksum/<checksum>`
+    The object with the given checksum. Objects never change, so responses
+    can be cached forever.
+
+`GET /by-tag/<tag>`
+    The object a tag currently points to. Responses must be revalidated, but
+    carry the checksum of the object as ETag, so revalidation is cheap.
+
+`POST /multi-get`
+    Multiple objects in one response. The request body is a JSON array of
+    tags and checksums. The response is a JSON object mapping each of them
+    to its manifest, or `null` if it does not exist.
+
+`GET /metrics`
+    Request metrics in the Prometheus text format.
+
+Objects stored uncompressed are sent with `sendfile()`, straight from the
+loose object or pack. Objects stored gzip-compressed are sent as they are to
+clients accepting gzip, with the ETag `"<checksum>-gzip"`, so caches never
+confuse them with the uncompressed representation. All other objects are
+decompressed first.
+"""
+
+
+import asyncio
+import collections
+import errno
+import http
+import json
+import os
+import time
+import urllib.parse
+
+from . import store
+
+
+# Limits of requests accepted by the server.
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+
+def accepts_encoding(header, coding):
+    """Check whether an `Accept-Encoding` header accepts a content-coding
+
+    A coding is accepted if it is listed with a non-zero quality value, or
+    if it is not listed and `*` is, with a non-zero quality value.
+    """
+
+    qualities = {}
+    for item in header.split(","):
+        name, *params = item.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+
+    coding = coding.lower()
+    if coding in qualities:
+        return qualities[coding] > 0
+    return qualities.get("*", 0) > 0
+
+
+def _etag_matches(header, etag):
+    # Check whether an `If-None-Match` header matches an ETag. The weak
+    # comparison is used, as required for `If-None-Match`.
+    for item in header.split(","):
+        item = item.strip()
+        if item == "*" or item.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class HttpError(Exception):
+    """Error to be reported to the client with the given status"""
+
+    def __init__(self, status):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+class MdbServer:
+    """Manifest Database HTTP Server
+
+    Parameters
+    ----------
+    dstdir
+        Path to the database directory.
+    max_connections
+        Maximum number of open client connections. Further connections are
+        answered with `503 Service Unavailable` and closed.
+    max_concurrency
+        Maximum number of requests processed at the same time. Further
+        requests wait until others are done.
+    """
+
+    def __init__(self, dstdir, max_connections=256, max_concurrency=64):
+        self._path_tags = os.path.join(dstdir, "by-tag")
+        self._objects = store.ObjectStore(dstdir)
+        self._max_connections = max_connections
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self._connections = 0
+        self._metrics = {
+            "requests": collections.Counter(),
+            "bytes": 0,
+            "duration": 0.0,
+            "in_flight": 0,
+            "rejected": 0,
+        }
+
+    def close(self):
+        """Release the database"""
+
+        self._objects.close()
+
+    def _resolve_tag(self, tag):
+        path = os.path.normpath(os.path.join(self._path_tags, tag))
+        if not path.startswith(self._path_tags + os.sep):
+            raise HttpError(http.HTTPStatus.NOT_FOUND)
+        try:
+            return os.path.basename(os.readlink(path))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.EINVAL, errno.ENOTDIR):
+                raise HttpError(http.HTTPStatus.NOT_FOUND) from None
+            raise
+
+    def _open(self, checksum):
+        # Open the file containing an object, and return it with the
+        # offset, length and compression of the object. Returns `None` if
+        # the object does not exist.
+        for _ in range(2):
+            location = self._objects.locate(checksum)
+            if location is None:
+                return None
+            path, offset, length = location
+            try:
+                stream = open(path, "rb")  # pylint: disable=consider-using-with
+            except FileNotFoundError:
+                # The object was packed or deleted concurrently.
+                self._objects.reload()
+                continue
+            stream.seek(offset)
+            compression = store.compression_of(stream.read(8))
+            return stream, offset, length, compression
+        return None
+
+    @staticmethod
+    def _head(status, headers):
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+    async def _send_object(self, writer, request, checksum, cache_control):
+        opened = self._open(checksum)
+        if opened is None:
+            raise HttpError(http.HTTPStatus.NOT_FOUND)
+
+        stream, offset, length, compression = opened
+        with stream:
+            # Every representation has its own ETag, so it is only
+            # revalidated against itself.
+            encoded = compression == "gzip" and accepts_encoding(
+                request["headers"].get("accept-encoding", ""), "gzip"
+            )
+            etag = f'"{checksum}-gzip"' if encoded else f'"{checksum}"'
+
+            if _etag_matches(request["headers"].get("if-none-match", ""), etag):
+                writer.write(self._head(http.HTTPStatus.NOT_MODIFIED, {
+                    "ETag": etag,
+                    "Cache-Control": cache_control,
+                    "Vary": "Accept-Encoding",
+                }))
+                return http.HTTPStatus.NOT_MODIFIED, 0
+
+            headers = {
+                "Content-Type": "application/json",
+                "ETag": etag,
+                "Cache-Control": cache_control,
+                "Vary": "Accept-Encoding",
+                "X-Mdb-Checksum": checksum,
+            }
+            body = None
+            if encoded:
+                headers["Content-Encoding"] = "gzip"
+            elif compression is not None:
+                stream.seek(offset)
+                body = self._objects.decode(stream.read(length))
+                length = len(body)
+            headers["Content-Length"] = str(length)
+
+            writer.write(self._head(http.HTTPStatus.OK, headers))
+            if request["method"] == "HEAD":
+                return http.HTTPStatus.OK, 0
+            if body is not None:
+                writer.write(body)
+            elif length > 0:
+                loop = asyncio.get_running_loop()
+                await loop.sendfile(writer.transport, stream, offset, length)
+        return http.HTTPStatus.OK, length
+
+    def _multi_get(self, request):
+        try:
+            refs = json.loads(request["body"])
+        except json.JSONDecodeError:
+            raise HttpError(http.HTTPStatus.BAD_REQUEST) from None
+        if not isinstance(refs, list) or not all(isinstance(r, str) for r in refs):
+            raise HttpError(http.HTTPStatus.BAD_REQUEST)
+
+        parts = [b"{"]
+        for i, ref in enumerate(refs):
+            if i > 0:
+                parts.append(b",")
+            parts.append(json.dumps(ref).encode() + b":")
+            try:
+                checksum = ref
+                if store.checksum_digest(ref) is None:
+                    checksum = self._resolve_tag(ref)
+                parts.append(self._objects.view(checksum))
+            except (HttpError, FileNotFoundError):
+                parts.append(b"null")
+        parts.append(b"}")
+        return parts
+
+    def _render_metrics(self):
+        lines = [
+            "# TYPE mdb_requests_total counter",
+        ]
+        for (route, status), count in sorted(self._metrics["requests"].items()):
+            lines.append(f'mdb_requests_total{{route="{route}",status="{status}"}} {count}')
+        lines += [
+            "# TYPE mdb_response_bytes_total counter",
+            f"mdb_response_bytes_total {self._metrics['bytes']}",
+            "# TYPE mdb_request_duration_seconds_total counter",
+            f"mdb_request_duration_seconds_total {self._metrics['duration']:.6f}",
+            "# TYPE mdb_requests_in_flight gauge",
+            f"mdb_requests_in_flight {self._metrics['in_flight']}",
+            "# TYPE mdb_connections gauge",
+            f"mdb_connections {self._connections}",
+            "# TYPE mdb_connections_rejected_total counter",
+            f"mdb_connections_rejected_total {self._metrics['rejected']}",
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+    async def _dispatch(self, writer, request):
+        # Handle a request and return its route, status and body size.
+        method = request["method"]
+        path = urllib.parse.unquote(urllib.parse.urlsplit(request["target"]).path)
+
+        if path.startswith("/by-checksum/"):
+            if method not in ("GET", "HEAD"):
+                raise HttpError(http.HTTPStatus.METHOD_NOT_ALLOWED)
+            checksum = path[len("/by-checksum/"):]
+            if store.checksum_digest(checksum) is None:
+                raise HttpError(http.HTTPStatus.NOT_FOUND)
+            status, size = await self._send_object(writer, request, checksum, CACHE_IMMUTABLE)
+            return "by-checksum", status, size
+
+        if path.startswith("/by-tag/"):
+            if method not in ("GET", "HEAD"):
+                raise HttpError(http.HTTPStatus.METHOD_NOT_ALLOWED)
+            checksum = self._resolve_tag(path[len("/by-tag/"):])
+            status, size = await self._send_object(writer, request, checksum, CACHE_REVALIDATE)
+            return "by-tag", status, size
+
+        if path == "/multi-get":
+            if method != "POST":
+                raise HttpError(http.HTTPStatus.METHOD_NOT_ALLOWED)
+            parts = self._multi_get(request)
+            size = sum(len(p) for p in parts)
+            writer.write(self._head(http.HTTPStatus.OK, {
+                "Content-Type": "application/json",
+                "Content-Length": str(size),
+                "Cache-Control": CACHE_REVALIDATE,
+            }))
+            writer.writelines(parts)
+            return "multi-get", http.HTTPStatus.OK, size
+
+        if path == "/metrics":
+            if method not in ("GET", "HEAD"):
+                raise HttpError(http.HTTPStatus.METHOD_NOT_ALLOWED)
+            body = self._render_metrics()
+            writer.write(self._head(http.HTTPStatus.OK, {
+                "Content-Type": "text/plain; version=0.0.4",
+                "Content-Length": str(len(body)),
+                "Cache-Control": CACHE_REVALIDATE,
+            }))
+            if method == "GET":
+                writer.write(body)
+            return "metrics", http.HTTPStatus.OK, len(body)
+
+        raise HttpError(http.HTTPStatus.NOT_FOUND)
+
+    @staticmethod
+    async def _read_request(reader):
+        # Read the next request from a connection. Returns `None` if the
+        # client closed the connection.
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HttpError(http.HTTPStatus.BAD_REQUEST) from None
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE) from None
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise HttpError(http.HTTPStatus.BAD_REQUEST) from None
+
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+        body = b""
+        if "content-length" in headers:
+            try:
+                size = int(headers["content-length"])
+            except ValueError:
+                raise HttpError(http.HTTPStatus.BAD_REQUEST) from None
+            if size < 0 or size > MAX_BODY_SIZE:
+                raise HttpError(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            body = await reader.readexactly(size)
+
+        connection = headers.get("connection", "").lower()
+        return {
+            "method": method,
+            "target": target,
+            "headers": headers,
+            "body": body,
+            "keep_alive": (
+                connection != "close"
+                and (version == "HTTP/1.1" or connection == "keep-alive")
+            ),
+        }
+
+    def _send_error(self, writer, status):
+        body = f"{status.value} {status.phrase}\n".encode()
+        writer.write(self._head(status, {
+            "Content-Type": "text/plain",
+            "Content-Length": str(len(body)),
+            "Connection": "close",
+        }))
+        writer.write(body)
+
+    async def _handle_request(self, writer, request):
+        # Process a single request within the concurrency limit and record
+        # its metrics.
+        async with self._semaphore:
+            self._metrics["in_flight"] += 1
+            start = time.monotonic()
+            try:
+                route, status, size = await self._dispatch(writer, request)
+            except HttpError as e:
+                route, status, size = "error", e.status, 0
+                self._send_error(writer, e.status)
+                request["keep_alive"] = False
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception:  # pylint: disable=broad-except
+                # Anything else, like a corrupt object or a failure to read
+                # it, is a server error. The response might have started
+                # already, so the connection is closed afterwards in any
+                # case.
+                route, status, size = "error", http.HTTPStatus.INTERNAL_SERVER_ERROR, 0
+                self._send_error(writer, status)
+                request["keep_alive"] = False
+            finally:
+                self._metrics["in_flight"] -= 1
+                self._metrics["duration"] += time.monotonic() - start
+
+        self._metrics["requests"][(route, status.value)] += 1
+        self._metrics["bytes"] += size
+        await writer.drain()
+
+    async def _handle_connection(self, reader, writer):
+        self._connections += 1
+        try:
+            if self._connections > self._max_connections:
+                self._metrics["rejected"] += 1
+                self._send_error(writer, http.HTTPStatus.SERVICE_UNAVAILABLE)
+                await writer.drain()
+                return
+
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as e:
+                    self._send_error(writer, e.status)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                await self._handle_request(writer, request)
+                if not request["keep_alive"]:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections -= 1
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        """Serve the database until cancelled
+
+        If given, `ready` is called with the list of bound socket addresses
+        once the server accepts connections.
+        """
+
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        server = await asyncio.start_server(
+            self._handle_connection,
+            host,
+            port,
+            limit=MAX_HEADER_SIZE,
+            backlog=self._max_connections,
+        )
+        async with server:
+            if ready is not None:
+                ready([s.getsockname() for s in server.sockets])
+            await server.serve_forever()
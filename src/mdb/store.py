@@ -0,0 +1,645 @@
+"""Manifest Database Object Store
+
+Objects of the database are stored under their checksum. New objects are
+always stored as loose files in `by-checksum`. Loose objects can be migrated
+into packs, which concatenate many objects into a single file. Each pack
+`packs/pack-<id>.pack` comes with an index `packs/pack-<id>.idx`, which maps
+the digests of all objects of the pack to their location in the pack.
+
+The index is a fixed header followed by one fixed-size entry per object,
+sorted by digest. Hence, it can be mapped into memory and searched in place
+without parsing it. An entry consists of the raw 32-byte SHA-256 digest of
+the object, followed by its offset and length in the pack as unsigned
+64-bit big-endian integers.
+
+Objects can be stored compressed with gzip, lzma or, if the `zstandard`
+module is available, zstd. Compressed objects are detected by the magic
+bytes of their format, which never start a JSON document, so no metadata is
+needed. Checksums are always computed over the uncompressed content, so the
+address of an object does not depend on how it is stored. Zstd can use a
+dictionary trained on the database, stored as `state/zstd-<id>.dict`. Frames
+name the dictionary they were compressed with, so dictionaries are never
+replaced, only added.
+
+A pack is only used once its index exists, and the index is always written
+last. Loose objects are only deleted once the pack containing them is in
+place. Readers look up objects in packs first and fall back to loose
+objects. If neither contains an object, the list of packs is reloaded once,
+since the object might have been migrated concurrently.
+"""
+
+
+import contextlib
+import errno
+import glob
+import gzip
+import hashlib
+import lzma
+import mmap
+import os
+import struct
+import tempfile
+
+
+PACK_MAGIC = b"MDBPACK\x01"
+IDX_MAGIC = b"MDBIDX\x00\x01"
+IDX_HEADER = struct.Struct(">8sQ")
+IDX_ENTRY = struct.Struct(">32sQQ")
+CHECKSUM_PREFIX = "sha256:"
+
+# Supported compression formats, by name, with the magic bytes that start
+# every object compressed in the respective format.
+COMPRESSIONS = {
+    "gzip": b"\x1f\x8b",
+    "lzma": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+# Size of trained zstd dictionaries, and maximum number of sample objects to
+# train them on.
+ZSTD_DICT_SIZE = 112640
+ZSTD_DICT_SAMPLES = 1024
+
+
+def _zstandard():
+    # pylint: disable=import-outside-toplevel
+    import zstandard
+    return zstandard
+
+
+def compression_of(data):
+    """Return the name of the compression format of `data`, or `None`"""
+
+    for name, magic in COMPRESSIONS.items():
+        if data[:len(magic)] == magic:
+            return name
+    return None
+
+
+def checksum_digest(checksum):
+    """Convert an object checksum into its raw digest, or `None`"""
+
+    if not checksum.startswith(CHECKSUM_PREFIX):
+        return None
+    try:
+        digest = bytes.fromhex(checksum[len(CHECKSUM_PREFIX):])
+    except ValueError:
+        return None
+    if len(digest) != 32:
+        return None
+    return digest
+
+
+class Pack:
+    """Object Pack
+
+    A read-only view of a pack and its index. Both files are mapped into
+    memory.
+
+    Parameters
+    ----------
+    path
+        Path to the pack, without suffix.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._idx = None
+        self._pack = None
+
+        with open(path + ".idx", "rb") as stream:
+            self._idx = mmap.mmap(stream.fileno(), 0, prot=mmap.PROT_READ)
+        magic, self.count = b"", 0
+        if len(self._idx) >= IDX_HEADER.size:
+            magic, self.count = IDX_HEADER.unpack_from(self._idx, 0)
+        if magic != IDX_MAGIC or len(self._idx) != IDX_HEADER.size + self.count * IDX_ENTRY.size:
+            self.close()
+            raise ValueError(f"Invalid pack index: {path}.idx")
+
+        with open(path + ".pack", "rb") as stream:
+            self.mtime = os.fstat(stream.fileno()).st_mtime
+            if self.count > 0:
+                self._pack = mmap.mmap(stream.fileno(), 0, prot=mmap.PROT_READ)
+
+    def close(self):
+        """Unmap the pack
+
+        If views of the pack are still in use, the mapping is released
+        once the last of them is gone.
+        """
+
+        for mapping in (self._pack, self._idx):
+            if mapping is not None:
+                with contextlib.suppress(BufferError):
+                    mapping.close()
+        self._pack = None
+        self._idx = None
+
+    def _entry(self, i):
+        return IDX_ENTRY.unpack_from(self._idx, IDX_HEADER.size + i * IDX_ENTRY.size)
+
+    def find(self, digest):
+        """Find an object and return its `(offset, length)`, or `None`"""
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = IDX_HEADER.size + mid * IDX_ENTRY.size
+            key = self._idx[pos:pos + 32]
+            if key < digest:
+                lo = mid + 1
+            elif key > digest:
+                hi = mid
+            else:
+                return self._entry(mid)[1:]
+        return None
+
+    def entries(self):
+        """Iterate the `(digest, offset, length)` of all objects, in pack order"""
+
+        return sorted((self._entry(i) for i in range(self.count)), key=lambda e: e[1])
+
+    def read(self, offset, length):
+        """Read an object from the pack"""
+
+        return self._pack[offset:offset + length]
+
+    def view(self, offset, length):
+        """Return a view of an object in the pack, without copying it"""
+
+        return memoryview(self._pack)[offset:offset + length]
+
+
+class ObjectStore:
+    """Object Store
+
+    Provides access to all objects of a database, whether they are loose or
+    packed.
+
+    Parameters
+    ----------
+    dstdir
+        Path to the database directory.
+    """
+
+    def __init__(self, dstdir):
+        self._path_loose = os.path.join(dstdir, "by-checksum")
+        self._path_packs = os.path.join(dstdir, "packs")
+        self._path_state = os.path.join(dstdir, "state")
+        self._packs = None
+        self._zstd_dicts = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """Unmap all packs"""
+
+        for pack in self._packs or []:
+            pack.close()
+        self._packs = None
+
+    @property
+    def packs(self):
+        """List of all packs, loaded on first use"""
+
+        if self._packs is None:
+            self._packs = []
+            names = []
+            with contextlib.suppress(FileNotFoundError):
+                names = sorted(os.listdir(self._path_packs))
+            for name in names:
+                if not name.startswith("pack-") or not name.endswith(".idx"):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    self._packs.append(Pack(os.path.join(self._path_packs, name[:-4])))
+        return self._packs
+
+    def reload(self):
+        """Drop the list of packs, so it is loaded again on next use"""
+
+        self.close()
+
+    @property
+    def zstd_dicts(self):
+        """Dictionary of all zstd dictionaries, by ID, loaded on first use"""
+
+        if self._zstd_dicts is None:
+            self._zstd_dicts = {}
+            for path in sorted(glob.glob(os.path.join(self._path_state, "zstd-*.dict"))):
+                with open(path, "rb") as stream:
+                    zdict = _zstandard().ZstdCompressionDict(stream.read())
+                self._zstd_dicts[zdict.dict_id()] = zdict
+        return self._zstd_dicts
+
+    def zstd_dict(self, train=False):
+        """Return the zstd dictionary to compress with, or `None`
+
+        If there is no dictionary, yet, and `train` is set, a new dictionary
+        is trained on the objects of the database. If there are too few
+        objects to train on, no dictionary is used.
+        """
+
+        if self.zstd_dicts:
+            return self.zstd_dicts[max(self.zstd_dicts)]
+        if not train:
+            return None
+
+        zstandard = _zstandard()
+        samples = []
+        for _checksum, content in self.objects():
+            samples.append(content)
+            if len(samples) >= ZSTD_DICT_SAMPLES:
+                break
+        try:
+            zdict = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+        except zstandard.ZstdError:
+            return None
+
+        os.makedirs(self._path_state, exist_ok=True)
+        path = os.path.join(self._path_state, f"zstd-{zdict.dict_id()}.dict")
+        with tempfile.NamedTemporaryFile(dir=self._path_state, prefix=".tmp-", delete=False) as f:
+            f.write(zdict.as_bytes())
+        os.replace(f.name, path)
+
+        self._zstd_dicts = None
+        return self.zstd_dicts[zdict.dict_id()]
+
+    def decode(self, data):
+        """Decompress the stored content of an object"""
+
+        compression = compression_of(data)
+        if compression == "gzip":
+            return gzip.decompress(data)
+        if compression == "lzma":
+            return lzma.decompress(data)
+        if compression == "zstd":
+            zstandard = _zstandard()
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            zdict = self.zstd_dicts.get(dict_id) if dict_id else None
+            if dict_id and zdict is None:
+                raise ValueError(f"Missing zstd dictionary {dict_id}")
+            return zstandard.ZstdDecompressor(dict_data=zdict).decompressobj().decompress(data)
+        return data
+
+    def verify(self, digest, data):
+        """Check whether the stored content of an object matches its digest
+
+        `data` can be any buffer, like a memory-mapped file, which is hashed
+        without copying it, unless it is compressed. Content that cannot be
+        decompressed does not match.
+        """
+
+        compression = compression_of(data)
+        if compression is None:
+            return hashlib.sha256(data).digest() == digest
+
+        errors = (OSError, EOFError, ValueError, lzma.LZMAError)
+        if compression == "zstd":
+            errors += (_zstandard().ZstdError,)
+        try:
+            return hashlib.sha256(self.decode(bytes(data))).digest() == digest
+        except errors:
+            return False
+
+    def encode(self, data, compression):
+        """Compress the content of an object for storage"""
+
+        if compression == "gzip":
+            return gzip.compress(data, mtime=0)
+        if compression == "lzma":
+            return lzma.compress(data)
+        if compression == "zstd":
+            zstandard = _zstandard()
+            return zstandard.ZstdCompressor(level=19, dict_data=self.zstd_dict()).compress(data)
+        return data
+
+    @contextlib.contextmanager
+    def writer(self, stream, compression):
+        """Wrap a binary stream to compress all data written to it
+
+        The underlying stream is not closed when the context is left, but
+        all compressed data is flushed to it.
+        """
+
+        if compression == "gzip":
+            with gzip.GzipFile(filename="", fileobj=stream, mode="wb", mtime=0) as writer:
+                yield writer
+        elif compression == "lzma":
+            with lzma.LZMAFile(stream, mode="wb") as writer:
+                yield writer
+        elif compression == "zstd":
+            zstandard = _zstandard()
+            compressor = zstandard.ZstdCompressor(level=19, dict_data=self.zstd_dict())
+            with compressor.stream_writer(stream, closefd=False) as writer:
+                yield writer
+        else:
+            yield stream
+
+    def _recode(self, data, compression):
+        # Convert the stored content of an object to the given compression,
+        # unless it already uses it. `None` keeps the content as it is.
+        if compression is None or compression_of(data) == compression:
+            return data
+        return self.encode(self.decode(data), compression)
+
+    def _locate(self, checksum):
+        # Return a `(pack, path, offset, length)` tuple of an object, where
+        # `pack` is `None` for loose objects, or `None` if it is unknown.
+        digest = checksum_digest(checksum)
+        if digest is not None:
+            for pack in self.packs:
+                location = pack.find(digest)
+                if location is not None:
+                    return pack, pack.path + ".pack", location[0], location[1]
+
+        path = os.path.join(self._path_loose, checksum)
+        try:
+            return None, path, 0, os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+
+    def locate(self, checksum):
+        """Locate an object
+
+        Return a `(path, offset, length)` tuple of the file containing the
+        object, or `None` if the object does not exist.
+        """
+
+        location = self._locate(checksum)
+        if location is None:
+            self.reload()
+            location = self._locate(checksum)
+        if location is None:
+            return None
+
+        return location[1:]
+
+    def contains(self, checksum):
+        """Check whether an object exists"""
+
+        return self.locate(checksum) is not None
+
+    def read(self, checksum):
+        """Read the content of an object
+
+        The content is decompressed, if the object is stored compressed.
+        Raises `FileNotFoundError` if the object does not exist.
+        """
+
+        for _ in range(2):
+            location = self._locate(checksum)
+            if location is not None:
+                pack, path, offset, length = location
+                if pack is not None:
+                    return self.decode(pack.read(offset, length))
+                with contextlib.suppress(FileNotFoundError):
+                    with open(path, "rb") as stream:
+                        return self.decode(stream.read())
+            self.reload()
+
+        raise FileNotFoundError(errno.ENOENT, "No such object", checksum)
+
+    def view(self, checksum):
+        """Return a read-only buffer with the content of an object
+
+        If the object is stored uncompressed, the buffer is a view of the
+        memory-mapped pack or loose file, and nothing is copied. Otherwise,
+        the decompressed content is returned. Raises `FileNotFoundError` if
+        the object does not exist.
+        """
+
+        for _ in range(2):
+            location = self._locate(checksum)
+            if location is not None:
+                pack, path, offset, length = location
+                data = None
+                if pack is not None:
+                    data = pack.view(offset, length)
+                elif length == 0:
+                    data = memoryview(b"")
+                else:
+                    with contextlib.suppress(FileNotFoundError):
+                        with open(path, "rb") as stream:
+                            data = memoryview(
+                                mmap.mmap(stream.fileno(), 0, prot=mmap.PROT_READ)
+                            )
+                if data is not None:
+                    if compression_of(data) is None:
+                        return data
+                    return memoryview(self.decode(bytes(data)))
+            self.reload()
+
+        raise FileNotFoundError(errno.ENOENT, "No such object", checksum)
+
+    def loose(self):
+        """Iterate the checksums of all loose objects"""
+
+        with contextlib.suppress(FileNotFoundError), os.scandir(self._path_loose) as it:
+            for dirent in it:
+                if not dirent.name.startswith("."):
+                    yield dirent.name
+
+    def objects(self, raw=False):
+        """Iterate all objects as `(checksum, content)` tuples
+
+        Packed objects are yielded first, in pack order, followed by all
+        loose objects that are not packed. Each object is yielded once.
+        Reading all objects this way is mostly sequential I/O. The content
+        is decompressed, unless `raw` is set.
+        """
+
+        decode = (lambda data: data) if raw else self.decode
+
+        seen = set()
+        for pack in self.packs:
+            for digest, offset, length in pack.entries():
+                if digest not in seen:
+                    seen.add(digest)
+                    yield CHECKSUM_PREFIX + digest.hex(), decode(pack.read(offset, length))
+
+        for checksum in self.loose():
+            if checksum_digest(checksum) in seen:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                with open(os.path.join(self._path_loose, checksum), "rb") as stream:
+                    yield checksum, decode(stream.read())
+
+    def _write_pack(self, objects):
+        # Write a new pack with the given `(digest, content)` tuples, sorted
+        # by digest. The name of the pack is derived from its content, so a
+        # pack is never replaced by a different one of the same name.
+        # Returns the path of the pack, without suffix.
+        objects = sorted(objects, key=lambda o: o[0])
+        os.makedirs(self._path_packs, exist_ok=True)
+
+        entries = []
+        with tempfile.NamedTemporaryFile(dir=self._path_packs, prefix=".tmp-", delete=False) as f:
+            try:
+                pack_hash = hashlib.sha256(PACK_MAGIC)
+                f.write(PACK_MAGIC)
+                offset = len(PACK_MAGIC)
+                for digest, content in objects:
+                    pack_hash.update(content)
+                    f.write(content)
+                    entries.append((digest, offset, len(content)))
+                    offset += len(content)
+                f.flush()
+                os.fsync(f.fileno())
+                os.chmod(f.name, 0o644)
+                path = os.path.join(self._path_packs, "pack-" + pack_hash.hexdigest())
+                os.replace(f.name, path + ".pack")
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+        with tempfile.NamedTemporaryFile(dir=self._path_packs, prefix=".tmp-", delete=False) as f:
+            try:
+                f.write(IDX_HEADER.pack(IDX_MAGIC, len(entries)))
+                for entry in entries:
+                    f.write(IDX_ENTRY.pack(*entry))
+                f.flush()
+                os.fsync(f.fileno())
+                os.chmod(f.name, 0o644)
+                os.replace(f.name, path + ".idx")
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+        return path
+
+    @staticmethod
+    def _remove_pack(path):
+        # The index goes first, so the pack is never used without it.
+        for suffix in (".idx", ".pack"):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path + suffix)
+
+    def _collect_loose(self, objects, compression):
+        # Add all valid loose objects that are not packed to `objects`.
+        # Returns the list of loose objects that can be deleted once
+        # `objects` is packed, and the list of invalid loose objects.
+        loose = []
+        skipped = []
+
+        for checksum in self.loose():
+            digest = checksum_digest(checksum)
+            if digest is None:
+                continue
+            if digest in objects or any(p.find(digest) for p in self.packs):
+                loose.append(checksum)
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                with open(os.path.join(self._path_loose, checksum), "rb") as stream:
+                    content = stream.read()
+                if not self.verify(digest, content):
+                    skipped.append(checksum)
+                    continue
+                objects[digest] = self._recode(content, compression)
+                loose.append(checksum)
+
+        return loose, skipped
+
+    def repack(self, merge=False, compression=None):
+        """Migrate loose objects into a new pack
+
+        Pack all loose objects whose content matches their checksum, and
+        delete them afterwards. Loose objects that are already packed are
+        deleted as well. If `merge` is set, all existing packs are merged
+        into the new pack. If `compression` is set, all objects written to
+        the new pack are stored with this compression. Returns a `(packed,
+        skipped)` tuple with the number of packed objects and the list of
+        loose objects that were skipped, since their content does not match
+        their checksum.
+        """
+
+        objects = {}
+
+        if compression == "zstd":
+            self.zstd_dict(train=True)
+
+        old_packs = list(self.packs) if merge else []
+        for pack in old_packs:
+            for digest, offset, length in pack.entries():
+                objects[digest] = self._recode(pack.read(offset, length), compression)
+
+        loose, skipped = self._collect_loose(objects, compression)
+
+        if objects and (merge or len(loose) > 0):
+            path = self._write_pack(objects.items())
+            old_packs = [p for p in old_packs if p.path != path]
+        for pack in old_packs:
+            self._remove_pack(pack.path)
+        self.reload()
+
+        for checksum in loose:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(self._path_loose, checksum))
+
+        return len(objects), skipped
+
+    def _sweep_packs(self, keep, deadline, dry_run):
+        swept = []
+
+        for pack in list(self.packs):
+            if pack.mtime >= deadline:
+                continue
+            retained = []
+            removed = []
+            for digest, offset, length in pack.entries():
+                checksum = CHECKSUM_PREFIX + digest.hex()
+                if checksum in keep:
+                    retained.append((digest, pack.read(offset, length)))
+                else:
+                    removed.append((checksum, length))
+            if not removed:
+                continue
+            swept += removed
+            if not dry_run:
+                if retained:
+                    self._write_pack(retained)
+                self._remove_pack(pack.path)
+        self.reload()
+
+        return swept
+
+    def _sweep_loose(self, keep, deadline, dry_run):
+        swept = []
+
+        with contextlib.suppress(FileNotFoundError), os.scandir(self._path_loose) as it:
+            for dirent in it:
+                if dirent.name in keep or dirent.name.startswith("."):
+                    continue
+                try:
+                    info = dirent.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if info.st_mtime >= deadline:
+                    continue
+                if not dry_run:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(dirent.path)
+                swept.append((dirent.name, info.st_size))
+
+        return swept
+
+    def sweep(self, keep, deadline, dry_run=False):
+        """Delete all objects that are not in `keep`
+
+        Objects modified after `deadline` are retained. Packed objects
+        share the modification time of their pack. Packs with objects to
+        delete are rewritten without them. Returns a list of `(checksum,
+        size)` tuples of all deleted objects. Objects stored more than once,
+        packed and loose, are listed once with the size of all their copies.
+        """
+
+        swept = {}
+        for checksum, size in (
+                self._sweep_packs(keep, deadline, dry_run)
+                + self._sweep_loose(keep, deadline, dry_run)
+        ):
+            swept[checksum] = swept.get(checksum, 0) + size
+        return list(swept.items())
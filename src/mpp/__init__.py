@@ -1,7 +1,23 @@
 """OSBuild Manifest Pre-Processor"""
 
 
-from .mpp import Mpp
+from .mpp import (
+    Manifest,
+    Mpp,
+    MppBatch,
+    MppContext,
+    MppEngine,
+    preprocess,
+    register_processor,
+)
 
 
-__all__ = ["Mpp"]
+__all__ = [
+    "Manifest",
+    "Mpp",
+    "MppBatch",
+    "MppContext",
+    "MppEngine",
+    "preprocess",
+    "register_processor",
+]
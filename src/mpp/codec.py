@@ -0,0 +1,395 @@
+"""JSON Codecs
+
+This module provides the JSON codecs used to read and write manifests. All
+codecs produce the canonical form of a manifest, which is the output of
+`json.dump()` with an indentation of 2, followed by a newline. Objects are
+addressed by the checksum of their canonical form, so all codecs must
+produce identical output, byte for byte.
+
+The `json` codec uses the python standard library. The `orjson` codec uses
+the `orjson` module, if it is installed. Whenever its output could differ
+from the canonical form, for instance because a document contains floats or
+non-ASCII characters, it falls back to the standard library. Codecs are
+registered in `CODECS` and selected by name. By default, the fastest
+available codec is used.
+
+Furthermore, this module provides `JsonScanner`, which reads selected parts
+of a serialized document without decoding all of it.
+"""
+
+# pylint: disable=too-few-public-methods
+
+
+import collections.abc
+import json
+import re
+
+
+def _sequence(value):
+    # Encode read-only sequences, as used by compacted manifests, like
+    # lists. Strings and bytes are sequences as well, but are not arrays.
+    if isinstance(value, collections.abc.Sequence) and not isinstance(
+            value, (str, bytes, bytearray)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    """Standard Library Codec"""
+
+    name = "json"
+
+    # Size of the chunks `dump()` writes, in characters.
+    CHUNK_SIZE = 64 * 1024
+
+    @staticmethod
+    def available():
+        """Check whether the codec can be used"""
+        return True
+
+    def loads(self, data):
+        """Decode a document from a string or bytes"""
+
+        return json.loads(data)
+
+    def load(self, stream):
+        """Decode a document from a stream"""
+
+        return json.load(stream)
+
+    def dump(self, data, stream):
+        """Write the canonical form of a document to a text stream
+
+        The document is encoded incrementally and written in large chunks.
+        Return the number of characters written.
+        """
+
+        encoder = json.JSONEncoder(indent=2, default=_sequence)
+        chunks = []
+        size = 0
+        total = 1
+        for chunk in encoder.iterencode(data):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.CHUNK_SIZE:
+                stream.write("".join(chunks))
+                total += size
+                chunks = []
+                size = 0
+        chunks.append("\n")
+        stream.write("".join(chunks))
+        return total + size
+
+
+def _plain(data):
+    # Check whether a document only consists of values `orjson` encodes
+    # exactly like the standard library: strings, booleans, `None`, 64-bit
+    # integers, and lists, other sequences and dictionaries with string keys
+    # thereof. Floats are excluded, since their exponent notation differs.
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        kind = type(value)
+        if kind is str or kind is bool or value is None:
+            continue
+        if kind is dict:
+            for key in value:
+                if type(key) is not str:  # pylint: disable=unidiomatic-typecheck
+                    return False
+            stack.extend(value.values())
+        elif kind is list or kind is tuple:
+            stack.extend(value)
+        elif kind is int:
+            if not -2**63 <= value < 2**64:
+                return False
+        else:
+            try:
+                stack.extend(_sequence(value))
+            except TypeError:
+                return False
+    return True
+
+
+class OrjsonCodec(JsonCodec):
+    """Codec Using `orjson`"""
+
+    name = "orjson"
+
+    # Runs of digits long enough to be integers outside of the 64-bit range,
+    # which `orjson` silently decodes as floats. Digits in strings match as
+    # well, which merely costs the fallback.
+    _LONG_DIGITS = re.compile(r"[0-9]{19}")
+    _LONG_DIGITS_BYTES = re.compile(rb"[0-9]{19}")
+
+    @staticmethod
+    def available():
+        try:
+            # pylint: disable=import-outside-toplevel,unused-import
+            import orjson
+        except ImportError:
+            return False
+        return True
+
+    def loads(self, data):
+        # pylint: disable=import-outside-toplevel,no-member
+        import orjson
+
+        # Documents `orjson` rejects, but the standard library accepts, like
+        # `NaN`, are decoded by the standard library. It also raises the same
+        # errors for malformed documents. Huge integers are not rejected, but
+        # decoded as floats, so documents that might contain them are
+        # decoded by the standard library right away.
+        pattern = self._LONG_DIGITS if isinstance(data, str) else self._LONG_DIGITS_BYTES
+        if pattern.search(data) is not None:
+            return super().loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return super().loads(data)
+
+    def load(self, stream):
+        return self.loads(stream.read())
+
+    def dump(self, data, stream):
+        # pylint: disable=import-outside-toplevel,no-member
+        import orjson
+
+        if _plain(data):
+            output = orjson.dumps(data, default=_sequence, option=orjson.OPT_INDENT_2)
+
+            # The standard library escapes all characters outside of the
+            # printable ASCII range, `orjson` does not.
+            if output.isascii() and b"\x7f" not in output:
+                text = output.decode() + "\n"
+                stream.write(text)
+                return len(text)
+
+        return super().dump(data, stream)
+
+
+# Registry of all codecs, by name, in order of preference.
+CODECS = {
+    "orjson": OrjsonCodec,
+    "json": JsonCodec,
+}
+
+_DEFAULT = None
+
+
+def default():
+    """Return the default codec
+
+    Unless selected via `set_default()`, this is the first available codec
+    of `CODECS`.
+    """
+
+    # pylint: disable=global-statement
+    global _DEFAULT
+    if _DEFAULT is None:
+        _DEFAULT = next(cls() for cls in CODECS.values() if cls.available())
+    return _DEFAULT
+
+
+def set_default(name):
+    """Select the default codec by name"""
+
+    # pylint: disable=global-statement
+    global _DEFAULT
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+    if not CODECS[name].available():
+        raise ValueError(f"JSON codec not available: {name}")
+    _DEFAULT = CODECS[name]()
+
+
+class JsonScanner:
+    """Incremental JSON Reader
+
+    Reads selected parts of a serialized JSON document. The document is
+    scanned for the requested values, and everything else is skipped without
+    being decoded. Scanning stops as soon as everything requested was found.
+    Hence, if only a small part of a manifest is needed, like some of its
+    top-level keys or the names of its stages, this avoids building all of
+    the manifest in memory, and usually avoids reading most of it.
+
+    Parameters
+    ----------
+    data
+        The serialized document, either as string or as bytes-like object.
+        A memory-mapped object can be scanned without copying it.
+    """
+
+    _WS = re.compile(rb"[ \t\n\r]*")
+    _STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+    _SCALAR = re.compile(rb"[^,:\]}\s]*")
+    _PLAIN = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.DOTALL)
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._data = data
+        # End offsets of all values scanned so far, by start offset, so no
+        # value is ever scanned twice.
+        self._ends = {}
+
+    @staticmethod
+    def _error(pos):
+        raise ValueError(f"Malformed JSON document at offset {pos}")
+
+    def _ws(self, pos):
+        return self._WS.match(self._data, pos).end()
+
+    def _char(self, pos):
+        return self._data[pos:pos + 1]
+
+    def _string(self, pos):
+        match = self._STRING.match(self._data, pos)
+        if match is None:
+            self._error(pos)
+        return match.end()
+
+    def skip(self, pos):
+        """Return the end offset of the value at `pos`"""
+
+        pos = self._ws(pos)
+        end = self._ends.get(pos)
+        if end is not None:
+            return end
+
+        char = self._char(pos)
+        if char == b'"':
+            end = self._string(pos)
+        elif char in (b"[", b"{"):
+            end = self._skip_container(pos)
+        else:
+            end = self._SCALAR.match(self._data, pos).end()
+            if end == pos:
+                self._error(pos)
+
+        self._ends[pos] = end
+        return end
+
+    def _skip_container(self, pos):
+        # Skip over everything but brackets in one go, including strings
+        # that contain brackets, and track the nesting depth until the
+        # container is closed.
+        depth = 0
+        while True:
+            char = self._char(pos)
+            if char in (b"[", b"{"):
+                depth += 1
+                pos += 1
+            elif char in (b"]", b"}"):
+                depth -= 1
+                pos += 1
+                if depth == 0:
+                    return pos
+            else:
+                # Either the end of the document or an unterminated string.
+                self._error(pos)
+            pos = self._PLAIN.match(self._data, pos).end()
+
+    def decode(self, pos):
+        """Decode the value at `pos`"""
+
+        pos = self._ws(pos)
+        return json.loads(bytes(self._data[pos:self.skip(pos)]))
+
+    def _items(self, pos, opening, closing, keyed):
+        # Iterate the items of the container at `pos`. The value of an item
+        # is only skipped once the caller asks for the next item, so callers
+        # that stop early never scan the rest of the container.
+        start = self._ws(pos)
+        if self._char(start) != opening:
+            self._error(start)
+        pos = self._ws(start + 1)
+        if self._char(pos) != closing:
+            while True:
+                key = None
+                if keyed:
+                    end = self._string(pos)
+                    key = json.loads(bytes(self._data[pos:end]))
+                    pos = self._ws(end)
+                    if self._char(pos) != b":":
+                        self._error(pos)
+                    pos = self._ws(pos + 1)
+                yield key, pos
+                pos = self._ws(self.skip(pos))
+                char = self._char(pos)
+                if char == closing:
+                    break
+                if char != b",":
+                    self._error(pos)
+                pos = self._ws(pos + 1)
+        self._ends[start] = pos + 1
+
+    def members(self, pos=0):
+        """Iterate the members of the object at `pos`
+
+        Yield a `(key, offset)` tuple for every member, with the offset of
+        its value.
+        """
+
+        return self._items(pos, b"{", b"}", True)
+
+    def elements(self, pos=0):
+        """Iterate the elements of the array at `pos`
+
+        Yield the offset of every element.
+        """
+
+        return (offset for _key, offset in self._items(pos, b"[", b"]", False))
+
+    def find(self, key, pos=0):
+        """Return the offset of member `key` of the object at `pos`, or `None`"""
+
+        for itr, offset in self.members(pos):
+            if itr == key:
+                return offset
+        return None
+
+    def read_keys(self, keys, pos=0):
+        """Decode the given members of the object at `pos`
+
+        Return a dictionary with all of the given keys that are present.
+        """
+
+        keys = set(keys)
+        result = {}
+        for key, offset in self.members(pos):
+            if key in keys:
+                result[key] = self.decode(offset)
+                if len(result) == len(keys):
+                    break
+        return result
+
+    def _stage_names(self, pos):
+        # Collect the stage names of the pipeline at `pos` and all its build
+        # pipelines. Build pipelines are scanned as they are encountered, so
+        # skipping them afterwards is free.
+        names = []
+        builds = []
+        for key, offset in self.members(pos):
+            if key == "stages":
+                for stage in self.elements(offset):
+                    name = self.find("name", stage)
+                    names.append(None if name is None else self.decode(name))
+            elif key == "build":
+                pipeline = self.find("pipeline", offset)
+                if pipeline is not None:
+                    builds = self._stage_names(pipeline)
+                elif next(self.members(offset), None) is not None:
+                    builds = [[]]
+        return [names] + builds
+
+    def stage_names(self):
+        """Return the names of the stages of a manifest
+
+        Return a list with the names of the stages of every pipeline level
+        of the manifest, in the same order as `Manifest.levels`.
+        """
+
+        pipeline = self.find("pipeline")
+        if pipeline is None:
+            return [[]]
+        return self._stage_names(pipeline)
@@ -0,0 +1,229 @@
+"""Compact Manifest Representation
+
+Pre-processed manifests are dominated by a few kinds of values: package
+checksums, which appear in the package lists of stages and as keys of the
+URL sources, the URLs of those packages, and a handful of large values, like
+the PGP keys of a distribution, which are repeated in every `rpm` stage.
+Loading many manifests into memory thus stores the same strings over and
+over again.
+
+A `Compactor` converts decoded manifests into a compact representation,
+which shares all equal values across all manifests it converts:
+
+ * All strings, including dictionary keys, are interned in a table of the
+   compactor, so equal strings are stored once. This includes the URLs of
+   packages.
+
+ * Lists of strings are converted to tuples and shared as a whole, so, for
+   instance, equal lists of PGP keys are stored once.
+
+ * Optionally, lists of `sha256:` checksums are packed into a
+   `PackedDigestList`, which stores the raw digests in a single buffer and
+   provides a read-only view of the checksums.
+
+Compacted manifests are read-only. Dictionaries are never shared, so they
+can be modified, but all converted lists are immutable. Compacted documents
+are encoded by the codecs of `mpp.codec` exactly like the original, so
+compaction does not change the checksum of a manifest. `expand()` converts a
+compacted document back into a plain one.
+"""
+
+
+import collections.abc
+import re
+import sys
+
+from . import mpp
+
+
+class PackedDigestList(collections.abc.Sequence):
+    """Packed List of Checksums
+
+    A read-only sequence of `sha256:<hex>` checksum strings, which stores
+    only the raw digests, 32 bytes each, in a single buffer. Checksums are
+    created on access.
+
+    Parameters
+    ----------
+    checksums
+        An iterable of checksums, all of which must be valid lower-case
+        `sha256:` checksums, see `pack()`.
+    """
+
+    PREFIX = "sha256:"
+    DIGEST_SIZE = 32
+
+    _PATTERN = re.compile(r"sha256:[0-9a-f]{64}")
+
+    __slots__ = ("_buffer",)
+
+    def __init__(self, checksums):
+        self._buffer = b"".join(bytes.fromhex(c[len(self.PREFIX):]) for c in checksums)
+
+    @classmethod
+    def pack(cls, values):
+        """Pack a list of checksums, or return `None` if it contains others"""
+
+        for value in values:
+            if type(value) is not str or not cls._PATTERN.fullmatch(value):  # pylint: disable=unidiomatic-typecheck
+                return None
+        return cls(values)
+
+    def __len__(self):
+        return len(self._buffer) // self.DIGEST_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PackedDigestList index out of range")
+        offset = index * self.DIGEST_SIZE
+        return self.PREFIX + self._buffer[offset:offset + self.DIGEST_SIZE].hex()
+
+    def __iter__(self):
+        for offset in range(0, len(self._buffer), self.DIGEST_SIZE):
+            yield self.PREFIX + self._buffer[offset:offset + self.DIGEST_SIZE].hex()
+
+    def __contains__(self, value):
+        if type(value) is not str or not self._PATTERN.fullmatch(value):  # pylint: disable=unidiomatic-typecheck
+            return False
+        digest = bytes.fromhex(value[len(self.PREFIX):])
+        offset = self._buffer.find(digest)
+        while offset >= 0:
+            if offset % self.DIGEST_SIZE == 0:
+                return True
+            offset = self._buffer.find(digest, offset + 1)
+        return False
+
+    def __eq__(self, other):
+        if isinstance(other, PackedDigestList):
+            return self._buffer == other._buffer
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._buffer)
+
+    def __repr__(self):
+        return f"PackedDigestList({list(self)!r})"
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._buffer)
+
+
+class Compactor:
+    """Manifest Compactor
+
+    Converts manifests into their compact representation. All manifests
+    converted by the same compactor share their values. The tables of the
+    compactor keep all shared values alive for as long as the compactor
+    lives.
+
+    Parameters
+    ----------
+    pack_digests
+        Pack lists of checksums into `PackedDigestList` objects. A packed
+        checksum takes 32 bytes, while a shared string takes only a reference
+        of 8 bytes in its list. Hence, this only saves memory for checksums
+        that are not stored elsewhere. In pre-processed manifests, checksums
+        of packages are also keys of the URL sources, so they are shared
+        anyway.
+    """
+
+    def __init__(self, pack_digests=False):
+        self._pack_digests = pack_digests
+        self._strings = {}
+        self._tuples = {}
+
+    def intern(self, value):
+        """Return the shared instance of a string"""
+
+        return self._strings.setdefault(value, value)
+
+    def _list(self, values):
+        # Lists of strings are shared as a whole, everything else is
+        # converted element by element.
+        strings = True
+        for value in values:
+            if type(value) is not str:  # pylint: disable=unidiomatic-typecheck
+                strings = False
+                break
+
+        # Empty lists are kept as they are, since they are equal to the
+        # defaults `Manifest` strips.
+        if not strings or not values:
+            return [self.compact(value) for value in values]
+
+        if self._pack_digests:
+            packed = PackedDigestList.pack(values)
+            if packed is not None:
+                return self._tuples.setdefault(packed, packed)
+
+        shared = tuple(self.intern(value) for value in values)
+        return self._tuples.setdefault(shared, shared)
+
+    def compact(self, data):
+        """Return the compact representation of a decoded JSON document"""
+
+        kind = type(data)
+        if kind is str:
+            return self.intern(data)
+        if kind is dict:
+            return {self.intern(key): self.compact(value) for key, value in data.items()}
+        if kind is list:
+            return self._list(data)
+        return data
+
+    def manifest(self, manifest):
+        """Return a compacted copy of a manifest"""
+
+        return mpp.Manifest(self.compact(manifest.data))
+
+    @property
+    def stats(self):
+        """Number of shared strings and sequences"""
+        return {"strings": len(self._strings), "sequences": len(self._tuples)}
+
+
+def expand(data):
+    """Return a plain copy of a compacted JSON document
+
+    All dictionaries and lists are copied, and all sequences of a compacted
+    document are converted into lists, so the result can be modified freely.
+    For plain documents, this is equivalent to `json_copy()`.
+    """
+
+    if isinstance(data, dict):
+        return {key: expand(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple, PackedDigestList)):
+        return [expand(value) for value in data]
+    return data
+
+
+def footprint(*roots):
+    """Measure the memory footprint of JSON documents
+
+    Return the total size in bytes of all objects reachable from the given
+    documents. Objects shared among documents, or within a document, are
+    counted once. Interned objects of the interpreter, like small integers,
+    `None` or booleans, are counted as well.
+    """
+
+    seen = set()
+    total = 0
+    stack = list(roots)
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return total
@@ -0,0 +1,580 @@
+"""Dependency Solving Helpers
+
+This module provides the infrastructure used by the depsolve transformation of
+the pre-processor. It is independent of the manifest format.
+"""
+
+# pylint: disable=too-few-public-methods
+
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import tempfile
+import xml.etree.ElementTree
+
+from . import trace
+
+
+class DepsolveCache:
+    """Persistent Depsolve Result Cache
+
+    The cache stores results of dependency resolutions on disk. Entries are
+    content-addressed: the key of an entry is a hash over the normalized
+    request and the revision of the repository metadata it was solved
+    against. Hence, a lookup can never return stale data. If the repository
+    metadata changes, the old entries are simply no longer used and are
+    eventually evicted.
+
+    The total size of all entries is bounded. Whenever a new entry is stored,
+    the least recently used entries are evicted until the cache fits into its
+    size limit again.
+
+    Parameters
+    ----------
+    path
+        Path to the cache directory. It is created if it does not exist.
+    max_size
+        Maximum total size of all entries in bytes.
+    """
+
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+    SUFFIX = ".json"
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self._path = path
+        self._max_size = max_size
+
+        os.makedirs(self._path, exist_ok=True)
+
+    @staticmethod
+    def normalize(options):
+        """Normalize a depsolve request
+
+        Reduce the options of a depsolve request to the values that affect
+        the result of the resolution. The order of packages is retained,
+        since it can affect the order of the resolved transaction.
+        """
+
+        return {
+            "architecture": str(options["architecture"]),
+            "fedora": str(options["fedora"]),
+            "packages": [str(p) for p in options.get("packages", [])],
+        }
+
+    @staticmethod
+    def key(request, revision):
+        """Compute the cache key of a request
+
+        Parameters
+        ----------
+        request
+            The normalized request, as returned by `normalize()`.
+        revision
+            A JSON-serializable value identifying the revision of the
+            repository metadata the request is solved against.
+        """
+
+        data = json.dumps(
+            {"request": request, "revision": revision},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, key + self.SUFFIX)
+
+    def lookup(self, key):
+        """Look up the resolved dependencies of a request, or `None`"""
+
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as stream:
+                entry = json.load(stream)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        # Mark the entry as recently used, for eviction purposes.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return entry["dependencies"]
+
+    def store(self, key, request, revision, dependencies):
+        """Store the resolved dependencies of a request"""
+
+        entry = {
+            "request": request,
+            "revision": revision,
+            "dependencies": dependencies,
+        }
+
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=self._path,
+                prefix=".tmp-",
+                delete=False,
+        ) as stream:
+            json.dump(entry, stream)
+        os.replace(stream.name, self._entry_path(key))
+
+        self.evict(self._max_size)
+
+    def entries(self):
+        """List all cache entries
+
+        Return a list of all entries in the cache, ordered from least to
+        most recently used. Each entry is a dictionary with the key, size and
+        last-use time of the entry.
+        """
+
+        entries = []
+        with os.scandir(self._path) as it:
+            for dirent in it:
+                if not dirent.name.endswith(self.SUFFIX) or dirent.name.startswith("."):
+                    continue
+                try:
+                    info = dirent.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append({
+                    "key": dirent.name[:-len(self.SUFFIX)],
+                    "size": info.st_size,
+                    "mtime": info.st_mtime,
+                })
+
+        entries.sort(key=lambda e: (e["mtime"], e["key"]))
+        return entries
+
+    def evict(self, max_size):
+        """Evict least recently used entries until the cache fits `max_size`
+
+        Returns the number of bytes reclaimed.
+        """
+
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        reclaimed = 0
+
+        for entry in entries:
+            if total <= max_size:
+                break
+            try:
+                os.unlink(self._entry_path(entry["key"]))
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            reclaimed += entry["size"]
+
+        return reclaimed
+
+    def purge(self):
+        """Drop all entries and return the number of bytes reclaimed"""
+
+        return self.evict(0)
+
+
+class DepsolveBackend:
+    """Dependency Solver Backend
+
+    A backend resolves depsolve requests of the pre-processor. This class
+    defines the interface every backend must implement. Backends are
+    registered in `BACKENDS` and selected by name.
+
+    Parameters
+    ----------
+    path_cache
+        Path to the cache directory of the pre-processor.
+    cache
+        The `DepsolveCache` to look up and store results in.
+    path_snapshot
+        Path to a local repository snapshot, if the backend uses one.
+    """
+
+    # Whether resolving is expensive enough to resolve the requests of
+    # different sessions concurrently, in worker processes, see
+    # `DepsolvePool`.
+    CONCURRENT = False
+
+    def __init__(self, *, path_cache, cache, path_snapshot=None):
+        self._path_cache = path_cache
+        self._cache = cache
+        self._path_snapshot = path_snapshot
+
+    def session_key(self, options):
+        """Compute the session key of a depsolve request
+
+        Requests with the same session key are resolved against the same
+        repository metadata, so a backend can share state among them. The
+        pre-processor resolves all requests of a session in one batch.
+        """
+
+        raise NotImplementedError()
+
+    def revision(self, options):
+        """Identify the revision of the repository metadata of a request
+
+        Return a JSON-serializable value that changes whenever the result
+        of the request could change, without resolving it. By default, the
+        backend does not depend on any repository metadata and `None` is
+        returned.
+        """
+
+        # pylint: disable=unused-argument
+        return None
+
+    def resolve(self, options):
+        """Resolve a depsolve request
+
+        Resolve the packages of the depsolve request given as `options` and
+        return the list of packages to install. Each entry is a dictionary
+        with the `checksum`, `name` and relative `path` of the package.
+        """
+
+        raise NotImplementedError()
+
+
+class DnfDepsolver(DepsolveBackend):
+    """Dnf Based Dependency Solver
+
+    The solver resolves depsolve requests via dnf. Which repositories are used
+    is defined by sub-classes. Loading the repository metadata into a dnf
+    sack is expensive, so the solver keeps one loaded sack for every
+    combination of fedora release, architecture and set of repositories it
+    encountered, and reuses it for all further requests of the same
+    combination. Only the goal is reset between requests, so results do not
+    depend on previous requests.
+
+    Before the metadata is loaded into a sack, the depsolve cache is
+    consulted. If the request was solved against the same metadata revision
+    before, the sack is not loaded at all.
+
+    Dnf caches are created in sub-directories of the cache directory.
+
+    Solving holds the GIL, so requests of different sessions are resolved
+    concurrently in worker processes, each with a solver of its own.
+    """
+
+    CONCURRENT = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self._path_dnfcache = os.path.join(self._path_cache, "dnf-cache")
+        self._path_dnfpersist = os.path.join(self._path_cache, "dnf-persist")
+        self._sessions = {}
+
+        os.makedirs(self._path_dnfcache, exist_ok=True)
+        os.makedirs(self._path_dnfpersist, exist_ok=True)
+
+    def _repos(self, options):
+        """List the repositories to solve a request against
+
+        Return a list of `(id, attribute, url)` tuples, where `attribute` is
+        either `metalink` or `baseurl`.
+        """
+
+        raise NotImplementedError()
+
+    def _revision(self, session, options):
+        """Identify the revision of the repository metadata of a session
+
+        By default, the repository metadata is loaded via dnf, but not yet
+        parsed into a sack, and dnf is asked for its revision.
+        """
+
+        base = self._base(session, options)
+
+        revisions = []
+        for repo in base.repos.iter_enabled():
+            repo.load()
+            # pylint: disable=protected-access
+            revisions.append([
+                repo.id,
+                repo._repo.getRevision(),
+                repo._repo.getMaxTimestamp(),
+            ])
+        return revisions
+
+    def session_key(self, options):
+        return (
+            str(options["fedora"]),
+            str(options["architecture"]),
+            tuple(self._repos(options)),
+        )
+
+    def _session(self, options):
+        key = self.session_key(options)
+        session = self._sessions.get(key)
+        if session is None:
+            session = {
+                "base": None,
+                "filled": False,
+                "revision": None,
+            }
+            self._sessions[key] = session
+        return session
+
+    def _base(self, session, options):
+        # pylint: disable=import-outside-toplevel,no-member
+        import dnf
+
+        if session["base"] is not None:
+            return session["base"]
+
+        opt_architecture = str(options["architecture"])
+        opt_fedora = str(options["fedora"])
+
+        base = dnf.Base()
+        base.conf.cachedir = self._path_dnfcache
+        base.conf.config_file_path = "/dev/null"
+        base.conf.module_platform_id = "f" + opt_fedora
+        base.conf.persistdir = self._path_dnfpersist
+        base.conf.substitutions["arch"] = opt_architecture
+        base.conf.substitutions["basearch"] = str(dnf.rpm.basearch(opt_architecture))
+        base.conf.substitutions["repo"] = "fedora-" + opt_fedora
+
+        for repo_id, repo_attribute, repo_url in self._repos(options):
+            repo = dnf.repo.Repo(repo_id, base.conf)
+            if repo_attribute == "metalink":
+                repo.metalink = repo_url
+            else:
+                repo.baseurl = [repo_url]
+            base.repos.add(repo)
+
+        session["base"] = base
+        return base
+
+    def revision(self, options):
+        session = self._session(options)
+        if session["revision"] is None:
+            with trace.span("depsolve.revision", fedora=str(options["fedora"])):
+                session["revision"] = self._revision(session, options)
+        return session["revision"]
+
+    def resolve(self, options):
+        # Fetch options early to have a uniform error location in case one
+        # is not provided by the manifest.
+        request = self._cache.normalize(options)
+        if len(request["packages"]) == 0:
+            return []
+
+        self.revision(options)
+        return self._resolve(self._session(options), options, request)
+
+    def _resolve(self, session, options, request):
+        # Check whether the same request was solved against the same
+        # repository metadata before. If it was, we reuse its result.
+        key = self._cache.key(request, session["revision"])
+        deps = self._cache.lookup(key)
+        if deps is not None:
+            trace.counter("depsolve.cache_hits")
+            return deps
+        trace.counter("depsolve.cache_misses")
+
+        # pylint: disable=import-outside-toplevel,no-member
+        import dnf
+        # pylint: disable=import-outside-toplevel,no-member
+        import hawkey
+
+        base = self._base(session, options)
+        if not session["filled"]:
+            with trace.span("depsolve.fill_sack", fedora=request["fedora"]):
+                base.fill_sack(load_system_repo=False)
+            session["filled"] = True
+
+        # Start from a clean goal, so previous requests on this sack do not
+        # affect the result.
+        base.reset(goal=True)
+        try:
+            with trace.span("depsolve.resolve", packages=len(request["packages"])):
+                base.install_specs(request["packages"])
+                base.resolve()
+
+            deps = []
+            for tsi in base.transaction:
+                if tsi.action not in dnf.transaction.FORWARD_ACTIONS:
+                    continue
+
+                checksum_type = hawkey.chksum_name(tsi.pkg.chksum[0])
+                checksum_hex = tsi.pkg.chksum[1].hex()
+                pkg = {
+                    "checksum": f"{checksum_type}:{checksum_hex}",
+                    "name": tsi.pkg.name,
+                    "path": tsi.pkg.relativepath,
+                }
+                deps.append(pkg)
+        finally:
+            base.reset(goal=True)
+
+        self._cache.store(key, request, session["revision"], deps)
+        return deps
+
+
+class DnfMetalinkDepsolver(DnfDepsolver):
+    """Dnf Based Dependency Solver Using Fedora Mirrors
+
+    This solver resolves requests against the official Fedora repositories,
+    located via the Fedora metalink service. It requires network access.
+    """
+
+    METALINK = "https://mirrors.fedoraproject.org/metalink?repo=$repo&arch=$basearch"
+
+    def _repos(self, options):
+        return [("default", "metalink", self.METALINK)]
+
+
+class DnfSnapshotDepsolver(DnfDepsolver):
+    """Dnf Based Dependency Solver Using Local Repository Snapshots
+
+    This solver resolves requests against repository metadata snapshots in a
+    local directory, without any network access. The snapshot for a request
+    is expected at `<snapshot>/fedora-<fedora>/<architecture>/` and must
+    contain the `repodata` directory of the repository.
+
+    The revision of a snapshot is read from its `repomd.xml` without
+    involving dnf. Hence, requests that hit the depsolve cache do not load
+    any metadata at all.
+    """
+
+    REPOMD_NS = "{http://linux.duke.edu/metadata/repo}"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        if self._path_snapshot is None:
+            raise ValueError("No repository snapshot specified")
+
+    def _path_repo(self, options):
+        return os.path.join(
+            self._path_snapshot,
+            "fedora-" + str(options["fedora"]),
+            str(options["architecture"]),
+        )
+
+    def _repos(self, options):
+        path = os.path.abspath(self._path_repo(options))
+        return [("default", "baseurl", "file://" + path)]
+
+    def _revision(self, session, options):
+        path = os.path.join(self._path_repo(options), "repodata", "repomd.xml")
+        try:
+            with open(path, "rb") as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            raise ValueError(f"No repository snapshot at {path}") from None
+
+        repomd = xml.etree.ElementTree.fromstring(data)
+        revision = repomd.findtext(self.REPOMD_NS + "revision")
+        return [["default", revision, hashlib.sha256(data).hexdigest()]]
+
+
+def request_key(options):
+    """Identify a depsolve request, for deduplication and lookup of results"""
+
+    return json.dumps(options, sort_keys=True)
+
+
+def resolve_all(backend, requests):
+    """Resolve depsolve requests with a single backend
+
+    Requests are resolved one after another, identical requests only once.
+    Return a dictionary of all results, keyed by `request_key()`.
+    """
+
+    results = {}
+    for options in requests:
+        key = request_key(options)
+        if key not in results:
+            results[key] = backend.resolve(options)
+    return results
+
+
+# The backend of the current depsolve worker process.
+_WORKER_BACKEND = None
+
+
+def _worker_init(backend, kwargs, tracing):
+    # pylint: disable=global-statement
+    global _WORKER_BACKEND
+
+    if tracing:
+        trace.enable("depsolve")
+    else:
+        trace.disable()
+    _WORKER_BACKEND = backend(**kwargs)
+
+
+def _worker_resolve(requests):
+    with trace.span("depsolve.group", requests=len(requests)):
+        results = resolve_all(_WORKER_BACKEND, requests)
+    return results, trace.take_events()
+
+
+class DepsolvePool:
+    """Pool of Depsolve Worker Processes
+
+    Resolves groups of depsolve requests concurrently, every group in a
+    worker process. Each worker creates a backend of its own on start-up
+    and keeps it, including all its sessions, until the pool is closed.
+    Hence, repository metadata a worker loaded is reused for all further
+    groups it resolves.
+
+    Parameters
+    ----------
+    backend
+        The backend class, see `BACKENDS`.
+    jobs
+        Maximum number of worker processes.
+    kwargs
+        Arguments to create the backend of every worker with.
+    """
+
+    def __init__(self, backend, jobs, **kwargs):
+        self._backend = backend
+        self._jobs = jobs
+        self._kwargs = kwargs
+        self._executor = None
+
+    def resolve(self, groups):
+        """Resolve groups of depsolve requests concurrently
+
+        Each group is a list of requests, which are resolved one after
+        another by the same worker. Return a dictionary of the results of
+        all groups, keyed by `request_key()`. Events traced by the workers
+        are merged into the trace of the current process.
+        """
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._jobs,
+                initializer=_worker_init,
+                initargs=(self._backend, self._kwargs, trace.enabled()),
+            )
+
+        jobs = [self._executor.submit(_worker_resolve, group) for group in groups]
+        results = {}
+        for job in jobs:
+            group_results, events = job.result()
+            results.update(group_results)
+            trace.add_events(events)
+        return results
+
+    def close(self):
+        """Stop all worker processes"""
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Registry of all available depsolve backends, by name.
+BACKENDS = {
+    "metalink": DnfMetalinkDepsolver,
+    "snapshot": DnfSnapshotDepsolver,
+}
@@ -11,7 +11,7 @@ manifest versions to newer ones, but also annotated converters that replace
 special annotations with generated content.
 """
 
-# pylint: disable=invalid-name,too-few-public-methods
+# pylint: disable=invalid-name,too-few-public-methods,too-many-lines
 
 
 import argparse
@@ -22,6 +22,10 @@ import os
 import sys
 import tempfile
 
+from . import codec
+from . import depsolve
+from . import trace
+
 
 def dict_enter(dct, key, default):
     """Access dictionary entry with a default value"""
@@ -50,6 +54,21 @@ def dict_contains_only(dct, allowed, allow_mpp=True):
     return True
 
 
+def json_copy(data):
+    """Copy a JSON document
+
+    Create a copy of a decoded JSON document. All dictionaries and lists are
+    copied, while all other values are immutable and thus shared with the
+    original. This is significantly faster than `copy.deepcopy()`.
+    """
+
+    if isinstance(data, dict):
+        return {key: json_copy(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [json_copy(value) for value in data]
+    return data
+
+
 class Manifest:
     """OSBuild Manifest"""
 
@@ -69,9 +88,23 @@ class Manifest:
         self.refresh()
 
     def _strip(self):
-        # Create a copy of the entire manifest so we can modify it without
-        # disrupting the cached links.
-        manifest = copy.deepcopy(self.data)
+        # Create a copy of all containers on the linked paths, so we can
+        # modify them without disrupting the cached links. Only these
+        # containers are ever modified, so everything else is shared with the
+        # original manifest.
+        manifest = dict(self.data)
+        copied = set()
+        for info in self._linkinfo:
+            itr = manifest
+            for step in info["path"][:-1]:
+                value = itr.get(step)
+                if not isinstance(value, dict):
+                    break
+                if id(value) not in copied:
+                    value = dict(value)
+                    copied.add(id(value))
+                    itr[step] = value
+                itr = value
 
         # Iterate the link-info array in reverse order and
         # drop every cached entry if it matches its default value. This keeps
@@ -92,25 +125,55 @@ class Manifest:
         """Create a new manifest from a stream"""
 
         try:
-            data = json.load(stream)
+            with trace.span("Manifest.from_stream"):
+                data = codec.default().load(stream)
         except json.JSONDecodeError:
             print("Cannot JSON-decode input", file=sys.stderr)
             raise
 
         return cls(data)
 
+    def to_data(self):
+        """Return the manifest as written by `to_stream()`
+
+        The result shares all values with the manifest, except for the
+        containers `to_stream()` strips defaults from.
+        """
+
+        return self._strip()
+
     def to_stream(self, stream):
-        """Write the manifest to a stream"""
+        """Write the manifest to a stream
+
+        The manifest is written in its canonical form by the default codec.
+        The output is identical to `json.dump()` with an indentation of 2,
+        followed by a newline, regardless of the codec.
+        """
 
         try:
-            json.dump(self._strip(), stream, indent=2)
-            print(end="\n", file=stream)
+            with trace.span("Manifest.to_stream"):
+                total = codec.default().dump(self.to_data(), stream)
+            trace.counter("mpp.chars_written", total)
         except TypeError:
             print("Cannot JSON-encode manifest", file=sys.stderr)
             raise
 
-    def refresh(self):
-        """Refresh cached links"""
+    def refresh(self, start=0):
+        """Refresh cached links
+
+        Re-create the cached links of the manifest. If `start` is non-zero,
+        only the pipeline levels starting at index `start` are re-created. All
+        other links are assumed to be still valid. This is suitable when a
+        transformation only modified a pipeline at level `start` or below.
+        """
+
+        with trace.span("Manifest.refresh", start=start):
+            self._refresh(start)
+
+    def _refresh(self, start):
+        if start > 0:
+            self._refresh_levels(start)
+            return
 
         self.levels = []
         self.links = {}
@@ -128,23 +191,37 @@ class Manifest:
                 itr = itr[step]
             self.links[info["link"]] = dict_enter(itr, info["path"][-1], copy.copy(info["default"]))
 
+        # Some sanity tests to verify the manifest does not contain entries
+        # that we do not know about.
+        dict_contains_only(self.data, ["pipeline", "sources"])
+        dict_contains_only(self.links["pipeline"], ["build", "stages"])
+        dict_contains_only(self.links["sources"], ["org.osbuild.files"])
+        dict_contains_only(self.links["files"], ["urls"])
+
+        self._refresh_levels(0)
+
+    def _refresh_levels(self, start):
         # To simplify recursive operations on the manifest, we collect all
         # pipelines as links. This allows iterating a plain array to access
-        # all pipelines in a manifest.
-        itr = self.data
+        # all pipelines in a manifest. Only levels from `start` onwards are
+        # collected again.
+        if start == 0:
+            itr = self.data
+        else:
+            itr = self.levels[start - 1].get("pipeline")
+            if itr:
+                itr = itr.get("build")
+        del self.levels[start:]
+
         while itr:
             self.levels.append(itr)
             itr = itr.get("pipeline")
             if itr:
                 itr = itr.get("build")
 
-        # Some sanity tests to verify the manifest does not contain entries
-        # that we do not know about.
-        dict_contains_only(self.data, ["pipeline", "sources"])
-        dict_contains_only(self.links["pipeline"], ["build", "stages"])
-        dict_contains_only(self.links["sources"], ["org.osbuild.files"])
-        dict_contains_only(self.links["files"], ["urls"])
-        for itr in self.levels:
+        # Some sanity tests to verify the levels do not contain entries that
+        # we do not know about.
+        for itr in self.levels[start:]:
             if itr != self.data:
                 dict_contains_only(itr, ["pipeline", "runner"])
             dict_contains_only(itr.get("pipeline", {}), ["build", "stages"])
@@ -165,125 +242,177 @@ class Manifest:
                 raise ValueError("Unknown source type")
 
 
+class ImportCache:
+    """Cache of Imported Manifests
+
+    The import cache parses every imported manifest only once and hands out
+    copies of the parsed document to each importer. Only containers are
+    copied, all strings are shared, so importers can modify their copy
+    freely. Entries are keyed by the resolved path of the file and validated
+    against its inode, size and modification time on every use, so a
+    changed file is parsed again.
+
+    The cache also detects import cycles. Before a manifest is handed out,
+    all its imports are followed transitively, and an error is raised if any
+    of them refers back to a manifest on the current import chain.
+
+    Parameters
+    ----------
+    path_cwd
+        Path to resolve relative import paths against.
+    """
+
+    def __init__(self, path_cwd):
+        self._path_cwd = path_cwd
+        self._entries = {}
+
+    @staticmethod
+    def _references(data):
+        # Collect all import annotations of a manifest, following the same
+        # structure as `Manifest.levels`.
+        refs = []
+        itr = data
+        while isinstance(itr, dict):
+            if "mpp-pipeline-import" in itr:
+                refs.append(itr["mpp-pipeline-import"])
+            itr = itr.get("pipeline")
+            if not isinstance(itr, dict):
+                break
+            if "mpp-pipeline-base" in itr:
+                refs.append(itr["mpp-pipeline-base"])
+            itr = itr.get("build")
+        return refs
+
+    def _entry(self, path):
+        path = os.path.realpath(os.path.join(self._path_cwd, path))
+        info = os.stat(path)
+        stamp = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+        entry = self._entries.get(path)
+        if entry is None or entry["stamp"] != stamp:
+            with open(path, "r", encoding="utf-8") as stream:
+                try:
+                    data = codec.default().load(stream)
+                except json.JSONDecodeError:
+                    print("Cannot JSON-decode input", file=sys.stderr)
+                    raise
+            entry = {
+                "path": path,
+                "stamp": stamp,
+                "data": data,
+                "references": self._references(data),
+                "acyclic": False,
+            }
+            self._entries[path] = entry
+
+            # The new content might close a cycle through manifests that
+            # were checked before, so all of them have to be checked again.
+            for itr in self._entries.values():
+                itr["acyclic"] = False
+
+        return entry
+
+    def _check(self, entry, chain):
+        if entry["acyclic"]:
+            return
+
+        chain.append(entry["path"])
+        for ref in entry["references"]:
+            sub = self._entry(ref)
+            if sub["path"] in chain:
+                cycle = chain[chain.index(sub["path"]):] + [sub["path"]]
+                raise ValueError("Import cycle: " + " -> ".join(cycle))
+            self._check(sub, chain)
+        chain.pop()
+
+        entry["acyclic"] = True
+
+    def load(self, path):
+        """Import a manifest
+
+        Return a new `Manifest` object with a private copy of the manifest
+        at `path`. Relative paths are resolved against the current working
+        directory of the cache.
+        """
+
+        entry = self._entry(path)
+        self._check(entry, [])
+        return Manifest(json_copy(entry["data"]))
+
+
 class MppDepsolve:
     """Dependency Solving Transformation"""
 
     def __init__(self, mpp):
         self._mpp = mpp
         self._manifest = mpp.manifest
-        self._path_dnfcache = None
-        self._path_dnfpersist = None
 
-    def _collect(self):
-        # Create dnf-caches.
-        self._path_dnfcache = os.path.join(self._mpp.path_cache, "dnf-cache")
-        os.makedirs(self._path_dnfcache, exist_ok=True)
-        self._path_dnfpersist = os.path.join(self._mpp.path_cache, "dnf-persist")
-        os.makedirs(self._path_dnfpersist, exist_ok=True)
+    # pylint: disable=no-self-use
+    def collect(self, level):
+        """Collect all pending annotations of a pipeline level"""
 
-        # Collect all stages of interest.
         todos = []
-        for itr in self._manifest.levels:
-            for stage in itr.get("pipeline", {}).get("stages", []):
-                if stage.get("name") != "org.osbuild.rpm":
-                    continue
-                if "mpp-depsolve" not in stage.get("options", {}):
-                    continue
-                todos.append(stage)
+        for stage in level.get("pipeline", {}).get("stages", []):
+            if stage.get("name") != "org.osbuild.rpm":
+                continue
+            if "mpp-depsolve" not in stage.get("options", {}):
+                continue
+            todos.append(stage)
 
         return todos
 
-    def _process_one(self, todo):
-        todo_options = todo["options"]
-        todo_mpp = todo_options["mpp-depsolve"]
-        todo_baseurl = todo_mpp["baseurl"]
-
-        # Resolve dependencies.
-        deps = self._dnf_resolve(
-            options=todo_mpp,
-            path_cache=self._path_dnfcache,
-            path_persist=self._path_dnfpersist,
-        )
+    def _resolve(self, todos):
+        depsolver = self._mpp.depsolver
 
-        # Append all packages to the RPM-pkg-list.
+        # Group all requests by the repository metadata they are solved
+        # against, so every session of the depsolver is used for all its
+        # requests in one go.
+        groups = {}
+        for todo in todos:
+            todo_mpp = todo["options"]["mpp-depsolve"]
+            groups.setdefault(depsolver.session_key(todo_mpp), []).append(todo_mpp)
+
+        # Distinct groups are resolved concurrently by the worker processes
+        # of the engine, if the backend benefits from it. A single group is
+        # resolved right here, to keep its session in this process.
+        pool = self._mpp.depsolve_pool
+        if pool is not None and len(groups) > 1:
+            return pool.resolve(list(groups.values()))
+
+        results = {}
+        for group in groups.values():
+            results.update(depsolve.resolve_all(depsolver, group))
+        return results
+
+    def process(self, todos):
+        """Run pipeline processor
+
+        Resolve all collected depsolve annotations. This only modifies stage
+        options and sources, never the structure of the manifest, so no
+        level has to be refreshed and `None` is returned.
+        """
+
+        todos = [todo for _, todo in todos]
+        results = self._resolve(todos)
+
+        # Append all packages to the RPM-pkg-lists, in the order the stages
+        # were collected, and collect all new URLs.
         urls = {}
-        for dep in deps:
-            dict_enter(todo_options, "packages", []).append(dep["checksum"])
-            urls[dep["checksum"]] = todo_baseurl + "/" + dep["path"]
-
-        # Update sources with the new URLs.
-        self._manifest.update_urls(urls)
-
-        del todo_options["mpp-depsolve"]
-
-    def process(self):
-        """Run pipeline processor"""
-
-        todos = self._collect()
         for todo in todos:
-            self._process_one(todo)
-        return len(todos) > 0
-
-    # pylint: disable=too-many-locals
-    @staticmethod
-    def _dnf_resolve(*, options, path_cache, path_persist):
-
-        # pylint: disable=import-outside-toplevel,no-member
-        import dnf
-        # pylint: disable=import-outside-toplevel,no-member
-        import hawkey
-
-        # Fetch options early to have a uniform error location in case one
-        # is not provided by the manifest.
-        opt_architecture = options["architecture"]
-        opt_fedora = options["fedora"]
-        opt_packages = options.get("packages", [])
-
-        def _dnf_repo(conf, repo_id, repo_metalink):
-            repo = dnf.repo.Repo(repo_id, conf)
-            repo.metalink = repo_metalink
-            return repo
-
-        def _dnf_base():
-            base = dnf.Base()
-            base.conf.cachedir = path_cache
-            base.conf.config_file_path = "/dev/null"
-            base.conf.module_platform_id = "f" + str(opt_fedora)
-            base.conf.persistdir = path_persist
-            base.conf.substitutions["arch"] = str(opt_architecture)
-            base.conf.substitutions["basearch"] = str(dnf.rpm.basearch(opt_architecture))
-            base.conf.substitutions["repo"] = "fedora-" + str(opt_fedora)
-
-            base.repos.add(
-                _dnf_repo(
-                    base.conf,
-                    "default",
-                    "https://mirrors.fedoraproject.org/metalink?repo=$repo&arch=$basearch",
-                )
-            )
-
-            base.fill_sack(load_system_repo=False)
-            return base
+            todo_options = todo["options"]
+            todo_mpp = todo_options["mpp-depsolve"]
+            todo_baseurl = todo_mpp["baseurl"]
 
-        deps = []
-        if len(opt_packages) > 0:
-            base = _dnf_base()
-            base.install_specs(opt_packages)
-            base.resolve()
+            deps = results[depsolve.request_key(todo_mpp)]
+            for dep in deps:
+                dict_enter(todo_options, "packages", []).append(dep["checksum"])
+                urls[dep["checksum"]] = todo_baseurl + "/" + dep["path"]
 
-            for tsi in base.transaction:
-                if tsi.action not in dnf.transaction.FORWARD_ACTIONS:
-                    continue
+            del todo_options["mpp-depsolve"]
+            self._mpp.add_platform(todo_mpp["fedora"], todo_mpp["architecture"])
 
-                checksum_type = hawkey.chksum_name(tsi.pkg.chksum[0])
-                checksum_hex = tsi.pkg.chksum[1].hex()
-                pkg = {
-                    "checksum": f"{checksum_type}:{checksum_hex}",
-                    "name": tsi.pkg.name,
-                    "path": tsi.pkg.relativepath,
-                }
-                deps.append(pkg)
-        return deps
+        # Update sources with the new URLs in one go.
+        self._manifest.update_urls(urls)
 
 
 class MppPipelineBase:
@@ -293,19 +422,19 @@ class MppPipelineBase:
         self._mpp = mpp
         self._manifest = mpp.manifest
 
-    def _collect(self):
-        todos = []
-        for itr in self._manifest.levels:
-            if "mpp-pipeline-base" in itr.get("pipeline", {}):
-                todos.append(itr["pipeline"])
-        return todos
+    # pylint: disable=no-self-use
+    def collect(self, level):
+        """Collect all pending annotations of a pipeline level"""
+
+        if "mpp-pipeline-base" in level.get("pipeline", {}):
+            return [level["pipeline"]]
+        return []
 
     def _process_one(self, todo):
         todo_mpp = todo["mpp-pipeline-base"]
 
         # Import the specified manifest.
-        with open(os.path.join(self._mpp.path_cwd, todo_mpp), "r") as stream:
-            imp = Manifest.from_stream(stream)
+        imp = self._mpp.import_manifest(todo_mpp)
 
         # Bail out if there are build-pipeline conflicts.
         if todo.get("build") and imp.data.get("build"):
@@ -326,13 +455,17 @@ class MppPipelineBase:
         # Drop MPP annotation.
         del todo["mpp-pipeline-base"]
 
-    def process(self):
-        """Run pipeline processor"""
+    def process(self, todos):
+        """Run pipeline processor
 
-        todos = self._collect()
-        for todo in todos:
+        Process all collected annotations. This modifies the pipelines of
+        the levels they were collected from, so the lowest of these levels
+        is returned.
+        """
+
+        for _, todo in todos:
             self._process_one(todo)
-        return len(todos) > 0
+        return min(index for index, _ in todos)
 
 
 class MppPipelineImport:
@@ -342,19 +475,19 @@ class MppPipelineImport:
         self._mpp = mpp
         self._manifest = mpp.manifest
 
-    def _collect(self):
-        todos = []
-        for itr in self._manifest.levels:
-            if "mpp-pipeline-import" in itr:
-                todos.append(itr)
-        return todos
+    # pylint: disable=no-self-use
+    def collect(self, level):
+        """Collect all pending annotations of a pipeline level"""
+
+        if "mpp-pipeline-import" in level:
+            return [level]
+        return []
 
     def _process_one(self, todo):
         todo_mpp = todo["mpp-pipeline-import"]
 
         # Import the specified manifest.
-        with open(os.path.join(self._mpp.path_cwd, todo_mpp), "r") as stream:
-            imp = Manifest.from_stream(stream)
+        imp = self._mpp.import_manifest(todo_mpp)
 
         # Update sources with all sources from the import.
         self._manifest.update_sources(imp.links["sources"])
@@ -365,13 +498,508 @@ class MppPipelineImport:
         # Drop MPP annotation.
         del todo["mpp-pipeline-import"]
 
-    def process(self):
-        """Run pipeline processor"""
+    def process(self, todos):
+        """Run pipeline processor
 
-        todos = self._collect()
-        for todo in todos:
+        Process all collected annotations. This modifies the pipelines of
+        the levels they were collected from, so the lowest of these levels
+        is returned.
+        """
+
+        for _, todo in todos:
             self._process_one(todo)
-        return len(todos) > 0
+        return min(index for index, _ in todos)
+
+
+# The registry of all pre-processors, in the order they are run.
+PROCESSORS = [
+    MppDepsolve,
+    MppPipelineBase,
+    MppPipelineImport,
+]
+
+
+def register_processor(proc, index=None):
+    """Register a pre-processor
+
+    Add a pre-processor to the registry of pre-processors run by default. If
+    `index` is given, the pre-processor is inserted at that position,
+    otherwise it is appended and runs last.
+
+    A pre-processor is a class that is instantiated with the `MppContext` of
+    a manifest. It must provide a method `collect(level)`, which returns a
+    list of pending annotations found in the given pipeline level, and a
+    method `process(todos)`, which processes a list of `(index, todo)`
+    tuples, where `index` is the level the annotation was collected from.
+    `process()` must return the lowest level index whose pipeline structure
+    it modified, or `None` if it did not modify any.
+    """
+
+    if index is None:
+        PROCESSORS.append(proc)
+    else:
+        PROCESSORS.insert(index, proc)
+
+
+class MppContext:
+    """Manifest Pre-Processing Context
+
+    A context represents a single manifest flowing through the engine. It is
+    handed to every pre-processor and provides access to the manifest that is
+    being transformed, as well as the shared state of the engine.
+
+    While running, the context records the paths of all files the manifest
+    depends on. Paths are recorded as referenced by the manifest, hence they
+    are relative to the current working directory of the engine, unless
+    absolute. It also records the platforms dependencies were resolved for.
+    """
+
+    def __init__(self, engine, manifest):
+        self._engine = engine
+        self._manifest = manifest
+        self._dependencies = {}
+        self._platforms = {}
+
+    def add_dependency(self, path):
+        """Record a file the manifest depends on"""
+
+        self._dependencies[os.path.normpath(path)] = None
+
+    def add_platform(self, fedora, architecture):
+        """Record a platform dependencies were resolved for"""
+
+        self._platforms[(str(fedora), str(architecture))] = None
+
+    def import_manifest(self, path):
+        """Import a manifest and record it as dependency"""
+
+        self.add_dependency(path)
+        return self._engine.imports.load(path)
+
+    def _scan(self, procs, queues, start):
+        levels = self._manifest.levels
+        for index in range(start, len(levels)):
+            for proc, queue in zip(procs, queues):
+                queue.extend((index, todo) for todo in proc.collect(levels[index]))
+
+    def run(self):
+        """Run all pre-processors on the manifest
+
+        All pending annotations are tracked in one work queue per
+        pre-processor. The pre-processors are run in order, each on its
+        entire queue, until all queues are empty. Whenever a pre-processor
+        modifies the structure of a level, only that level and the levels
+        below it are refreshed and scanned for new annotations again.
+        """
+
+        procs = [proc(self) for proc in self._engine.processors]
+        queues = [[] for _ in procs]
+
+        self._scan(procs, queues, 0)
+
+        progress = True
+        while progress:
+            progress = False
+            trace.counter("mpp.iterations")
+            for proc, queue in zip(procs, queues):
+                if not queue:
+                    continue
+
+                todos = list(queue)
+                queue.clear()
+                progress = True
+
+                with trace.span(type(proc).__name__, todos=len(todos)):
+                    start = proc.process(todos)
+                if start is not None:
+                    self._manifest.refresh(start)
+                    for itr in queues:
+                        itr[:] = [todo for todo in itr if todo[0] < start]
+                    self._scan(procs, queues, start)
+
+        return self._manifest
+
+    def report(self):
+        """Report information about the processing
+
+        Return a JSON-serializable dictionary with all information recorded
+        while processing the manifest that is not part of the manifest
+        itself.
+        """
+
+        return {
+            "dependencies": self.dependencies,
+            "platforms": self.platforms,
+            "revisions": self.revisions,
+        }
+
+    @property
+    def dependencies(self):
+        """List of recorded dependencies, in order of first use"""
+        return list(self._dependencies)
+
+    @property
+    def platforms(self):
+        """List of recorded `[fedora, architecture]` platforms"""
+        return [list(p) for p in self._platforms]
+
+    @property
+    def revisions(self):
+        """List of `[fedora, architecture, revision]` of all platforms
+
+        The revision is the one of the repository metadata dependencies
+        were resolved against, see `DepsolveBackend.revision()`.
+        """
+
+        return [
+            [fedora, architecture, self.depsolver.revision({
+                "fedora": fedora,
+                "architecture": architecture,
+            })]
+            for fedora, architecture in self._platforms
+        ]
+
+    @property
+    def manifest(self):
+        """Access the linked manifest"""
+        return self._manifest
+
+    @property
+    def depsolve_cache(self):
+        """Access the depsolve cache of the engine"""
+        return self._engine.depsolve_cache
+
+    @property
+    def depsolver(self):
+        """Access the dependency solver of the engine"""
+        return self._engine.depsolver
+
+    @property
+    def depsolve_pool(self):
+        """Access the depsolve worker pool of the engine, if any"""
+        return self._engine.depsolve_pool
+
+    @property
+    def path_cache(self):
+        """Query path to the cache directory"""
+        return self._engine.path_cache
+
+    @property
+    def path_cwd(self):
+        """Query path to the current working directory"""
+        return self._engine.path_cwd
+
+
+# pylint: disable=too-many-instance-attributes
+class MppEngine:
+    """Manifest Pre-Processing Engine
+
+    The engine carries the state that is shared across all manifests it
+    processes. A single engine can be used to process any number of
+    manifests, one after another, without re-doing its setup.
+
+    Parameters
+    ----------
+    path_cache
+        Path to the cache directory. It must exist.
+    path_cwd
+        Path used as base for all relative file-system operations.
+    depsolve_cache_size
+        Maximum size of the depsolve cache in bytes.
+    depsolve_backend
+        Name of the depsolve backend to use, see `depsolve.BACKENDS`. If
+        `None`, the snapshot backend is used if a snapshot is specified, and
+        the metalink backend otherwise.
+    depsolve_snapshot
+        Path to the local repository snapshot used by the snapshot backend.
+    depsolve_jobs
+        Maximum number of worker processes resolving depsolve requests of
+        different repositories concurrently. Only used by backends that
+        benefit from it, see `DepsolvePool`.
+    processors
+        List of pre-processors to run, in order. If `None`, the registered
+        pre-processors are used, see `register_processor()`.
+    """
+
+    DEPSOLVE_CACHE_SIZE = depsolve.DepsolveCache.DEFAULT_MAX_SIZE
+    DEPSOLVE_JOBS = 4
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self,
+            *,
+            path_cache,
+            path_cwd,
+            depsolve_cache_size=DEPSOLVE_CACHE_SIZE,
+            depsolve_backend=None,
+            depsolve_snapshot=None,
+            depsolve_jobs=DEPSOLVE_JOBS,
+            processors=None,
+    ):
+        self._path_cache = path_cache
+        self._path_cwd = path_cwd
+        self._depsolve_cache = None
+        self._depsolve_cache_size = depsolve_cache_size
+        self._depsolve_snapshot = depsolve_snapshot
+        self._depsolver = None
+        self._depsolve_jobs = depsolve_jobs
+        self._depsolve_pool = None
+        self._imports = ImportCache(path_cwd)
+        self._processors = list(PROCESSORS if processors is None else processors)
+
+        if depsolve_backend is None:
+            depsolve_backend = "metalink" if depsolve_snapshot is None else "snapshot"
+        if depsolve_backend not in depsolve.BACKENDS:
+            raise ValueError(f"Unknown depsolve backend: {depsolve_backend}")
+        self._depsolve_backend = depsolve_backend
+
+    def process(self, manifest):
+        """Pre-process a manifest
+
+        Run all pre-processors on the given manifest until no further progress
+        is made. The manifest is modified in-place and returned.
+        """
+
+        return MppContext(self, manifest).run()
+
+    @property
+    def depsolve_cache(self):
+        """Access the depsolve cache, creating it on first use"""
+
+        if self._depsolve_cache is None:
+            self._depsolve_cache = depsolve.DepsolveCache(
+                os.path.join(self._path_cache, "depsolve"),
+                max_size=self._depsolve_cache_size,
+            )
+        return self._depsolve_cache
+
+    @property
+    def depsolver(self):
+        """Access the dependency solver, creating it on first use
+
+        The solver keeps loaded repository metadata around for the lifetime
+        of the engine, so it is shared by all manifests the engine processes.
+        """
+
+        if self._depsolver is None:
+            self._depsolver = depsolve.BACKENDS[self._depsolve_backend](
+                path_cache=self._path_cache,
+                cache=self.depsolve_cache,
+                path_snapshot=self._depsolve_snapshot,
+            )
+        return self._depsolver
+
+    @property
+    def depsolve_pool(self):
+        """Access the depsolve worker pool, creating it on first use
+
+        Return `None` if the depsolve backend does not benefit from worker
+        processes, or if only a single job is allowed.
+        """
+
+        backend = depsolve.BACKENDS[self._depsolve_backend]
+        if not backend.CONCURRENT or self._depsolve_jobs < 2:
+            return None
+        if self._depsolve_pool is None:
+            self._depsolve_pool = depsolve.DepsolvePool(
+                backend,
+                self._depsolve_jobs,
+                path_cache=self._path_cache,
+                cache=self.depsolve_cache,
+                path_snapshot=self._depsolve_snapshot,
+            )
+        return self._depsolve_pool
+
+    def close(self):
+        """Stop the depsolve worker processes, if any were started"""
+
+        if self._depsolve_pool is not None:
+            self._depsolve_pool.close()
+            self._depsolve_pool = None
+
+    @property
+    def processors(self):
+        """List of pre-processors run by the engine, in order"""
+        return self._processors
+
+    @property
+    def imports(self):
+        """Access the import cache shared by all manifests"""
+        return self._imports
+
+    @property
+    def path_cache(self):
+        """Query path to the cache directory"""
+        return self._path_cache
+
+    @property
+    def path_cwd(self):
+        """Query path to the current working directory"""
+        return self._path_cwd
+
+
+class MppBatch:
+    """Batch Pre-Processing
+
+    Pre-processes many manifests, one after another, with a single engine.
+    Hence, all manifests share the cache directory, the import cache and
+    the depsolve state of the engine. A manifest that fails to pre-process
+    is reported, but does not abort the batch.
+
+    Every processed manifest yields a result, which is a dictionary with the
+    report of the manifest as returned by `MppContext.report()`, or with an
+    `error` message if it failed.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def _process(self, manifest):
+        context = MppContext(self._engine, manifest)
+        with trace.span("MppContext.run"):
+            context.run()
+        return context.report()
+
+    @staticmethod
+    def _error(e):
+        return f"{type(e).__name__}: {e}"
+
+    @staticmethod
+    def _umask():
+        # The umask can only be read by replacing it, so restore it right
+        # away.
+        umask = os.umask(0o022)
+        os.umask(umask)
+        return umask
+
+    @classmethod
+    def _write(cls, manifest, path):
+        # Write the manifest next to its destination first and move it into
+        # place, so the destination never contains a partial manifest.
+        # Temporary files are private to their owner, so give it the mode a
+        # plain `open()` would have used.
+        dirpath = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirpath, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=dirpath,
+                prefix=".tmp-",
+                delete=False,
+        ) as stream:
+            try:
+                manifest.to_stream(stream)
+                os.fchmod(stream.fileno(), 0o666 & ~cls._umask())
+            except BaseException:
+                os.unlink(stream.name)
+                raise
+        os.replace(stream.name, path)
+
+    def process_ndjson(self, src, dst):
+        """Pre-process newline-delimited manifests
+
+        Read one manifest per line from the text stream `src`, and write one
+        line per manifest to `dst`, each a JSON object with the `line` of
+        the manifest and either the pre-processed `manifest` and its
+        `report`, or an `error`. Empty lines are skipped. Return the list of
+        results.
+        """
+
+        results = []
+        for lineno, line in enumerate(src, start=1):
+            if not line.strip():
+                continue
+
+            result = {"line": lineno}
+            record = {"line": lineno}
+            try:
+                with trace.span("batch", line=lineno):
+                    data = codec.default().loads(line)
+                    if not isinstance(data, dict):
+                        raise ValueError("Manifest is not a JSON object")
+                    manifest = Manifest(data)
+                    report = self._process(manifest)
+                result.update(report)
+                record["manifest"] = manifest.to_data()
+                record["report"] = report
+            except Exception as e:  # pylint: disable=broad-except
+                result["error"] = self._error(e)
+                record["error"] = result["error"]
+                print(f"Line {lineno}: {result['error']}", file=sys.stderr)
+
+            dst.write(json.dumps(record) + "\n")
+            dst.flush()
+            results.append(result)
+
+        return results
+
+    def process_files(self, pairs):
+        """Pre-process manifest files
+
+        Pre-process every `(input, output)` pair of paths: read the manifest
+        at `input` and write the result to `output`. Return the list of
+        results, each with the `input` and `output` paths.
+        """
+
+        results = []
+        for path_input, path_output in pairs:
+            result = {"input": path_input, "output": path_output}
+            try:
+                with trace.span("batch", path=path_input):
+                    with open(path_input, "r", encoding="utf-8") as stream:
+                        manifest = Manifest.from_stream(stream)
+                    result.update(self._process(manifest))
+                    self._write(manifest, path_output)
+            except Exception as e:  # pylint: disable=broad-except
+                result["error"] = self._error(e)
+                print(f"{path_input}: {result['error']}", file=sys.stderr)
+            results.append(result)
+
+        return results
+
+
+def preprocess(source, *, path_cache=None, path_cwd=None):
+    """Pre-process a single manifest
+
+    This is the library entry-point of the pre-processor. It runs all
+    pre-processors on a manifest and returns the result.
+
+    Parameters
+    ----------
+    source
+        Either a `Manifest` object, or a text stream to read the manifest
+        from. A `Manifest` object is modified in-place.
+    path_cache
+        Path to the cache directory to use. It is created if it does not
+        exist. If `None`, a temporary directory is used for the duration of
+        this call.
+    path_cwd
+        Path to use as base for all relative file-system operations. If
+        `None`, the current working directory of the process is used.
+
+    Returns
+    -------
+    Manifest
+        The pre-processed manifest.
+    """
+
+    if isinstance(source, Manifest):
+        manifest = source
+    else:
+        manifest = Manifest.from_stream(source)
+
+    with contextlib.ExitStack() as ctx:
+        if path_cache is None:
+            path_cache = ctx.enter_context(tempfile.TemporaryDirectory())
+        else:
+            os.makedirs(path_cache, exist_ok=True)
+
+        if path_cwd is None:
+            path_cwd = os.getcwd()
+
+        engine = MppEngine(path_cache=path_cache, path_cwd=path_cwd)
+        ctx.callback(engine.close)
+        return engine.process(manifest)
 
 
 class Mpp:
@@ -380,9 +1008,10 @@ class Mpp:
     def __init__(self, argv):
         self._argv = argv
         self._ctx = contextlib.ExitStack()
+        self._engine = None
         self._manifest = None
-        self._path_cache = None
-        self._path_cwd = None
+        self._pairs = None
+        self._path_report = None
 
     def _parse_args(self):
         parser = argparse.ArgumentParser(
@@ -393,6 +1022,14 @@ class Mpp:
             prog="osbuild-mpp",
         )
 
+        parser.add_argument(
+            "--batch",
+            action="store_true",
+            default=False,
+            help="Pre-process many manifests, given as INPUT:OUTPUT pairs or as "
+            "newline-delimited JSON on standard-input",
+        )
+
         parser.add_argument(
             "--cache",
             help="Path to cache-directory to use",
@@ -400,6 +1037,28 @@ class Mpp:
             type=os.path.abspath,
         )
 
+        parser.add_argument(
+            "--depsolve-cache-size",
+            default=MppEngine.DEPSOLVE_CACHE_SIZE,
+            help="Maximum size of the depsolve cache in bytes",
+            metavar="BYTES",
+            type=int,
+        )
+
+        parser.add_argument(
+            "--depsolve-backend",
+            choices=sorted(depsolve.BACKENDS),
+            help="Depsolve backend to use",
+            metavar="NAME",
+        )
+
+        parser.add_argument(
+            "--depsolve-snapshot",
+            help="Path to local repository snapshots to depsolve against",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+
         parser.add_argument(
             "--cwd",
             help="Path to current-working-directory to use",
@@ -407,21 +1066,60 @@ class Mpp:
             type=os.path.abspath,
         )
 
-        return parser.parse_args(self._argv[1:])
+        parser.add_argument(
+            "--report",
+            help="Path to write a JSON report of the processing to",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+
+        parser.add_argument(
+            "--trace",
+            help="Path to write a trace of the processing to, in Chrome trace-event format",
+            metavar="PATH",
+            type=os.path.abspath,
+        )
+
+        parser.add_argument(
+            "PAIR",
+            help="In batch mode, path to a manifest and path to write the result to",
+            metavar="INPUT:OUTPUT",
+            nargs="*",
+            type=str,
+        )
+
+        args = parser.parse_args(self._argv[1:])
+
+        if args.PAIR and not args.batch:
+            parser.error("INPUT:OUTPUT pairs require --batch")
+        self._pairs = []
+        for pair in args.PAIR:
+            path_input, _, path_output = pair.rpartition(":")
+            if not path_input or not path_output:
+                parser.error(f"Invalid INPUT:OUTPUT pair: {pair}")
+            self._pairs.append((path_input, path_output))
+
+        return args
 
     def __enter__(self):
         with self._ctx as ctx:
             args = self._parse_args()
 
+            # If `--trace=FILE` was specified, record a trace of everything
+            # that follows and write it when we are done, even on failure.
+            if args.trace is not None:
+                trace.enable("mpp")
+                ctx.callback(trace.dump, args.trace)
+
             # If `--cache=DIR` was specified, try creating the directory
             # (unless it exists already). If it was not specified, create a
             # temporary directory instead.
             if args.cache is None:
-                self._path_cache = ctx.enter_context(tempfile.TemporaryDirectory())
+                path_cache = ctx.enter_context(tempfile.TemporaryDirectory())
             else:
                 try:
-                    self._path_cache = os.path.join(os.getcwd(), args.cache)
-                    os.makedirs(self._path_cache, exist_ok=True)
+                    path_cache = os.path.join(os.getcwd(), args.cache)
+                    os.makedirs(path_cache, exist_ok=True)
                 except OSError:
                     print("Cannot create cache directory", file=sys.stderr)
                     raise
@@ -430,13 +1128,24 @@ class Mpp:
             # file-system operations. If not, we use the actual CWD of the
             # process.
             if args.cwd is None:
-                self._path_cwd = os.getcwd()
+                path_cwd = os.getcwd()
             else:
-                self._path_cwd = os.path.join(os.getcwd(), args.cwd)
+                path_cwd = os.path.join(os.getcwd(), args.cwd)
+
+            self._engine = MppEngine(
+                path_cache=path_cache,
+                path_cwd=path_cwd,
+                depsolve_cache_size=args.depsolve_cache_size,
+                depsolve_backend=args.depsolve_backend,
+                depsolve_snapshot=args.depsolve_snapshot,
+            )
+            ctx.callback(self._engine.close)
+            self._path_report = args.report
 
-            # We always expect a manifest on standard-input. Import it and
-            # provide it as property.
-            self._manifest = Manifest.from_stream(sys.stdin)
+            # Unless in batch mode, we expect a manifest on standard-input.
+            # Import it and provide it as property.
+            if not args.batch:
+                self._manifest = Manifest.from_stream(sys.stdin)
 
             # Initialization succeeded. Save the exit-stack for later.
             self._ctx = ctx.pop_all()
@@ -447,22 +1156,35 @@ class Mpp:
         with self._ctx:
             pass
 
+    def _run_batch(self):
+        batch = MppBatch(self._engine)
+        if self._pairs:
+            results = batch.process_files(self._pairs)
+        else:
+            results = batch.process_ndjson(sys.stdin, sys.stdout)
+
+        # If requested, write a report with the results of all manifests.
+        if self._path_report is not None:
+            with open(self._path_report, "w", encoding="utf-8") as stream:
+                json.dump(results, stream)
+
+        return 1 if any("error" in result for result in results) else 0
+
     def run(self):
         """Execute the pre-processors"""
 
-        # Run processors as long as there is progress.
-        procs = [
-            MppDepsolve,
-            MppPipelineBase,
-            MppPipelineImport,
-        ]
-        progress = True
-        while progress:
-            progress = False
-            for proc in procs:
-                if proc(self).process():
-                    progress = True
-                    self._manifest.refresh()
+        if self._manifest is None:
+            return self._run_batch()
+
+        context = MppContext(self._engine, self._manifest)
+        with trace.span("MppContext.run"):
+            context.run()
+
+        # If requested, write a report with information about the processing
+        # that is not part of the manifest itself.
+        if self._path_report is not None:
+            with open(self._path_report, "w", encoding="utf-8") as stream:
+                json.dump(context.report(), stream)
 
         # Write the resulting manifest to standard-output.
         self._manifest.to_stream(sys.stdout)
@@ -476,9 +1198,9 @@ class Mpp:
     @property
     def path_cache(self):
         """Query path to the cache directory"""
-        return self._path_cache
+        return self._engine.path_cache
 
     @property
     def path_cwd(self):
         """Query path to the current working directory"""
-        return self._path_cwd
+        return self._engine.path_cwd
@@ -0,0 +1,188 @@
+"""Tracing Helpers
+
+This module provides an opt-in tracing layer for the pre-processor and the
+database. While tracing is enabled, spans of interesting operations and
+counters are recorded in memory and eventually written as a file in the
+Chrome trace-event format, which can be viewed with `chrome://tracing` or
+Perfetto.
+
+Tracing is disabled by default. Then, `span()` and `counter()` do nothing,
+so instrumented code pays close to nothing for it.
+
+Events are timestamped with the monotonic clock of the system, which is
+shared by all processes. Hence, events recorded by worker processes and
+subprocesses can be merged into the trace of their parent via
+`add_events()`.
+"""
+
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """Trace Event Recorder
+
+    Records trace events of the current process. Events can be recorded
+    from multiple threads.
+
+    Parameters
+    ----------
+    name
+        Name of the process, as shown in the trace.
+    """
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._counters = {}
+        self._events = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": self._pid,
+            "tid": 0,
+            "args": {"name": name},
+        }]
+
+    @staticmethod
+    def now():
+        """Current timestamp, in microseconds"""
+        return time.monotonic_ns() / 1000
+
+    @contextlib.contextmanager
+    def span(self, name, category, args):
+        """Record the duration of a block as complete event"""
+
+        start = self.now()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": self.now() - start,
+                "pid": self._pid,
+                "tid": threading.get_ident(),
+            }
+            if args:
+                event["args"] = args
+            with self._lock:
+                self._events.append(event)
+
+    def counter(self, name, value):
+        """Add `value` to a counter and record its new total"""
+
+        with self._lock:
+            total = self._counters.get(name, 0) + value
+            self._counters[name] = total
+            self._events.append({
+                "name": name,
+                "ph": "C",
+                "ts": self.now(),
+                "pid": self._pid,
+                "args": {"value": total},
+            })
+
+    def add_events(self, events):
+        """Merge events recorded elsewhere"""
+
+        with self._lock:
+            self._events.extend(events)
+
+    def take_events(self):
+        """Return all recorded events and forget about them"""
+
+        with self._lock:
+            events = self._events
+            self._events = []
+        return events
+
+
+# The tracer of the current process, if tracing is enabled.
+_TRACER = None
+
+
+def enable(name):
+    """Enable tracing for the current process
+
+    Any tracer inherited from a parent process is replaced, so events are
+    never recorded twice.
+    """
+
+    # pylint: disable=global-statement
+    global _TRACER
+    _TRACER = Tracer(name)
+
+
+def disable():
+    """Disable tracing and drop all recorded events"""
+
+    # pylint: disable=global-statement
+    global _TRACER
+    _TRACER = None
+
+
+def enabled():
+    """Check whether tracing is enabled"""
+    return _TRACER is not None
+
+
+def span(name, category="mpp", **args):
+    """Trace a block of code
+
+    Return a context manager that records the duration of the block it
+    guards as a span with the given name and arguments. If tracing is
+    disabled, nothing is recorded.
+    """
+
+    if _TRACER is None:
+        return contextlib.nullcontext()
+    return _TRACER.span(name, category, args)
+
+
+def counter(name, value=1):
+    """Add `value` to the counter `name`, if tracing is enabled"""
+
+    if _TRACER is not None:
+        _TRACER.counter(name, value)
+
+
+def take_events():
+    """Return and drop all events recorded so far, for merging elsewhere"""
+
+    if _TRACER is None:
+        return []
+    return _TRACER.take_events()
+
+
+def add_events(events):
+    """Merge events recorded by another process, if tracing is enabled"""
+
+    if _TRACER is not None and events:
+        _TRACER.add_events(events)
+
+
+def load(path):
+    """Read the events of a trace file, or an empty list if there is none"""
+
+    try:
+        with open(path, "r", encoding="utf-8") as stream:
+            return json.load(stream).get("traceEvents", [])
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def dump(path):
+    """Write all recorded events to a trace file"""
+
+    data = {
+        "displayTimeUnit": "ms",
+        "traceEvents": take_events(),
+    }
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(data, stream)
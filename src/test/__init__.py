@@ -0,0 +1,16 @@
+"""Unittests
+
+The tests import `mdb` and `mpp` from the source tree, and run their
+command-line interfaces from it. Hence, the source tree is added to the
+module search path.
+"""
+
+
+import os
+import sys
+
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if SRCDIR not in sys.path:
+    sys.path.insert(0, SRCDIR)
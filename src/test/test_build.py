@@ -0,0 +1,124 @@
+"""Test the build scheduler"""
+
+
+import os
+import tempfile
+import unittest
+
+import mpp
+
+from mdb import build
+from mdb import merkle
+
+from . import util
+
+
+def _manifest(runner, packages, url):
+    return mpp.Manifest({
+        "pipeline": {
+            "build": {
+                "pipeline": {"stages": [{"name": "org.osbuild.rpm"}]},
+                "runner": runner,
+            },
+            "stages": [{"name": "org.osbuild.rpm", "options": {"packages": packages}}],
+        },
+        "sources": {"org.osbuild.files": {"urls": {packages[0]: url}}},
+    })
+
+
+class TestBuild(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def test_hashes(self):
+        """Pipeline hashes are the level hashes of the Merkle tree"""
+
+        manifest = _manifest("org.osbuild.fedora32", ["sha256:aa"], "http://a")
+        self.assertEqual(
+            build.pipeline_hashes(manifest),
+            [level["hash"] for level in merkle.manifest_tree(manifest)["levels"]],
+        )
+
+    def test_runner(self):
+        """Levels with the same stages but different runners are distinct"""
+
+        a = _manifest("org.osbuild.fedora32", ["sha256:aa"], "http://a")
+        b = _manifest("org.osbuild.fedora33", ["sha256:aa"], "http://a")
+        self.assertNotEqual(build.pipeline_hashes(a), build.pipeline_hashes(b))
+
+        plan = build.BuildPlan()
+        plan.add("a", a)
+        plan.add("b", b)
+        self.assertEqual(len(plan.nodes), 4)
+        runners = sorted(str(n["runner"]) for n in plan.nodes.values())
+        self.assertEqual(runners, ["None", "None", "org.osbuild.fedora32", "org.osbuild.fedora33"])
+
+    def test_sources(self):
+        """Shared pipelines get the sources of all manifests using them"""
+
+        a = _manifest("org.osbuild.fedora32", ["sha256:aa"], "http://a")
+        b = _manifest("org.osbuild.fedora32", ["sha256:bb"], "http://b")
+
+        plan = build.BuildPlan()
+        plan.add("a", a)
+        plan.add("b", b)
+        self.assertEqual(len(plan.nodes), 3)
+
+        shared = plan.nodes[build.pipeline_hashes(a)[1]]
+        self.assertEqual(shared["tags"], ["a", "b"])
+        self.assertEqual(
+            shared["manifest"]["sources"],
+            {"org.osbuild.files": {"urls": {"sha256:aa": "http://a", "sha256:bb": "http://b"}}},
+        )
+        self.assertEqual(a.data["sources"]["org.osbuild.files"]["urls"], {"sha256:aa": "http://a"})
+
+    def test_schedule(self):
+        """Every unique pipeline is built once, and not again"""
+
+        dstdir = os.path.join(util.database(self), "db")
+
+        proc = util.run("mdb", "build", "--dstdir", dstdir, "--executor", "local")
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        results = [p for p in os.listdir(os.path.join(dstdir, "builds")) if p.endswith(".json")]
+        self.assertEqual(len(results), 4)
+
+        proc = util.run("mdb", "build", "--dstdir", dstdir, "--executor", "local")
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(len(os.listdir(os.path.join(dstdir, "builds"))), len(results) + 1)
+
+    def test_store_failure(self):
+        """Pipelines whose result cannot be recorded fail, the plan goes on"""
+
+        a = _manifest("org.osbuild.fedora32", ["sha256:aa"], "http://a")
+        b = _manifest("org.osbuild.fedora32", ["sha256:bb"], "http://b")
+        hashes_a = build.pipeline_hashes(a)
+        hashes_b = build.pipeline_hashes(b)
+        plan = build.BuildPlan()
+        plan.add("a", a)
+        plan.add("b", b)
+
+        expected = [
+            # The pipeline of `a` fails, the shared build pipeline and `b`
+            # are not affected.
+            (hashes_a[0], {hashes_a[0]: "failure", hashes_a[1]: "success", hashes_b[0]: "success"}),
+            # The shared build pipeline fails, so both `a` and `b` are skipped.
+            (hashes_a[1], {hashes_a[0]: "skipped", hashes_a[1]: "failure", hashes_b[0]: "skipped"}),
+        ]
+        for blocked, statuses in expected:
+            with self.subTest(blocked=blocked), tempfile.TemporaryDirectory() as tmp:
+                # A directory in place of the result cannot be replaced.
+                path_results = os.path.join(tmp, "builds")
+                os.makedirs(os.path.join(path_results, blocked + ".json"))
+                executor = build.LocalExecutor(path_output=os.path.join(tmp, "output"))
+                scheduler = build.BuildScheduler(executor, path_results, jobs=2)
+
+                results = scheduler.run(plan)
+                self.assertEqual({h: r["status"] for h, r in results.items()}, statuses)
+                self.assertIn("Cannot record result", results[blocked]["error"])
+                self.assertEqual(
+                    sorted(os.listdir(path_results)),
+                    sorted(h + ".json" for h, status in statuses.items() if status != "skipped"),
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
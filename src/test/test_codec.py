@@ -0,0 +1,202 @@
+"""Test the JSON codecs"""
+
+
+import io
+import json
+import unittest
+
+from mpp import codec
+from mpp import compact
+
+
+DIGESTS = [
+    "sha256:" + "0" * 64,
+    "sha256:" + "0123456789abcdef" * 4,
+]
+
+DOCUMENTS = {
+    "empty": {},
+    "plain": {
+        "version": "2",
+        "pipeline": {
+            "build": {},
+            "stages": [
+                {"name": "org.osbuild.rpm", "options": {"gpgkeys": [], "packages": []}},
+            ],
+        },
+        "sources": {"org.osbuild.files": {"urls": {}}},
+        "flags": [True, False, None],
+        "empty": [[], {}],
+    },
+    "non-ascii": {"name": "Zürich", "emoji": "\U0001f600", "ctl": "\x01\x1f"},
+    "escapes": {"quote": '"', "backslash": "\\", "newline": "a\nb\tc", "slash": "/"},
+    "del": {"del": "a\x7fb"},
+    "floats": {"float": 1.5, "tiny": 1e-10, "huge": 1e22, "neg": -0.0},
+    "integers": {"small": -1, "i64": -2**63, "u64": 2**64 - 1, "big": 2**64, "neg": -2**63 - 1},
+    "non-string keys": {1: "a", "b": {2: "c"}},
+    "tuples": {"tuple": (1, "a", ()), "nested": [("x", ("y",))]},
+    "packed": {
+        "packages": compact.PackedDigestList(DIGESTS),
+        "empty": compact.PackedDigestList([]),
+    },
+}
+
+
+def _expected(data):
+    return json.dumps(data, indent=2, default=codec._sequence) + "\n"  # pylint: disable=protected-access
+
+
+class TestCodec(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def _codecs(self):
+        codecs = [cls() for cls in codec.CODECS.values() if cls.available()]
+        self.assertIn("json", [c.name for c in codecs])
+        return codecs
+
+    def test_dump(self):
+        """All codecs write the canonical form, byte for byte"""
+
+        for impl in self._codecs():
+            for name, data in DOCUMENTS.items():
+                with self.subTest(codec=impl.name, document=name):
+                    stream = io.StringIO()
+                    total = impl.dump(data, stream)
+                    self.assertEqual(stream.getvalue(), _expected(data))
+                    self.assertEqual(total, len(stream.getvalue()))
+
+    def test_dump_chunked(self):
+        """Documents larger than a chunk are written completely"""
+
+        data = {"packages": [f"package-{i}" for i in range(16 * 1024)], "name": "Zürich"}
+        for impl in self._codecs():
+            with self.subTest(codec=impl.name):
+                stream = io.StringIO()
+                total = impl.dump(data, stream)
+                self.assertEqual(stream.getvalue(), _expected(data))
+                self.assertEqual(total, len(stream.getvalue()))
+
+    def test_orjson(self):
+        """The `orjson` codec matches the standard library"""
+
+        if not codec.OrjsonCodec.available():
+            self.skipTest("orjson not available")
+
+        impl = codec.OrjsonCodec()
+        for name, data in DOCUMENTS.items():
+            with self.subTest(document=name):
+                stream = io.StringIO()
+                codec.JsonCodec().dump(data, stream)
+                expected = stream.getvalue()
+                stream = io.StringIO()
+                impl.dump(data, stream)
+                self.assertEqual(stream.getvalue(), expected)
+
+    def test_loads(self):
+        """All codecs decode like the standard library"""
+
+        for impl in self._codecs():
+            for name, data in DOCUMENTS.items():
+                text = _expected(data)
+                with self.subTest(codec=impl.name, document=name):
+                    self.assertEqual(impl.loads(text), json.loads(text))
+                    self.assertEqual(impl.loads(text.encode()), json.loads(text))
+                    self.assertEqual(impl.load(io.StringIO(text)), json.loads(text))
+
+            with self.subTest(codec=impl.name, document="nan"):
+                self.assertEqual(impl.loads('{"a": NaN}').keys(), {"a"})
+            with self.subTest(codec=impl.name, document="malformed"):
+                with self.assertRaises(json.JSONDecodeError):
+                    impl.loads('{"a": ')
+
+    def test_default(self):
+        """Codecs are selected by name"""
+
+        previous = codec.default()
+        self.addCleanup(codec.set_default, previous.name)
+
+        codec.set_default("json")
+        self.assertIsInstance(codec.default(), codec.JsonCodec)
+        with self.assertRaises(ValueError):
+            codec.set_default("unknown")
+
+
+class TestJsonScanner(unittest.TestCase):
+    """Testcases of the incremental JSON reader"""
+
+    MANIFEST = {
+        "version": "2",
+        "pipeline": {
+            "build": {
+                "runner": "org.osbuild.fedora32",
+                "pipeline": {"stages": [{"name": "org.osbuild.rpm"}]},
+            },
+            "stages": [
+                {"name": "org.osbuild.rpm", "options": {"text": "]}\"[{", "n": [1, 2.5, None]}},
+                {"options": {}},
+                {"name": "org.osbuild.fstab"},
+            ],
+        },
+        "sources": {"org.osbuild.files": {"urls": {"sha256:00": "https://example.com/ü"}}},
+    }
+
+    def _scanners(self):
+        for indent in (None, 2):
+            text = json.dumps(self.MANIFEST, indent=indent)
+            yield indent, codec.JsonScanner(text)
+            yield indent, codec.JsonScanner(text.encode())
+
+    def test_read_keys(self):
+        """Selected top-level keys are decoded"""
+
+        for indent, scanner in self._scanners():
+            with self.subTest(indent=indent):
+                self.assertEqual(
+                    scanner.read_keys(["sources", "version", "missing"]),
+                    {"sources": self.MANIFEST["sources"], "version": "2"},
+                )
+
+    def test_members(self):
+        """Members and their values are found in order"""
+
+        for indent, scanner in self._scanners():
+            with self.subTest(indent=indent):
+                keys = [key for key, _offset in scanner.members()]
+                self.assertEqual(keys, list(self.MANIFEST))
+                pipeline = scanner.find("pipeline")
+                self.assertEqual(scanner.decode(pipeline), self.MANIFEST["pipeline"])
+                self.assertIsNone(scanner.find("missing"))
+                stages = scanner.find("stages", pipeline)
+                self.assertEqual(
+                    [scanner.decode(offset) for offset in scanner.elements(stages)],
+                    self.MANIFEST["pipeline"]["stages"],
+                )
+
+    def test_stage_names(self):
+        """Stage names of all pipeline levels are listed"""
+
+        for indent, scanner in self._scanners():
+            with self.subTest(indent=indent):
+                self.assertEqual(scanner.stage_names(), [
+                    ["org.osbuild.rpm", None, "org.osbuild.fstab"],
+                    ["org.osbuild.rpm"],
+                ])
+
+        self.assertEqual(codec.JsonScanner("{}").stage_names(), [[]])
+        self.assertEqual(codec.JsonScanner('{"pipeline": {"build": {}}}').stage_names(), [[]])
+        self.assertEqual(
+            codec.JsonScanner('{"pipeline": {"build": {"runner": "r"}}}').stage_names(),
+            [[], []],
+        )
+
+    def test_malformed(self):
+        """Malformed documents raise `ValueError`"""
+
+        for text in ("", "[", '{"a" 1}', '{"a": [1, 2}', '{"a": "b'):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    codec.JsonScanner(text).read_keys(["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Test `mdb diff`"""
+
+
+import os
+import unittest
+
+from . import util
+
+
+class TestDiff(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.database(self)
+        self.dstdir = os.path.join(self._tmp, "db")
+
+    def _diff(self, a, b):
+        return util.run("mdb", "diff", "--dstdir", self.dstdir, a, b)
+
+    def test_equal(self):
+        """Identical manifests exit with 0 and print nothing"""
+
+        checksum = os.path.basename(os.readlink(os.path.join(self.dstdir, "by-tag/img/a.json")))
+        for b in ["img/a.json", checksum]:
+            proc = self._diff("img/a.json", b)
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertEqual(proc.stdout, "")
+
+    def test_different(self):
+        """Different manifests exit with 1 and print their changes"""
+
+        proc = self._diff("img/a.json", "img/b.json")
+        self.assertEqual(proc.returncode, 1, proc.stderr)
+        self.assertIn("org.osbuild.locale", proc.stdout)
+
+        proc = self._diff("img/b.json", "img/c.json")
+        self.assertEqual(proc.returncode, 1, proc.stderr)
+        self.assertNotEqual(proc.stdout, "")
+
+    def test_missing(self):
+        """Unknown manifests exit with 2"""
+
+        proc = self._diff("img/a.json", "img/missing.json")
+        self.assertEqual(proc.returncode, 2)
+        self.assertIn("img/missing.json", proc.stderr)
+
+        proc = self._diff("sha256:" + "0" * 64, "img/a.json")
+        self.assertEqual(proc.returncode, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Test `mdb fsck`"""
+
+
+import os
+import re
+import time
+import unittest
+
+from . import util
+
+
+class TestFsck(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.database(self)
+        self.dstdir = os.path.join(self._tmp, "db")
+
+    def _fsck(self, *args, dstdir=None):
+        return util.run("mdb", "fsck", "--dstdir", dstdir or self.dstdir, *args)
+
+    def _checksum(self, tag):
+        return os.readlink(os.path.join(self.dstdir, "by-tag", tag)).rsplit("/", 1)[-1]
+
+    @staticmethod
+    def _corrupt(path):
+        os.chmod(path, 0o644)
+        with open(path, "r+b") as stream:
+            stream.seek(-1, os.SEEK_END)
+            last = stream.read(1)
+            stream.seek(-1, os.SEEK_END)
+            stream.write(bytes([last[0] ^ 0x20]))
+
+    def _link(self, tag, target):
+        os.symlink(target, os.path.join(self.dstdir, "by-tag", tag))
+
+    def test_clean(self):
+        """Consistent databases exit with 0, unchanged objects are cached"""
+
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        match = re.search(r"Checked (\d+) objects \((\d+) unchanged\)", proc.stdout)
+        self.assertEqual(match.group(2), "0")
+        objects = match.group(1)
+
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertIn(f"Checked {objects} objects ({objects} unchanged)", proc.stdout)
+
+        proc = self._fsck("--full")
+        self.assertIn(f"Checked {objects} objects (0 unchanged)", proc.stdout)
+
+    def test_corrupt_loose(self):
+        """Modified loose objects are corrupt, even if previously checked"""
+
+        self.assertEqual(self._fsck().returncode, 0)
+
+        checksum = self._checksum("img/a.json")
+        self._corrupt(os.path.join(self.dstdir, "by-checksum", checksum))
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 1, proc.stdout + proc.stderr)
+        self.assertIn(f"corrupt: by-checksum/{checksum}", proc.stdout)
+
+    def test_corrupt_pack(self):
+        """Modified packs are corrupt"""
+
+        proc = util.run("mdb", "repack", "--dstdir", self.dstdir)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(self._fsck().returncode, 0)
+
+        path_packs = os.path.join(self.dstdir, "packs")
+        packs = [name for name in os.listdir(path_packs) if name.endswith(".pack")]
+        self.assertEqual(len(packs), 1)
+        self._corrupt(os.path.join(path_packs, packs[0]))
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 1, proc.stdout + proc.stderr)
+        self.assertIn(f"corrupt: packs/{packs[0]}", proc.stdout)
+
+    def test_dangling(self):
+        """Tags of missing objects are dangling"""
+
+        self._link("img/x.json", "../../by-checksum/sha256:" + "0" * 64)
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 2, proc.stdout + proc.stderr)
+        self.assertIn("dangling: by-tag/img/x.json", proc.stdout)
+
+    def test_misdirected(self):
+        """Tags must be relative symlinks into `by-checksum`"""
+
+        checksum = self._checksum("img/a.json")
+        self._link("img/x.json", os.path.join(self.dstdir, "by-checksum", checksum))
+        with open(os.path.join(self.dstdir, "by-tag", "img", "y.json"), "wb"):
+            pass
+
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 4, proc.stdout + proc.stderr)
+        self.assertIn("misdirected: by-tag/img/x.json", proc.stdout)
+        self.assertIn("misdirected: by-tag/img/y.json: not a symlink", proc.stdout)
+
+    def test_orphaned(self):
+        """Only old temporary files are orphaned"""
+
+        path_young = os.path.join(self.dstdir, "by-checksum", ".mdb-tmp-young")
+        path_old = os.path.join(self.dstdir, "state", ".tmp-old")
+        for path in (path_young, path_old):
+            with open(path, "wb"):
+                pass
+        self.assertEqual(self._fsck().returncode, 0)
+
+        past = time.time() - 7200
+        os.utime(path_old, (past, past))
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 8, proc.stdout + proc.stderr)
+        self.assertIn("orphaned: state/.tmp-old", proc.stdout)
+        self.assertNotIn("young", proc.stdout)
+
+        proc = self._fsck("--temp-age", "0")
+        self.assertEqual(proc.returncode, 8, proc.stdout + proc.stderr)
+        self.assertIn("young", proc.stdout)
+
+    def test_combined(self):
+        """The exit code combines all classes of problems found"""
+
+        self._corrupt(os.path.join(self.dstdir, "by-checksum", self._checksum("img/b.json")))
+        self._link("img/x.json", "../../by-checksum/sha256:" + "0" * 64)
+        self.assertEqual(self._fsck().returncode, 3)
+
+    def test_missing(self):
+        """Missing databases cannot be checked"""
+
+        proc = self._fsck(dstdir=os.path.join(self._tmp, "missing"))
+        self.assertEqual(proc.returncode, 16)
+        self.assertIn("No database", proc.stderr)
+
+        # Errors while checking are reported as well, instead of raised.
+        with open(os.path.join(self.dstdir, "packs"), "wb"):
+            pass
+        proc = self._fsck()
+        self.assertEqual(proc.returncode, 16, proc.stdout + proc.stderr)
+        self.assertIn("Cannot check", proc.stderr)
+        self.assertNotIn("Traceback", proc.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
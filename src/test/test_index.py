@@ -0,0 +1,208 @@
+"""Test the manifest database index"""
+
+
+import base64
+import hashlib
+import os
+import sqlite3
+import unittest
+import unittest.mock
+
+import mpp
+from mdb import Mdb, index
+
+from . import util
+
+
+FINGERPRINT = "0123456789ABCDEF0123456789ABCDEF89ABCDEF"
+
+
+class ProbeDepsolver(mpp.depsolve.DepsolveBackend):
+    """Depsolve backend that probes the index while a stub is pre-processed
+
+    Records the tags visible in the index at `PATH` in `PROBES`, or the
+    error if the index cannot be written right away. Also records the
+    objects a lookup of the source host `LOOKUP` returns.
+    """
+
+    PATH = None
+    PROBES = []
+    LOOKUP = "example.com"
+
+    def session_key(self, options):
+        return None
+
+    def resolve(self, options):
+        db = sqlite3.connect(self.PATH, timeout=0)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            self.PROBES.append([row[0] for row in db.execute("SELECT tag FROM tags")])
+            db.rollback()
+        except sqlite3.OperationalError as e:
+            self.PROBES.append(str(e))
+        finally:
+            db.close()
+
+        db_index = index.MdbIndex(self.PATH)
+        try:
+            self.PROBES.append(db_index.lookup(host=self.LOOKUP))
+        finally:
+            db_index.close()
+        return []
+
+
+def _facts(**kwargs):
+    facts = {
+        "stages": [],
+        "runners": [],
+        "platforms": [],
+        "packages": [],
+        "urls": [],
+        "gpgkeys": [],
+    }
+    facts.update(kwargs)
+    return facts
+
+
+class TestIndex(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+        self.index = index.MdbIndex(os.path.join(self._tmp, "state", "index.sqlite"))
+        self.addCleanup(self.index.close)
+
+        self.index.add_object("sha256:01", _facts(packages=["sha256:aa"], gpgkeys=[FINGERPRINT]))
+        self.index.add_object("sha256:02", _facts(packages=["sha256:bb"]))
+        self.index.set_tag("img/a.json", "sha256:01")
+        self.index.set_tag("img/b.json", "sha256:02")
+
+    def test_query_package(self):
+        """Queries match packages by checksum"""
+
+        self.assertEqual(self.index.query(package="sha256:aa"), [("img/a.json", "sha256:01")])
+        self.assertEqual(self.index.query(package="aa"), [])
+
+    def test_prune_tags(self):
+        """Tags that no longer exist, or moved, are dropped"""
+
+        self.index.set_tag("img/c.json", "sha256:02")
+        pruned = self.index.prune_tags({"img/a.json": "sha256:01", "img/b.json": "sha256:01"})
+        self.assertEqual(pruned, 2)
+        self.assertEqual(self.index.query(), [("img/a.json", "sha256:01")])
+
+    def test_lookup_gpgkey(self):
+        """Keys are looked up by fingerprint, long or short key ID"""
+
+        match = [("sha256:01", ["img/a.json"])]
+        for key in [
+                FINGERPRINT,
+                FINGERPRINT[-24:],
+                FINGERPRINT[-16:],
+                FINGERPRINT[-8:],
+                "0x" + FINGERPRINT[-16:].lower(),
+        ]:
+            self.assertEqual(self.index.lookup(gpgkey=key), match, key)
+
+        self.assertEqual(self.index.lookup(gpgkey=FINGERPRINT[:16]), [])
+
+    def test_lookup_gpgkey_invalid(self):
+        """Key IDs must be hexadecimal, so they never contain wildcards"""
+
+        for key in ["%", "_" * 16, "", "0" * 41]:
+            with self.assertRaises(ValueError):
+                self.index.lookup(gpgkey=key)
+
+    def test_gpgkey_fingerprints(self):
+        """Fingerprints are computed from armored version 4 keys"""
+
+        body = b"\x04" + b"\x00" * 4 + b"\x01" + b"\x00\x08\xff" * 2
+        packet = bytes([0xc6, len(body)]) + body
+        armored = "\n".join([
+            "-----BEGIN PGP PUBLIC KEY BLOCK-----",
+            "",
+            base64.b64encode(packet).decode(),
+            "=AAAA",
+            "-----END PGP PUBLIC KEY BLOCK-----",
+        ])
+        expected = hashlib.sha1(b"\x99" + len(body).to_bytes(2, "big") + body).hexdigest()
+        self.assertEqual(index.gpgkey_fingerprints(armored), [expected.upper()])
+
+
+
+class TestIndexDatabase(unittest.TestCase):
+    """Testcases of the index of a database"""
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+        self.srcdir = os.path.join(self._tmp, "src")
+        self.dstdir = os.path.join(self._tmp, "db")
+        util.write_stubs(self.srcdir)
+
+    def _query(self, *args):
+        proc = util.run("mdb", "query", "--dstdir", self.dstdir, *args)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return [line.split()[0] for line in proc.stdout.splitlines()]
+
+    def test_commit(self):
+        """Every stub is committed to the index as soon as it is linked"""
+
+        util.write_json(os.path.join(self.srcdir, "img/z.json"), {
+            "pipeline": {
+                "stages": [{
+                    "name": "org.osbuild.rpm",
+                    "options": {
+                        "mpp-depsolve": {
+                            "architecture": "x86_64",
+                            "baseurl": "https://example.com",
+                            "fedora": "37",
+                            "packages": [],
+                        },
+                    },
+                }],
+            },
+        })
+        os.makedirs(os.path.join(self.dstdir, "by-checksum"))
+
+        mpp.depsolve.BACKENDS["probe"] = ProbeDepsolver
+        self.addCleanup(mpp.depsolve.BACKENDS.pop, "probe")
+        path = os.path.join(self.dstdir, "state", "index.sqlite")
+        with unittest.mock.patch.object(ProbeDepsolver, "PATH", path), \
+                unittest.mock.patch.object(ProbeDepsolver, "PROBES", []):
+            argv = [
+                "osbuild-mdb", "--depsolve-backend", "probe",
+                "preprocess", "--jobs", "1", "--srcdir", self.srcdir, "--dstdir", self.dstdir,
+                "img",
+            ]
+            with Mdb(argv) as main:
+                self.assertEqual(main.run(), 0)
+            tags, objects = ProbeDepsolver.PROBES
+        self.assertEqual(tags, ["img/a.json", "img/b.json", "img/c.json"])
+
+        # Lookups see all objects linked so far, with their tags.
+        self.assertEqual(sorted(tag for _, tags in objects for tag in tags), tags)
+
+    def test_gc_prunes_tags(self):
+        """Tags removed from `by-tag` are dropped from the index by gc"""
+
+        util.preprocess(self.srcdir, self.dstdir)
+        self.assertEqual(self._query("--tag", "img/*"), ["img/a.json", "img/b.json", "img/c.json"])
+
+        # The object of `a` is deleted, the one of `b` is pinned, so only its
+        # tag is gone.
+        path_b = os.path.join(self.dstdir, "by-tag", "img", "b.json")
+        pin = os.path.basename(os.readlink(path_b))
+        os.unlink(os.path.join(self.dstdir, "by-tag", "img", "a.json"))
+        os.unlink(path_b)
+        args = ["--dstdir", self.dstdir, "--keep-recent", "0", "--pin", pin]
+        proc = util.run("mdb", "gc", *args, "--dry-run")
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(len(self._query("--tag", "img/*")), 3)
+
+        proc = util.run("mdb", "gc", *args)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(self._query("--tag", "img/*"), ["img/c.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+"""Test the pre-processor"""
+
+
+import os
+import time
+import unittest
+import unittest.mock
+
+import mpp
+
+from . import util
+
+
+class RendezvousDepsolver(mpp.depsolve.DepsolveBackend):
+    """Depsolve backend that waits for all platforms to be resolved at once
+
+    Every request announces its platform in the cache directory and waits
+    until the other platform was announced, too. Hence, requests of two
+    platforms only resolve if they are resolved concurrently. Every package
+    resolves to itself, with the ID of the resolving process as path.
+    """
+
+    CONCURRENT = True
+    PLATFORMS = ("36", "37")
+    TIMEOUT = 30
+
+    def session_key(self, options):
+        return str(options["fedora"])
+
+    def resolve(self, options):
+        with open(os.path.join(self._path_cache, options["fedora"]), "wb"):
+            pass
+        deadline = time.monotonic() + self.TIMEOUT
+        while not all(os.path.exists(os.path.join(self._path_cache, p)) for p in self.PLATFORMS):
+            if time.monotonic() > deadline:
+                raise RuntimeError("Platforms were not resolved concurrently")
+            time.sleep(0.01)
+
+        return [
+            {"checksum": name, "name": name, "path": str(os.getpid())}
+            for name in options["packages"]
+        ]
+
+
+class TestImports(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+        self.srcdir = os.path.join(self._tmp, "src")
+        util.write_stubs(self.srcdir)
+        self.engine = mpp.MppEngine(
+            path_cache=os.path.join(self._tmp, "cache"),
+            path_cwd=self.srcdir,
+        )
+
+    def _run(self, path):
+        with open(os.path.join(self.srcdir, path), "r", encoding="utf-8") as stream:
+            manifest = mpp.Manifest.from_stream(stream)
+        return mpp.MppContext(self.engine, manifest).run()
+
+    def test_import(self):
+        """Imported pipelines are resolved transitively"""
+
+        manifest = self._run("img/b.json")
+        self.assertEqual(len(manifest.levels), 2)
+        self.assertEqual(manifest.data["pipeline"]["build"]["runner"], "org.osbuild.fedora32")
+        self.assertIn("sha256:aa", manifest.data["sources"]["org.osbuild.files"]["urls"])
+
+    def test_cycle(self):
+        """Import cycles are detected"""
+
+        util.write_json(
+            os.path.join(self.srcdir, "base/build.json"),
+            {"mpp-pipeline-import": "base/os.json"},
+        )
+        with self.assertRaisesRegex(ValueError, "Import cycle"):
+            self._run("img/b.json")
+
+    def test_cycle_after_edit(self):
+        """Import cycles introduced into cached manifests are detected"""
+
+        self._run("img/b.json")
+        util.write_json(
+            os.path.join(self.srcdir, "base/build.json"),
+            {"mpp-pipeline-import": "base/os.json"},
+        )
+        with self.assertRaisesRegex(ValueError, "Import cycle"):
+            self._run("img/b.json")
+
+    def test_batch_mode(self):
+        """Batch output honours the umask, like a plain `open()`"""
+
+        path_output = os.path.join(self._tmp, "out", "b.json")
+        umask = os.umask(0o027)
+        try:
+            results = mpp.MppBatch(self.engine).process_files([
+                (os.path.join(self.srcdir, "img/b.json"), path_output),
+            ])
+        finally:
+            os.umask(umask)
+
+        self.assertNotIn("error", results[0])
+        self.assertEqual(os.stat(path_output).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(os.path.dirname(path_output)), ["b.json"])
+
+
+
+class TestDepsolve(unittest.TestCase):
+    """Testcases of the depsolve transformation"""
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+        mpp.depsolve.BACKENDS["rendezvous"] = RendezvousDepsolver
+        self.addCleanup(mpp.depsolve.BACKENDS.pop, "rendezvous")
+
+    @staticmethod
+    def _stage(fedora, packages):
+        return {
+            "name": "org.osbuild.rpm",
+            "options": {
+                "mpp-depsolve": {
+                    "architecture": "x86_64",
+                    "baseurl": f"https://example.com/{fedora}",
+                    "fedora": fedora,
+                    "packages": packages,
+                },
+            },
+        }
+
+    def test_concurrent(self):
+        """Requests of distinct repositories are resolved concurrently"""
+
+        engine = mpp.MppEngine(
+            path_cache=self._tmp,
+            path_cwd=self._tmp,
+            depsolve_backend="rendezvous",
+        )
+        self.addCleanup(engine.close)
+
+        manifest = engine.process(mpp.Manifest({
+            "pipeline": {
+                "build": {
+                    "pipeline": {"stages": [self._stage("36", ["gcc"])]},
+                    "runner": "org.osbuild.fedora36",
+                },
+                "stages": [self._stage("37", ["bash"]), self._stage("37", ["bash"])],
+            },
+        }))
+
+        build, tree = manifest.data["pipeline"]["build"]["pipeline"], manifest.data["pipeline"]
+        self.assertEqual(build["stages"][0]["options"], {"packages": ["gcc"]})
+        for stage in tree["stages"]:
+            self.assertEqual(stage["options"], {"packages": ["bash"]})
+
+        urls = manifest.data["sources"]["org.osbuild.files"]["urls"]
+        self.assertEqual(set(urls), {"gcc", "bash"})
+        self.assertTrue(urls["gcc"].startswith("https://example.com/36/"))
+        pids = {url.rsplit("/", 1)[-1] for url in urls.values()}
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(str(os.getpid()), pids)
+
+    def test_single_job(self):
+        """Without worker processes, requests are resolved one after another"""
+
+        engine = mpp.MppEngine(
+            path_cache=self._tmp,
+            path_cwd=self._tmp,
+            depsolve_backend="rendezvous",
+            depsolve_jobs=1,
+        )
+        manifest = mpp.Manifest({
+            "pipeline": {"stages": [self._stage("36", ["gcc"]), self._stage("37", ["bash"])]},
+        })
+        with unittest.mock.patch.object(RendezvousDepsolver, "TIMEOUT", 0.1):
+            with self.assertRaisesRegex(RuntimeError, "not resolved concurrently"):
+                engine.process(manifest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""Test `mdb preprocess`"""
+
+
+import hashlib
+import json
+import os
+import unittest
+
+from mpp import depsolve
+
+from . import util
+
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo"><revision>{}</revision></repomd>
+"""
+
+
+class TestPreprocess(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    DEPSOLVE = {"architecture": "x86_64", "fedora": "37", "packages": ["bash"]}
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+        self.srcdir = os.path.join(self._tmp, "src")
+        self.dstdir = os.path.join(self._tmp, "db")
+        self.cache = os.path.join(self._tmp, "cache")
+        self.snapshot = os.path.join(self._tmp, "snapshot")
+        util.write_stubs(self.srcdir)
+
+    def _snapshot(self, name, *args):
+        dstdir = os.path.join(self._tmp, name)
+        util.preprocess(self.srcdir, dstdir, *args)
+        return util.snapshot(dstdir)
+
+    def test_tags(self):
+        """Every stub is tagged with its pre-processed object"""
+
+        result = self._snapshot("db")
+        tags = sorted(p for p in result if p.startswith("by-tag"))
+        self.assertEqual(tags, [os.path.join("by-tag", "img", f"{n}.json") for n in "abc"])
+        for tag in tags:
+            self.assertIn(os.path.join("by-checksum", os.path.basename(result[tag])), result)
+
+    def test_isolated(self):
+        """In-process and isolated pre-processing produce identical databases"""
+
+        self.assertEqual(self._snapshot("inprocess"), self._snapshot("isolated", "--isolate"))
+
+    def test_jobs(self):
+        """Parallel pre-processing produces an identical database"""
+
+        self.assertEqual(self._snapshot("serial"), self._snapshot("parallel", "--jobs", "3"))
+
+    def test_up_to_date(self):
+        """Pre-processing again keeps the database unchanged"""
+
+        dstdir = os.path.join(self._tmp, "db")
+        util.preprocess(self.srcdir, dstdir)
+        before = util.snapshot(dstdir)
+        util.preprocess(self.srcdir, dstdir)
+        self.assertEqual(util.snapshot(dstdir), before)
+
+    def _depsolve_setup(self):
+        # Add a stub with a depsolve request, resolved against a local
+        # snapshot. Dnf is not needed, since all results are cached.
+        util.write_json(os.path.join(self.srcdir, "img/d.json"), {
+            "pipeline": {
+                "stages": [{
+                    "name": "org.osbuild.rpm",
+                    "options": {"mpp-depsolve": dict(self.DEPSOLVE, baseurl="https://example.com")},
+                }],
+            },
+        })
+        os.makedirs(os.path.join(self.dstdir, "by-checksum"))
+
+    def _depsolve_revision(self, revision, checksum):
+        # Publish a new revision of the snapshot, and cache the result of the
+        # request for it.
+        path = os.path.join(self.snapshot, "fedora-37", "x86_64", "repodata", "repomd.xml")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = REPOMD.format(revision).encode()
+        with open(path, "wb") as stream:
+            stream.write(data)
+
+        cache = depsolve.DepsolveCache(os.path.join(self.cache, "depsolve"))
+        request = cache.normalize(self.DEPSOLVE)
+        revision = [["default", str(revision), hashlib.sha256(data).hexdigest()]]
+        deps = [{"checksum": checksum, "name": "bash", "path": "bash.rpm"}]
+        cache.store(cache.key(request, revision), request, revision, deps)
+
+    def _depsolve_run(self, *args):
+        # Pre-process all stubs and return the number of pre-processed stubs
+        # and the packages of the depsolved stub.
+        path_trace = os.path.join(self._tmp, "trace.json")
+        proc = util.run(
+            "mdb",
+            "--cache", self.cache,
+            "--depsolve-snapshot", self.snapshot,
+            "--trace", path_trace,
+            "preprocess", "--srcdir", self.srcdir, "--dstdir", self.dstdir, *args, "img",
+            cwd=self.srcdir,
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+
+        with open(path_trace, "r", encoding="utf-8") as stream:
+            events = json.load(stream)["traceEvents"]
+        count = sum(1 for event in events if event["name"] == "preprocess")
+        path = os.path.join(self.dstdir, "by-tag", "img", "d.json")
+        with open(path, "r", encoding="utf-8") as stream:
+            packages = json.load(stream)["pipeline"]["stages"][0]["options"]["packages"]
+        return count, packages
+
+    def test_up_to_date_revision(self):
+        """Stubs are pre-processed again if their repository metadata changed"""
+
+        self._depsolve_setup()
+        self._depsolve_revision(1, "sha256:01")
+        self.assertEqual(self._depsolve_run(), (4, ["sha256:01"]))
+        self.assertEqual(self._depsolve_run(), (0, ["sha256:01"]))
+
+        self._depsolve_revision(2, "sha256:02")
+        self.assertEqual(self._depsolve_run(), (1, ["sha256:02"]))
+        self.assertEqual(self._depsolve_run(), (0, ["sha256:02"]))
+
+    def test_up_to_date_options(self):
+        """Stubs are pre-processed again if their options changed"""
+
+        self._depsolve_setup()
+        self._depsolve_revision(1, "sha256:01")
+        self.assertEqual(self._depsolve_run()[0], 4)
+        self.assertEqual(self._depsolve_run("--compress", "gzip")[0], 4)
+        self.assertEqual(self._depsolve_run("--compress", "gzip")[0], 0)
+        self.assertEqual(self._depsolve_run()[0], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
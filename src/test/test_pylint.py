@@ -30,7 +30,7 @@ class TestPylint(unittest.TestCase):
         files = filter(lambda p: p.endswith(".py"), files)
 
         # Run pylint on all files.
-        proc = subprocess.Popen(
+        with subprocess.Popen(
             [
                 "pylint",
                 "--disable", "duplicate-code",
@@ -39,8 +39,8 @@ class TestPylint(unittest.TestCase):
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-        )
-        output, _ = proc.communicate()
+        ) as proc:
+            output, _ = proc.communicate()
         if proc.returncode != 0:
             print("FAILED")
             print(output)
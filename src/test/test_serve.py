@@ -0,0 +1,167 @@
+"""Test `mdb serve`"""
+
+
+import asyncio
+import contextlib
+import gzip
+import http.client
+import os
+import threading
+import unittest
+
+from mdb import serve
+from mdb import store
+
+from . import util
+
+
+class TestAcceptEncoding(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def test_accepts(self):
+        """Quality values of content-codings are honoured"""
+
+        cases = [
+            ("gzip", True),
+            ("gzip, deflate, br", True),
+            ("GZIP;q=0.5", True),
+            ("gzip;q=0", False),
+            ("gzip; q=0.000", False),
+            ("deflate", False),
+            ("", False),
+            ("*", True),
+            ("*;q=0", False),
+            ("*, gzip;q=0", False),
+            ("*;q=0, gzip", True),
+            ("gzip;q=invalid", False),
+        ]
+        for header, expected in cases:
+            self.assertEqual(serve.accepts_encoding(header, "gzip"), expected, header)
+
+
+class TestServe(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.database(self)
+        self.dstdir = os.path.join(self._tmp, "db")
+
+        tag = os.path.join(self.dstdir, "by-tag", "img", "a.json")
+        self.checksum = os.path.basename(os.readlink(tag))
+        with store.ObjectStore(self.dstdir) as objects:
+            self.content = objects.read(self.checksum)
+            objects.repack(compression="gzip")
+
+        self._start(self.dstdir)
+
+    def _start(self, dstdir):
+        # Run the server on its own event loop in a thread, until the test
+        # is done.
+        server = serve.MdbServer(dstdir)
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        addresses = []
+
+        def on_ready(bound):
+            addresses.extend(bound)
+            ready.set()
+
+        task = loop.create_task(server.serve("127.0.0.1", 0, ready=on_ready))
+
+        def run():
+            with contextlib.suppress(asyncio.CancelledError):
+                loop.run_until_complete(task)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.assertTrue(ready.wait(10))
+        self.port = addresses[0][1]
+
+        def stop():
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+            loop.close()
+            server.close()
+
+        self.addCleanup(stop)
+
+    def _get(self, path, headers):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def test_encoded(self):
+        """Gzip-compressed objects are sent as they are, with their own ETag"""
+
+        for path in [f"/by-checksum/{self.checksum}", "/by-tag/img/a.json"]:
+            status, headers, body = self._get(path, {"Accept-Encoding": "gzip"})
+            self.assertEqual(status, 200)
+            self.assertEqual(headers.get("Content-Encoding"), "gzip")
+            self.assertEqual(headers["ETag"], f'"{self.checksum}-gzip"')
+            self.assertEqual(gzip.decompress(body), self.content)
+
+    def test_identity(self):
+        """Clients not accepting gzip get the decoded object"""
+
+        for accept in ["gzip;q=0", "identity", "deflate"]:
+            status, headers, body = self._get(
+                f"/by-checksum/{self.checksum}",
+                {"Accept-Encoding": accept},
+            )
+            self.assertEqual(status, 200)
+            self.assertNotIn("Content-Encoding", headers)
+            self.assertEqual(headers["ETag"], f'"{self.checksum}"')
+            self.assertEqual(body, self.content)
+
+    def test_revalidate(self):
+        """ETags are only matched against the representation they name"""
+
+        path = "/by-tag/img/a.json"
+        plain = f'"{self.checksum}"'
+        encoded = f'"{self.checksum}-gzip"'
+
+        status, _, _ = self._get(path, {"If-None-Match": plain})
+        self.assertEqual(status, 304)
+        status, _, _ = self._get(path, {"If-None-Match": f"W/{encoded}, {plain}"})
+        self.assertEqual(status, 304)
+        status, headers, _ = self._get(path, {"If-None-Match": encoded})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["ETag"], plain)
+
+        status, headers, _ = self._get(path, {"If-None-Match": plain, "Accept-Encoding": "gzip"})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["ETag"], encoded)
+        status, headers, _ = self._get(path, {"If-None-Match": encoded, "Accept-Encoding": "gzip"})
+        self.assertEqual(status, 304)
+        self.assertEqual(headers["ETag"], encoded)
+
+
+    def test_corrupt(self):
+        """Objects that cannot be decoded fail with a server error"""
+
+        # Break the size in the gzip trailer of the object.
+        with store.ObjectStore(self.dstdir) as objects:
+            path, offset, length = objects.locate(self.checksum)
+        with open(path, "r+b") as stream:
+            stream.seek(offset + length - 1)
+            stream.write(b"\xff")
+
+        status, headers, _ = self._get(f"/by-checksum/{self.checksum}", {})
+        self.assertEqual(status, 500)
+        self.assertEqual(headers["Connection"], "close")
+
+        # Encoded objects are sent as they are, so the client detects it.
+        status, _, _ = self._get(f"/by-checksum/{self.checksum}", {"Accept-Encoding": "gzip"})
+        self.assertEqual(status, 200)
+
+        status, _, body = self._get("/metrics", {})
+        self.assertEqual(status, 200)
+        self.assertIn(b'mdb_requests_total{route="error",status="500"} 1', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
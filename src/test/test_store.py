@@ -0,0 +1,144 @@
+"""Test the object store"""
+
+
+import hashlib
+import importlib.util
+import os
+import unittest
+
+from mdb import store
+
+from . import util
+
+
+def _checksum(content):
+    return store.CHECKSUM_PREFIX + hashlib.sha256(content).hexdigest()
+
+
+class TestStore(unittest.TestCase):
+    """Testcases of this unittest"""
+
+    def setUp(self):
+        self._tmp = util.tempdir(self)
+
+    def _database(self, name, compression=None):
+        # Create a database with a few loose objects, stored with the given
+        # compression, and return its path and the content of all objects.
+        dstdir = os.path.join(self._tmp, name)
+        os.makedirs(os.path.join(dstdir, "by-checksum"))
+
+        contents = {}
+        with store.ObjectStore(dstdir) as objects:
+            for i in range(32):
+                content = b'{"object": %d, "data": "%s"}\n' % (i, b"x" * (i * 97))
+                checksum = _checksum(content)
+                contents[checksum] = content
+                path = os.path.join(dstdir, "by-checksum", checksum)
+                with open(path, "wb") as stream:
+                    stream.write(objects.encode(content, compression))
+        return dstdir, contents
+
+    def _verify(self, dstdir, contents):
+        with store.ObjectStore(dstdir) as objects:
+            for checksum, content in contents.items():
+                self.assertTrue(objects.contains(checksum))
+                self.assertEqual(objects.read(checksum), content)
+                self.assertEqual(bytes(objects.view(checksum)), content)
+            self.assertEqual(dict(objects.objects()), contents)
+            self.assertFalse(objects.contains(_checksum(b"missing")))
+            with self.assertRaises(FileNotFoundError):
+                objects.read(_checksum(b"missing"))
+
+    @staticmethod
+    def _compressions():
+        compressions = [None, "gzip", "lzma"]
+        if importlib.util.find_spec("zstandard") is not None:
+            compressions.append("zstd")
+        return compressions
+
+    def test_loose(self):
+        """Loose objects are read back decompressed"""
+
+        for compression in self._compressions():
+            with self.subTest(compression=compression):
+                dstdir, contents = self._database(f"loose-{compression}", compression)
+                self._verify(dstdir, contents)
+
+    def test_repack(self):
+        """Packed objects round-trip with every compression"""
+
+        for compression in self._compressions():
+            with self.subTest(compression=compression):
+                dstdir, contents = self._database(f"pack-{compression}")
+                with store.ObjectStore(dstdir) as objects:
+                    packed, skipped = objects.repack(compression=compression)
+                    self.assertEqual((packed, skipped), (len(contents), []))
+                    self.assertEqual(list(objects.loose()), [])
+                    self.assertEqual(len(objects.packs), 1)
+                    for _name, raw in objects.objects(raw=True):
+                        self.assertEqual(store.compression_of(raw), compression)
+                self._verify(dstdir, contents)
+
+    def test_merge(self):
+        """Merging packs keeps all objects, recompressed"""
+
+        dstdir, contents = self._database("merge")
+        more, _ = self._database("more")
+        for name in os.listdir(os.path.join(more, "by-checksum")):
+            os.rename(
+                os.path.join(more, "by-checksum", name),
+                os.path.join(dstdir, "by-checksum", name),
+            )
+
+        with store.ObjectStore(dstdir) as objects:
+            objects.repack()
+            extra = b'{"extra": true}\n'
+            contents[_checksum(extra)] = extra
+            with open(os.path.join(dstdir, "by-checksum", _checksum(extra)), "wb") as stream:
+                stream.write(extra)
+            objects.repack()
+            self.assertEqual(len(objects.packs), 2)
+            objects.repack(merge=True, compression="gzip")
+            self.assertEqual(len(objects.packs), 1)
+        self._verify(dstdir, contents)
+
+    def test_corrupt(self):
+        """Corrupt loose objects are neither packed nor deleted"""
+
+        dstdir, contents = self._database("corrupt")
+        checksum = next(iter(contents))
+        path = os.path.join(dstdir, "by-checksum", checksum)
+        with open(path, "ab") as stream:
+            stream.write(b"corrupt")
+
+        with store.ObjectStore(dstdir) as objects:
+            packed, skipped = objects.repack()
+            self.assertEqual((packed, skipped), (len(contents) - 1, [checksum]))
+            self.assertEqual(list(objects.loose()), [checksum])
+            digest = store.checksum_digest(checksum)
+            self.assertFalse(objects.verify(digest, objects.read(checksum)))
+
+    def test_sweep_duplicate(self):
+        """Objects both packed and loose are swept once"""
+
+        dstdir, contents = self._database("duplicate")
+        checksum = next(iter(contents))
+        with store.ObjectStore(dstdir) as objects:
+            objects.repack()
+        path = os.path.join(dstdir, "by-checksum", checksum)
+        with open(path, "wb") as stream:
+            stream.write(contents[checksum])
+
+        proc = util.run("mdb", "gc", "--dstdir", dstdir, "--keep-recent", "0")
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        lines = proc.stdout.splitlines()
+        self.assertEqual(len(lines), len(contents) + 1)
+        # Both copies are stored uncompressed, and both are reclaimed.
+        self.assertIn(f"{checksum}  {2 * len(contents[checksum]):>10}", lines)
+        reclaimed = sum(len(content) for content in contents.values()) + len(contents[checksum])
+        self.assertEqual(lines[-1], f"Reclaimed {reclaimed} bytes in {len(contents)} objects")
+        self.assertEqual(os.listdir(os.path.join(dstdir, "by-checksum")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
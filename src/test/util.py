@@ -0,0 +1,151 @@
+"""Test Helpers"""
+
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from . import SRCDIR
+
+
+# Manifest stubs, by path, which pre-process without depsolving. They use
+# pipeline imports and bases, nested build pipelines and runners.
+STUBS = {
+    "base/build.json": {
+        "pipeline": {
+            "stages": [
+                {"name": "org.osbuild.rpm", "options": {"packages": ["sha256:aa"]}},
+            ],
+        },
+        "sources": {
+            "org.osbuild.files": {"urls": {"sha256:aa": "http://example.com/a.rpm"}},
+        },
+    },
+    "base/os.json": {
+        "pipeline": {
+            "build": {
+                "mpp-pipeline-import": "base/build.json",
+                "runner": "org.osbuild.fedora32",
+            },
+            "stages": [
+                {"name": "org.osbuild.rpm", "options": {"packages": ["sha256:bb"]}},
+            ],
+        },
+        "sources": {
+            "org.osbuild.files": {"urls": {"sha256:bb": "http://example.com/b.rpm"}},
+        },
+    },
+    "img/a.json": {
+        "pipeline": {
+            "mpp-pipeline-base": "base/os.json",
+            "stages": [{"name": "org.osbuild.locale", "options": {"language": "en_US"}}],
+        },
+    },
+    "img/b.json": {
+        "mpp-pipeline-import": "base/os.json",
+    },
+    "img/c.json": {
+        "pipeline": {
+            "build": {
+                "mpp-pipeline-import": "base/build.json",
+                "runner": "org.osbuild.fedora32",
+            },
+            "stages": [{"name": "org.osbuild.noop"}],
+        },
+    },
+}
+
+
+def tempdir(testcase):
+    """Create a temporary directory for the duration of a testcase
+
+    The directory is removed when `testcase` is cleaned up. Return its path.
+    """
+
+    # The directory outlives this function, `addCleanup()` removes it.
+    tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    testcase.addCleanup(tmp.cleanup)
+    return tmp.name
+
+
+def write_json(path, data):
+    """Write a JSON document, creating its parent directories"""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(data, stream)
+
+
+def write_stubs(srcdir, stubs=None):
+    """Write manifest stubs into `srcdir`, by default `STUBS`"""
+
+    for path, data in (STUBS if stubs is None else stubs).items():
+        write_json(os.path.join(srcdir, path), data)
+
+
+def run(module, *args, cwd=None):
+    """Run the command-line interface of a module of the source tree
+
+    Return the completed process, with its output decoded.
+    """
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRCDIR, env.get("PYTHONPATH")]))
+    return subprocess.run(
+        [sys.executable, "-m", module] + list(args),
+        cwd=cwd,
+        env=env,
+        encoding="utf-8",
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+
+
+def preprocess(srcdir, dstdir, *args):
+    """Pre-process all stubs of `img` in `srcdir` into the database `dstdir`"""
+
+    os.makedirs(os.path.join(dstdir, "by-checksum"), exist_ok=True)
+    proc = run(
+        "mdb", "preprocess", "--srcdir", srcdir, "--dstdir", dstdir, *args, "img",
+        cwd=srcdir,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"mdb preprocess failed:\n{proc.stderr}")
+
+
+def database(testcase, *args):
+    """Create a database for the duration of a testcase
+
+    Write `STUBS` into `src` of a new temporary directory, and pre-process
+    them into the database `db` next to it, passing `args` on. Return the
+    path of the temporary directory.
+    """
+
+    path = tempdir(testcase)
+    write_stubs(os.path.join(path, "src"))
+    preprocess(os.path.join(path, "src"), os.path.join(path, "db"), *args)
+    return path
+
+
+def snapshot(dstdir):
+    """Return the objects and tags of a database
+
+    Return a dictionary mapping the path of every object to its content, and
+    of every tag to its link target.
+    """
+
+    result = {}
+    for level, _subdirs, files in os.walk(dstdir):
+        for entry in files:
+            path = os.path.join(level, entry)
+            rel = os.path.relpath(path, dstdir)
+            if os.path.islink(path):
+                result[rel] = os.readlink(path)
+            elif rel.startswith("by-checksum" + os.sep):
+                with open(path, "rb") as stream:
+                    result[rel] = stream.read()
+    return result